@@ -0,0 +1,159 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, delete, exists, select
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import aliased
+from database import ReadSessionLocal, run_write, insert_ignore
+import models
+
+#ROUND ARCHIVE, finished rounds older than ARCHIVE_AGE leave games and spots for one sqlite file per day
+#archived_rounds and archived_spots in the main database stay behind as the index, the ledger is untouched
+#a batch is read and written to its file off the writer thread, only the summary insert and the delete go through it
+#the file write is idempotent, so a crash between the two just archives the same rounds again next run
+
+archive_metadata = MetaData()
+
+def copy_table(table):
+	#same columns as the live table, no foreign keys since players and configs aren't in the file
+	return Table(table.name, archive_metadata, *[Column(column.name, column.type, primary_key=column.primary_key) for column in table.columns])
+
+archived_games = copy_table(models.Game.__table__)
+archived_spots = copy_table(models.Spot.__table__)
+Index("ix_games_num_time", archived_games.c.num, archived_games.c.time_created)
+Index("ix_spots_game_id", archived_spots.c.game_id)
+
+def get_day(timestamp):
+	return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+class Archive:
+	def __init__(self, config):
+		self.AGE = config["ARCHIVE_AGE"]
+		self.BATCH_SIZE = min(config["ARCHIVE_BATCH_SIZE"], models.MAX_IN_PARAMS)
+		self.MAX_PER_RUN = config["ARCHIVE_MAX_PER_RUN"]
+		self.DIR = config["ARCHIVE_DIR"]
+		self.MAX_OPEN_FILES = config["ARCHIVE_MAX_OPEN_FILES"]
+		self.engines = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get_path(self, day):
+		return os.path.join(self.DIR, f"rounds-{day}.db")
+
+	def get_engine(self, day, create=False):
+		#a few day files stay open, least recently used closes first
+		with self.lock:
+			db_engine = self.engines.get(day)
+			if db_engine is not None:
+				self.engines.move_to_end(day)
+				return db_engine
+			path = self.get_path(day)
+			if not create and not os.path.exists(path):
+				return None
+			os.makedirs(self.DIR, exist_ok=True)
+			db_engine = create_engine(f"sqlite:///{path}")
+			archive_metadata.create_all(db_engine)
+			self.engines[day] = db_engine
+			if len(self.engines) > self.MAX_OPEN_FILES:
+				self.engines.popitem(last=False)[1].dispose()
+			return db_engine
+
+	async def archive_old_rounds(self):
+		archived = 0
+		while archived < self.MAX_PER_RUN:
+			batch = await asyncio.to_thread(self.load_batch)
+			if not batch:
+				break
+			await asyncio.to_thread(self.write_files, batch)
+			await run_write(self.forget, batch)
+			archived += len(batch)
+		if archived:
+			print(f"archived {archived} rounds")
+		return archived
+
+	def load_batch(self):
+		#oldest finished rounds first, the one before each live round stays since its board shows that round's secrets
+		cutoff = models.get_current_time() - self.AGE
+		game = models.Game.__table__
+		successor = aliased(models.Game)
+		db = ReadSessionLocal()
+		try:
+			rows = db.execute(select(game).where(game.c.active == False, game.c.time_created < cutoff,
+				~exists().where(successor.last_game_id == game.c.id, successor.active))
+				.order_by(game.c.time_created.asc()).limit(self.BATCH_SIZE)).mappings().all()
+			rounds = {row["id"]: {"game":dict(row), "spots":[]} for row in rows}
+			if not rounds:
+				return []
+			for row in db.execute(select(models.Spot.__table__).where(models.Spot.game_id.in_(list(rounds)))).mappings():
+				rounds[row["game_id"]]["spots"].append(dict(row))
+			return list(rounds.values())
+		finally:
+			db.close()
+
+	def write_files(self, batch):
+		by_day = {}
+		for archived_round in batch:
+			by_day.setdefault(get_day(archived_round["game"]["time_created"]), []).append(archived_round)
+		for day, rounds in by_day.items():
+			with self.get_engine(day, create=True).begin() as connection:
+				connection.execute(sqlite.insert(archived_games).on_conflict_do_nothing(), [archived_round["game"] for archived_round in rounds])
+				spots = [spot for archived_round in rounds for spot in archived_round["spots"]]
+				if spots:
+					connection.execute(sqlite.insert(archived_spots).on_conflict_do_nothing(), spots)
+
+	def forget(self, db, batch):
+		#runs on the writer thread, summary rows in and live rows out in one transaction
+		rounds = []
+		spots = []
+		for archived_round in batch:
+			game = archived_round["game"]
+			winning_spot = game["state"].split(":")[1] if game["state"].startswith("4:") else None
+			winner_id = None
+			for spot in archived_round["spots"]:
+				won = str(spot["spot_num"]) == winning_spot
+				if won:
+					winner_id = spot["player_id"]
+				spots.append({"game_id":game["id"],"spot_num":spot["spot_num"],"player_id":spot["player_id"],"cost":spot["cost"],"won":won,"time_created":spot["time_created"]})
+			rounds.append({"id":game["id"],"num":game["num"],"config_id":game["config_id"],"day":get_day(game["time_created"]),"winner_id":winner_id,
+				"prize":game["prize"],"time_created":game["time_created"]})
+		ids = [game["id"] for game in rounds]
+		db.execute(insert_ignore(models.ArchivedRound, ["id"]), rounds)
+		if spots:
+			db.execute(insert_ignore(models.ArchivedSpot, ["game_id", "spot_num"]), spots)
+		db.execute(delete(models.Spot).where(models.Spot.game_id.in_(ids)))
+		db.execute(delete(models.Game).where(models.Game.id.in_(ids), models.Game.active == False))
+		db.commit()
+
+	def load_rounds(self, day, ids):
+		#archived rounds in the shape fairness.load_batches builds from the live tables
+		db_engine = self.get_engine(day)
+		if db_engine is None:
+			return []
+		with db_engine.connect() as connection:
+			games = {row.id: dict(row._mapping, spots=[], payouts=[], last_game=None) for row in connection.execute(select(archived_games.c.id, archived_games.c.num,
+				archived_games.c.secret, archived_games.c.spot_secret, archived_games.c.state, archived_games.c.spot_count, archived_games.c.prize,
+				archived_games.c.last_game_id, archived_games.c.time_created).where(archived_games.c.id.in_(ids)))}
+			for game_id, *spot in connection.execute(select(archived_spots.c.game_id, archived_spots.c.spot_num, archived_spots.c.secret,
+				archived_spots.c.secret_time, archived_spots.c.player_id, archived_spots.c.time_created).where(archived_spots.c.game_id.in_(list(games)))):
+				games[game_id]["spots"].append(tuple(spot))
+		return list(games.values())
+
+	def close(self):
+		with self.lock:
+			for db_engine in self.engines.values():
+				db_engine.dispose()
+			self.engines = OrderedDict()
+
+def get_player_history(db, player_id, limit):
+	#newest first, live rounds then the archive index
+	spots = db.query(models.Spot.game_id, models.Game.num, models.Spot.spot_num, models.Spot.cost, models.Game.state, models.Spot.time_created).join(models.Game)\
+		.filter(models.Spot.player_id == player_id, models.Game.active == False).order_by(models.Spot.time_created.desc()).limit(limit)
+	history = [{"game_id":game_id,"num":num,"spot_num":spot_num,"cost":cost,"won":state == f"4:{spot_num}","time_created":time_created}
+		for game_id, num, spot_num, cost, state, time_created in spots]
+	if len(history) < limit:
+		db_archived_spots = models.ArchivedSpot.get_by_player(db, player_id, limit - len(history))
+		nums = {archived_round.id: archived_round.num for archived_round in models.ArchivedRound.get_many(db, [spot.game_id for spot in db_archived_spots])}
+		history += [{"game_id":spot.game_id,"num":nums.get(spot.game_id),"spot_num":spot.spot_num,"cost":spot.cost,"won":spot.won,"time_created":spot.time_created}
+			for spot in db_archived_spots]
+	return history
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+#BACKEND SMOKE, the money path run once against each database backend
+#migrate an empty database, buy out a table, tick it to payout, claim a withdraw, then the dialect specific statements:
+#insert_ignore, the leader lease conditional update and reconcile's correlated update
+#run from the repo root: python -m bench.backend_smoke [--url postgresql+psycopg://user@localhost/arcade_smoke]
+#sqlite always runs on a scratch file, every --url must be an empty database since the run writes to it
+#postgres urls need the driver, pip install -r requirements-postgres.txt
+
+SCRATCH_DIR = os.path.join("data", "bench_backend")
+MAX_TICKS = 100
+
+def check(name, ok, detail=""):
+	if not ok:
+		raise AssertionError(f"{name} failed {detail}".strip())
+	print(f"  ok {name}")
+
+def run_checks():
+	#imported here so database.py binds to the DATABASE_URL this child was started with
+	from sqlalchemy import inspect, func, update
+	from database import engine, ReadSessionLocal, run_write_sync
+	from game_engine import GameEngine
+	import migrations
+	import models
+
+	with engine.connect() as connection:
+		if inspect(connection).has_table(models.Player.__tablename__):
+			raise SystemExit(f"{engine.url.render_as_string()} already has tables, point the smoke at an empty database")
+	check("migrations", migrations.upgrade(engine) == migrations.MIGRATIONS[-1][0])
+
+	with open(os.environ.get("CONFIG_FILE", "config.json"), "r") as file:
+		config = json.load(file)
+	game_engine = GameEngine(config["GAME_CONFIGS"])
+
+	def seed(db):
+		players = [models.Player.create(db, f"smoke{i}", f"smoke-fingerprint-{i}") for i in range(4)]
+		for player in players:
+			player.balance_add(db, 10 * models.NORMALIZER, "smoke")
+		db.commit()
+		game_engine.recover(db)
+		db.commit()
+		return [player.id for player in players]
+	player_ids = run_write_sync(seed)
+
+	def buy_out(db):
+		#same order as main.buy_spot, game row then player row, both locked
+		game = min(models.Game.get_current_games(db), key=lambda game: game.spot_count)
+		for spot_num, player_id in enumerate(player_ids[:game.spot_count], start=1):
+			game = models.Game.get_for_update(db, game.id)
+			player = models.Player.get_for_update(db, player_id)
+			if not game.add_spot(db, spot_num, player):
+				return None, None
+			db.expire_all()
+		game = models.Game.get(db, game.id)
+		game_engine.update(game)
+		return game.id, game.state
+	game_id, state = run_write_sync(buy_out)
+	check("buy", game_id is not None and state.startswith("1:"), state)
+
+	for _ in range(MAX_TICKS):
+		run_write_sync(game_engine.tick)
+		if game_id not in game_engine.games:
+			break
+
+	def get_payout(db):
+		game = models.Game.get(db, game_id)
+		payouts = db.query(models.LedgerEntry).filter(models.LedgerEntry.kind == "payout", models.LedgerEntry.ref_id == game_id).all()
+		next_game = db.query(models.Game).filter(models.Game.last_game_id == game_id, models.Game.active).one_or_none()
+		return game.active, game.state, [(entry.player_id, entry.amount) for entry in payouts], next_game is not None, game.prize * models.NORMALIZER
+	active, state, payouts, dealt, prize = run_write_sync(get_payout)
+	check("payout", not active and state.startswith("4:") and len(payouts) == 1 and payouts[0][1] == prize, f"{state} {payouts}")
+	check("next round", dealt)
+
+	def withdraw(db):
+		player = models.Player.get_for_update(db, payouts[0][0])
+		request = models.WithdrawRequest.create(db, player, models.NORMALIZER, "smoke-address")
+		first = [claimed.id for claimed in models.WithdrawRequest.claim_queued(db, "smoke-a", 10, 60)]
+		second = models.WithdrawRequest.claim_queued(db, "smoke-b", 10, 60)
+		return request is not None and first == [request.id] and not second
+	check("withdraw claim", run_write_sync(withdraw))
+
+	def insert_ignore(db):
+		transaction = {"tx_hash":"smoke-tx","amount":1,"block_height":1,"unlocked":True,"credited":False}
+		models.Transaction.bulk_insert(db, [transaction])
+		models.Transaction.bulk_insert(db, [transaction])
+		return db.query(func.count(models.Transaction.id)).scalar()
+	check("insert_ignore", run_write_sync(insert_ignore) == 1)
+
+	def lease(db):
+		return (models.LeaderLease.acquire(db, "smoke", "a", 60), models.LeaderLease.acquire(db, "smoke", "b", 60),
+			models.LeaderLease.acquire(db, "smoke", "a", 60))
+	check("leader lease", run_write_sync(lease) == (True, False, True))
+
+	def reconcile(db):
+		#knock a balance off its ledger sum, reconcile has to put exactly that one back
+		db.execute(update(models.Player).where(models.Player.id == player_ids[0]).values(balance=models.Player.balance + 1))
+		db.commit()
+		fixed = [row[0] for row in models.LedgerEntry.reconcile(db)]
+		return fixed, models.LedgerEntry.reconcile(db)
+	fixed, again = run_write_sync(reconcile)
+	check("reconcile", fixed == [player_ids[0]] and not again, f"{fixed} {again}")
+
+	db = ReadSessionLocal()
+	try:
+		check("read session", db.query(func.count(models.Player.id)).scalar() == len(player_ids))
+	finally:
+		db.close()
+
+def main():
+	parser = argparse.ArgumentParser(description="run the money path against sqlite and any other database urls given")
+	parser.add_argument("--url", action="append", default=[], help="extra database url, must be empty, can be repeated")
+	parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+	args = parser.parse_args()
+	if args.child:
+		run_checks()
+		return
+
+	shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+	os.makedirs(SCRATCH_DIR)
+	urls = [f"sqlite:///{SCRATCH_DIR}/data.db"] + args.url
+	failed = []
+	for url in urls:
+		print(url.split("://")[0])
+		result = subprocess.run([sys.executable, "-m", "bench.backend_smoke", "--child"], env=dict(os.environ, DATABASE_URL=url))
+		if result.returncode:
+			failed.append(url.split("://")[0])
+	shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+	if failed:
+		print(f"failed on {', '.join(failed)}")
+		sys.exit(1)
+	print(f"passed on {len(urls)} backend(s)")
+
+if __name__ == "__main__":
+	main()
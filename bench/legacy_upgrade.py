@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from hashlib import sha256
+
+#LEGACY UPGRADE, a database shaped like the release before migrations, upgraded to the current schema and then audited
+#the tables are what that release's create_all built, it only ever ran on sqlite
+#a round it paid out has no ledger entry, the audit has to say it can't check that payout rather than flag it
+#run from the repo root: python -m bench.legacy_upgrade
+
+SCRATCH_DIR = os.path.join("data", "bench_legacy")
+NORMALIZER = 1000 * 1000 * 1000 * 1000
+DAY = 24 * 60 * 60
+
+LEGACY_SCHEMA = [
+	"""CREATE TABLE players (id VARCHAR NOT NULL PRIMARY KEY, display VARCHAR, public_fingerprint VARCHAR, xmr_address VARCHAR,
+		xmr_address_index INTEGER, balance INTEGER, time_active INTEGER, time_created INTEGER)""",
+	"CREATE UNIQUE INDEX ix_players_display ON players (display)",
+	"CREATE UNIQUE INDEX ix_players_public_fingerprint ON players (public_fingerprint)",
+	"CREATE UNIQUE INDEX ix_players_xmr_address ON players (xmr_address)",
+	"CREATE UNIQUE INDEX ix_players_xmr_address_index ON players (xmr_address_index)",
+	"""CREATE TABLE games (id VARCHAR NOT NULL PRIMARY KEY, state VARCHAR, active BOOLEAN, num INTEGER, secret VARCHAR, spot_secret VARCHAR,
+		last_game_id VARCHAR REFERENCES games (id), prize INTEGER, spot_count INTEGER, spot_cost INTEGER, time_created INTEGER)""",
+	"""CREATE TABLE spots (id VARCHAR NOT NULL PRIMARY KEY, cost INTEGER, spot_num INTEGER, secret VARCHAR, secret_time INTEGER,
+		game_id VARCHAR REFERENCES games (id), player_id VARCHAR REFERENCES players (id), time_created INTEGER)""",
+	"""CREATE TABLE login_codes (id VARCHAR NOT NULL PRIMARY KEY, public_fingerprint VARCHAR, code VARCHAR,
+		player_id VARCHAR REFERENCES players (id), time_created INTEGER)""",
+	"CREATE INDEX ix_login_codes_public_fingerprint ON login_codes (public_fingerprint)",
+	"CREATE INDEX ix_login_codes_code ON login_codes (code)",
+	"""CREATE TABLE transactions (id VARCHAR NOT NULL PRIMARY KEY, address_index INTEGER REFERENCES players (xmr_address_index), amount INTEGER,
+		tx_hash VARCHAR, unlocked BOOLEAN, block_height INTEGER, credited BOOLEAN, time_created INTEGER)""",
+	"CREATE UNIQUE INDEX ix_transactions_tx_hash ON transactions (tx_hash)",
+	"""CREATE TABLE withdraw_requests (id VARCHAR NOT NULL PRIMARY KEY, address_index INTEGER REFERENCES players (xmr_address_index), amount INTEGER,
+		fee INTEGER, tx_hash VARCHAR, success BOOLEAN, refunded BOOLEAN, status VARCHAR, time_created INTEGER)""",
+]
+
+def check(name, ok, detail=""):
+	if not ok:
+		raise AssertionError(f"{name} failed {detail}".strip())
+	print(f"  ok {name}")
+
+def make_round(game_id, num, spot_count, player_ids, time_created, last_game_id=None):
+	#a finished round built the way Game.end and generate_spot_secret build them, so everything but the payout checks out
+	secret = sha256(game_id.encode()).hexdigest()
+	chunk_size = 64 // spot_count
+	spots = []
+	for spot_num, player_id in enumerate(player_ids, start=1):
+		secret_time = (int(secret, 16) + time_created) % 100000
+		spots.append({"id":f"{game_id}-{spot_num}","cost":1,"spot_num":spot_num,"secret":sha256(str(secret_time).encode()).hexdigest()[:chunk_size],
+			"secret_time":secret_time,"game_id":game_id,"player_id":player_id,"time_created":time_created})
+	spot_secret = "".join(spot["secret"] for spot in spots)
+	winner = (int(secret, 16) + int(spot_secret, 16)) % spot_count + 1
+	game = {"id":game_id,"state":f"4:{winner}","active":False,"num":num,"secret":secret,"spot_secret":spot_secret,"last_game_id":last_game_id,
+		"prize":1,"spot_count":spot_count,"spot_cost":1,"time_created":time_created}
+	return game, spots
+
+def run_checks():
+	#imported here so database.py binds to the DATABASE_URL this child was started with
+	from sqlalchemy import text
+	from database import engine, ReadSessionLocal, run_write_sync
+	from fairness import FairnessVerifier
+	import migrations
+	import models
+
+	now = int(time.time())
+	players = [{"id":f"legacy{i}","display":f"legacy{i}","public_fingerprint":f"legacy-fingerprint-{i}","xmr_address":f"legacy-address-{i}",
+		"xmr_address_index":i + 1,"balance":(i + 1) * NORMALIZER,"time_active":now - DAY,"time_created":now - 2 * DAY} for i in range(2)]
+	player_ids = [player["id"] for player in players]
+	legacy_game, legacy_spots = make_round("legacy-round", 1, 2, player_ids, now - DAY)
+	with engine.begin() as connection:
+		for statement in LEGACY_SCHEMA:
+			connection.execute(text(statement))
+		for table, rows in (("players", players), ("games", [legacy_game]), ("spots", legacy_spots)):
+			columns = list(rows[0])
+			connection.execute(text(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(':' + column for column in columns)})"), rows)
+
+	check("migrations", migrations.upgrade(engine) == migrations.MIGRATIONS[-1][0])
+	check("opening balances", not run_write_sync(models.LedgerEntry.reconcile))
+
+	with open(os.environ.get("CONFIG_FILE", "config.json"), "r") as file:
+		config = json.load(file)
+	config["FAIRNESS_WORKERS"] = 1
+	verifier = FairnessVerifier(config)
+	db = ReadSessionLocal()
+	try:
+		report = verifier.verify(db)
+		check("legacy round not flagged", report["rounds"] == 1 and report["fair"] and report["unchecked_payouts"] == 1, str(report))
+
+		#a round finished after the upgrade with no payout entry is still a failure
+		def add_unpaid_round(db):
+			ledger_start = db.query(models.SchemaVersion.time_applied).order_by(models.SchemaVersion.version.asc()).limit(1).scalar()
+			game, spots = make_round("unpaid-round", 1, 2, player_ids, ledger_start, "legacy-round")
+			db.execute(models.Game.__table__.insert(), [game])
+			db.execute(models.Spot.__table__.insert(), spots)
+			db.commit()
+		run_write_sync(add_unpaid_round)
+		db.expire_all()
+		report = verifier.verify(db)
+		flagged = {game["id"]: game["problems"] for game in report["flagged"]}
+		check("unpaid round flagged", report["rounds"] == 2 and report["unchecked_payouts"] == 1 and flagged == {"unpaid-round":["0 payouts recorded"]}, str(report))
+	finally:
+		db.close()
+		verifier.close()
+
+def main():
+	if "--child" in sys.argv:
+		run_checks()
+		return
+	shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+	os.makedirs(SCRATCH_DIR)
+	result = subprocess.run([sys.executable, "-m", "bench.legacy_upgrade", "--child"], env=dict(os.environ, DATABASE_URL=f"sqlite:///{SCRATCH_DIR}/data.db"))
+	shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+	if result.returncode:
+		print("failed")
+		sys.exit(1)
+	print("passed")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,384 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import secrets
+import shutil
+import subprocess
+import sys
+import time
+import httpx
+import jwt
+
+#LOAD TEST, boots the arcade on a scratch database against fake_wallet_rpc.py and points simulated logged in players at it
+#players refresh the lobby and boards, buy spots, deposit and withdraw, per action latency and throughput are reported with the game tick lag
+#run from the repo root: python -m bench.load_test --players 2000 --duration 60
+#--save-baseline stores the run under --name in bench/baselines.json, later runs print their difference against the baseline
+#run with the same parameters, or the one named with --name, and exit 1 on a regression
+#baselines are only comparable on the machine that recorded them, resave them after moving hosts
+#the server and the simulated players are pinned to separate cpus when there's more than one, otherwise the client's own work lands in the server's percentiles
+#a baseline records which cpus each side had and the tolerance it's compared with, wider when they shared a cpu
+
+NORMALIZER = 1000 * 1000 * 1000 * 1000
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), "baselines.json")
+#relative weights, a player mostly watches
+ACTIONS = {"lobby":40, "board":30, "buy_spot":20, "history":4, "deposit":3, "withdraw":3}
+#actions with fewer samples than this aren't compared to the baseline, their percentiles are noise
+MIN_SAMPLES = 50
+#a baseline only means something for the same load
+PARAMS = ["players", "duration", "think_time", "tables", "workers", "wallet_latency"]
+#allowed fraction worse than a baseline, a shared cpu makes the tail latencies swing run to run
+TOLERANCE = 0.2
+SHARED_CPU_TOLERANCE = 1.0
+GAME_ID_RE = re.compile(r'data-game-id="([^"]+)"')
+FREE_SPOT_RE = re.compile(r'value="(\d+)" name="spot"')
+ADDRESS_RE = re.compile(r"<xmr-address>([^<]+)</xmr-address>")
+
+def get_scratch_config(args, scratch_dir):
+	#the real config with everything that touches disk, the network or the wallet moved to the scratch dir and the fake wallet
+	with open("config.json", "r") as file:
+		config = json.load(file)
+	config.update({
+		"PORT": args.port,
+		"LIVE_RELOAD": False,
+		"DATABASE_URL": f"sqlite:///{scratch_dir}/data.db",
+		"WALLET_RPC_ADDRESS": f"127.0.0.1:{args.wallet_port}",
+		"XMR_RATE_SOURCES": ["stub"],
+		"XMR_RATE_CACHE_FILE": f"{scratch_dir}/xmr_rate.json",
+		"ARCHIVE_DIR": f"{scratch_dir}/archive",
+		"CLUSTER_ENABLED": args.workers > 1,
+		"CLUSTER_BUS_SOCKET": f"{scratch_dir}/engine.sock",
+		"WEB_WORKERS": args.workers,
+		"DEPOSIT_SWEEP_TIME": 2,
+		"WITHDRAW_BATCH_WINDOW": 5,
+		"HOTWALLET_STAUTS_LEEWAY": 10,
+	})
+	for game_config in config["GAME_CONFIGS"]:
+		game_config["instances"] = args.tables
+	return config
+
+def seed_players(count):
+	#straight into the scratch database before the app starts, pgp logins aren't what's being measured
+	#imported here so database.py picks up CONFIG_FILE
+	from database import engine
+	import migrations
+	import models
+	migrations.upgrade(engine)
+	now = models.get_current_time()
+	players = [{"id":f"bench-{i}","display":f"bench{i}","public_fingerprint":f"bench-fingerprint-{i}","balance":NORMALIZER,"time_active":now,"time_created":now}
+		for i in range(count)]
+	with engine.begin() as connection:
+		connection.execute(models.Player.__table__.insert(), players)
+		connection.execute(models.LedgerEntry.__table__.insert(), [{"player_id":player["id"],"amount":player["balance"],"kind":"bench","time_created":now} for player in players])
+	engine.dispose()
+	return [player["id"] for player in players]
+
+def parse_cpus(value):
+	#"0-3,6" to {0, 1, 2, 3, 6}
+	cpus = set()
+	for part in value.split(","):
+		first, _, last = part.partition("-")
+		cpus.update(range(int(first), int(last or first) + 1))
+	return cpus
+
+def split_cpus(args):
+	#server and client cpus, a side that isn't given gets the rest, or the last quarter for the client when neither is
+	available = sorted(os.sched_getaffinity(0))
+	server_cpus = parse_cpus(args.server_cpus) if args.server_cpus else None
+	client_cpus = parse_cpus(args.client_cpus) if args.client_cpus else None
+	if server_cpus is None and client_cpus is None and len(available) > 1:
+		client_count = max(len(available) // 4, 1)
+		server_cpus, client_cpus = set(available[:-client_count]), set(available[-client_count:])
+	if server_cpus is None:
+		server_cpus = set(available) - (client_cpus or set())
+	if client_cpus is None:
+		client_cpus = set(available) - server_cpus
+	return server_cpus or set(available), client_cpus or set(available)
+
+def get_percentile(values, percentile):
+	values = sorted(values)
+	return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+class LoadTest:
+	def __init__(self, args, config, player_ids, jwt_secret):
+		self.args = args
+		self.nums = list(range(1, len(config["GAME_CONFIGS"]) * args.tables + 1))
+		self.tokens = {player_id: jwt.encode({"player_id":player_id}, jwt_secret, algorithm="HS256") for player_id in player_ids}
+		self.latencies = {action: [] for action in ACTIONS}
+		self.errors = {action: 0 for action in ACTIONS}
+		self.tick_lags = []
+		self.client = None
+		self.wallet = None
+
+	async def wallet_call(self, method, params):
+		response = await self.wallet.post("/json_rpc", json={"jsonrpc":"2.0","id":"0","method":method,"params":params})
+		return response.json().get("result")
+
+	async def timed(self, action, fn):
+		start = time.perf_counter()
+		try:
+			ok = await fn()
+		except httpx.HTTPError:
+			ok = False
+		if ok:
+			self.latencies[action].append(time.perf_counter() - start)
+		else:
+			self.errors[action] += 1
+
+	async def get(self, path, token):
+		response = await self.client.get(path, headers={"Cookie":f"auth={token}"})
+		return response
+
+	async def lobby(self, token):
+		return (await self.get("/arcade/iframe", token)).status_code == 200
+
+	async def board(self, token):
+		return (await self.get(f"/arcade/game/{random.choice(self.nums)}", token)).status_code == 200
+
+	async def buy_spot(self, token):
+		#the board a player is looking at, then a spot that was free on it, losing the race to another player still counts as a request
+		num = random.choice(self.nums)
+		response = await self.get(f"/arcade/game/{num}", token)
+		game_id = GAME_ID_RE.search(response.text)
+		if response.status_code != 200 or not game_id:
+			return False
+		free = FREE_SPOT_RE.findall(response.text)
+		if not free:
+			return True
+		response = await self.client.post(f"/arcade/game/{game_id.group(1)}/spot", data={"spot":random.choice(free)}, headers={"Cookie":f"auth={token}"})
+		return response.status_code == 302
+
+	async def history(self, token):
+		return (await self.get("/player/history?limit=20", token)).status_code == 200
+
+	async def deposit(self, token):
+		#the page makes the subaddress on first visit, the fake wallet then sees a payment to it
+		response = await self.get("/deposit", token)
+		address = ADDRESS_RE.search(response.text)
+		if response.status_code != 200 or not address:
+			return False
+		await self.wallet_call("fake_receive", {"address":address.group(1),"amount":random.randint(1, 100) * NORMALIZER // 1000})
+		return True
+
+	async def withdraw(self, token):
+		address = "8" + secrets.token_hex(47)
+		response = await self.client.post("/withdraw", data={"address":address,"amount":"0.001"}, headers={"Cookie":f"auth={token}"})
+		return response.status_code == 302
+
+	async def run_player(self, token, end_time):
+		actions = list(ACTIONS)
+		weights = list(ACTIONS.values())
+		while time.monotonic() < end_time:
+			action = random.choices(actions, weights)[0]
+			await self.timed(action, lambda: getattr(self, action)(token))
+			await asyncio.sleep(min(random.expovariate(1 / self.args.think_time), max(end_time - time.monotonic(), 0)))
+
+	async def mine(self, end_time):
+		#a block a second so deposits unlock and get credited during the run
+		while time.monotonic() < end_time:
+			await self.wallet_call("fake_mine", {"blocks":1})
+			await asyncio.sleep(1)
+
+	async def sample_tick_lag(self, end_time):
+		while time.monotonic() < end_time:
+			await asyncio.sleep(1)
+			try:
+				stats = (await self.client.get("/scheduler/stats")).json()
+			except httpx.HTTPError:
+				continue
+			if "game" in stats:
+				self.tick_lags.append(stats["game"]["last_lag"])
+
+	async def run(self):
+		limits = httpx.Limits(max_connections=self.args.connections, max_keepalive_connections=self.args.connections)
+		async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{self.args.port}", limits=limits, timeout=30) as self.client, \
+			httpx.AsyncClient(base_url=f"http://127.0.0.1:{self.args.wallet_port}", timeout=30) as self.wallet:
+			#enough unlocked in the hot wallet to pay every withdraw the run queues
+			await self.wallet_call("fake_receive", {"address_index":0,"amount":len(self.tokens) * NORMALIZER})
+			await self.wallet_call("fake_mine", {"blocks":20})
+			start = time.monotonic()
+			end_time = start + self.args.duration
+			tasks = [asyncio.create_task(self.run_player(token, end_time)) for token in self.tokens.values()]
+			tasks += [asyncio.create_task(self.mine(end_time)), asyncio.create_task(self.sample_tick_lag(end_time))]
+			await asyncio.gather(*tasks)
+			elapsed = time.monotonic() - start
+			stats = (await self.client.get("/scheduler/stats")).json()
+		return self.get_report(elapsed, stats)
+
+	def get_report(self, elapsed, stats):
+		actions = {}
+		for action, latencies in self.latencies.items():
+			if not latencies:
+				actions[action] = {"count":0,"errors":self.errors[action]}
+				continue
+			actions[action] = {"count":len(latencies),"errors":self.errors[action],"rps":round(len(latencies) / elapsed, 2),
+				"p50_ms":round(get_percentile(latencies, 50) * 1000, 2),"p99_ms":round(get_percentile(latencies, 99) * 1000, 2)}
+		total = sum(len(latencies) for latencies in self.latencies.values())
+		game = stats.get("game", {})
+		tick = {"runs":game.get("runs", 0),"skipped":game.get("skipped", 0),"average_duration_ms":round(game.get("average_duration", 0) * 1000, 2),
+			"p99_lag_ms":round(get_percentile(self.tick_lags, 99) * 1000, 2) if self.tick_lags else 0,"max_lag_ms":round(game.get("max_lag", 0) * 1000, 2)}
+		server_cpus, client_cpus = sorted(self.args.cpus[0]), sorted(self.args.cpus[1])
+		host = {"cpus":os.cpu_count(),"python":platform.python_version(),"machine":platform.machine(),"server_cpus":server_cpus,"client_cpus":client_cpus,
+			"shared_cpu":bool(set(server_cpus) & set(client_cpus))}
+		return {"params":{param: getattr(self.args, param) for param in PARAMS},"host":host,"elapsed":round(elapsed, 1),"rps":round(total / elapsed, 2),"actions":actions,"tick":tick}
+
+def print_report(report):
+	print(f"{report['params']['players']} players for {report['elapsed']}s, {report['rps']} requests/s")
+	print(f"{'action':<12}{'count':>8}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}")
+	for action, result in report["actions"].items():
+		print(f"{action:<12}{result['count']:>8}{result['errors']:>8}{result.get('rps', 0):>10}{result.get('p50_ms', 0):>10}{result.get('p99_ms', 0):>10}")
+	tick = report["tick"]
+	print(f"game tick: {tick['runs']} runs, {tick['skipped']} skipped, {tick['average_duration_ms']} ms average, lag p99 {tick['p99_lag_ms']} ms max {tick['max_lag_ms']} ms")
+
+def get_change(value, base):
+	if not base:
+		return ""
+	return f"{(value - base) / base * 100:+.0f}%"
+
+def print_diff(name, report, baseline):
+	print(f"against baseline {name}, {baseline['params']['players']} players for {baseline['elapsed']}s, {baseline['rps']} requests/s ({get_change(report['rps'], baseline['rps'])})")
+	if baseline.get("host") != report["host"]:
+		print(f"baseline was recorded on {baseline.get('host')}, this run is on {report['host']}")
+	if report["host"]["shared_cpu"]:
+		print("server and players shared a cpu, latencies include the players' own work")
+	print(f"{'action':<12}{'rps':>10}{'base':>10}{'change':>8}{'p50 ms':>10}{'base':>10}{'change':>8}{'p99 ms':>10}{'base':>10}{'change':>8}")
+	for action, result in report["actions"].items():
+		base = baseline["actions"].get(action, {})
+		row = f"{action:<12}"
+		for key in ("rps", "p50_ms", "p99_ms"):
+			value, base_value = result.get(key, 0), base.get(key, 0)
+			row += f"{value:>10}{base_value:>10}{get_change(value, base_value):>8}"
+		print(row)
+	tick, base_tick = report["tick"], baseline["tick"]
+	print(f"game tick: {tick['skipped']} skipped, baseline {base_tick['skipped']}, {tick['average_duration_ms']} ms average, baseline {base_tick['average_duration_ms']} ms, "
+		f"lag p99 {tick['p99_lag_ms']} ms, baseline {base_tick['p99_lag_ms']} ms")
+
+def find_baseline(baselines, name, params):
+	#the named baseline, or else the one recorded with the same parameters
+	if name:
+		return name, baselines.get(name)
+	for name, baseline in baselines.items():
+		if baseline["params"] == params:
+			return name, baseline
+	return None, None
+
+def compare(report, baseline, tolerance):
+	#slower p99, lower throughput or more skipped ticks than the baseline allows
+	regressions = []
+	for action, result in report["actions"].items():
+		base = baseline["actions"].get(action)
+		if not base or base["count"] < MIN_SAMPLES or result["count"] < MIN_SAMPLES:
+			continue
+		if result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+			regressions.append(f"{action} p99 {result['p99_ms']} ms, baseline {base['p99_ms']} ms")
+		if result["rps"] < base["rps"] * (1 - tolerance):
+			regressions.append(f"{action} {result['rps']} requests/s, baseline {base['rps']}")
+	if report["tick"]["skipped"] > baseline["tick"]["skipped"]:
+		regressions.append(f"game tick skipped {report['tick']['skipped']}, baseline {baseline['tick']['skipped']}")
+	return regressions
+
+def wait_until_up(url, process, timeout):
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		if process.poll() is not None:
+			raise RuntimeError(f"{url} exited with {process.returncode}")
+		try:
+			if httpx.get(url, timeout=1).status_code < 500:
+				return
+		except httpx.HTTPError:
+			pass
+		time.sleep(0.2)
+	raise RuntimeError(f"{url} didn't come up in {timeout}s")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--players", type=int, default=1000, help="simulated logged in players")
+	parser.add_argument("--duration", type=float, default=60, help="seconds of load")
+	parser.add_argument("--think-time", type=float, default=2, help="mean seconds a player waits between actions")
+	parser.add_argument("--connections", type=int, default=200, help="client connection pool size")
+	parser.add_argument("--tables", type=int, default=4, help="instances of every game config")
+	parser.add_argument("--workers", type=int, default=1, help="web worker processes, more than one runs the cluster")
+	parser.add_argument("--port", type=int, default=18080)
+	parser.add_argument("--wallet-port", type=int, default=18083)
+	parser.add_argument("--wallet-latency", type=float, default=0, help="seconds the fake wallet waits per call")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--scratch-dir", default="data/bench_load", help="replaced on every run")
+	parser.add_argument("--name", help="baseline to save, default \"default\", or to compare against, default the one with the same parameters")
+	parser.add_argument("--save-baseline", action="store_true")
+	parser.add_argument("--tolerance", type=float, help=f"allowed fraction worse than the baseline, default the one saved with it, {TOLERANCE} or {SHARED_CPU_TOLERANCE} on a shared cpu")
+	parser.add_argument("--server-cpus", help="cpus for the app and fake wallet, like 0-2, default all but a quarter")
+	parser.add_argument("--client-cpus", help="cpus for the simulated players, default the last quarter")
+	args = parser.parse_args()
+	random.seed(args.seed)
+	args.cpus = split_cpus(args)
+	server_cpus, client_cpus = args.cpus
+	os.sched_setaffinity(0, client_cpus)
+	#main.py serves static/ from the working directory, it isn't checked in
+	os.makedirs("static", exist_ok=True)
+
+	shutil.rmtree(args.scratch_dir, ignore_errors=True)
+	os.makedirs(args.scratch_dir)
+	config = get_scratch_config(args, args.scratch_dir)
+	config_file = os.path.join(args.scratch_dir, "config.json")
+	with open(config_file, "w") as file:
+		json.dump(config, file, indent=1)
+	#a DATABASE_URL in the environment would win over the scratch config and load test the real database
+	os.environ.pop("DATABASE_URL", None)
+	os.environ["CONFIG_FILE"] = config_file
+	with open("secrets.json", "r") as file:
+		jwt_secret = json.load(file)["JWT_SECRET"]
+
+	player_ids = seed_players(args.players)
+	log = open(os.path.join(args.scratch_dir, "server.log"), "w")
+	#pinned before exec so uvicorn's workers and the engine inherit it
+	pin_server = lambda: os.sched_setaffinity(0, server_cpus)
+	wallet_process = subprocess.Popen([sys.executable, "fake_wallet_rpc.py", "--port", str(args.wallet_port), "--latency", str(args.wallet_latency)], stdout=log, stderr=log,
+		preexec_fn=pin_server)
+	app_process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port), "--workers", str(args.workers),
+		"--log-level", "warning"], stdout=log, stderr=log, env=os.environ, preexec_fn=pin_server)
+	try:
+		wait_until_up(f"http://127.0.0.1:{args.wallet_port}/json_rpc", wallet_process, 30)
+		wait_until_up(f"http://127.0.0.1:{args.port}/scheduler/stats", app_process, 60)
+		report = asyncio.run(LoadTest(args, config, player_ids, jwt_secret).run())
+	finally:
+		app_process.terminate()
+		wallet_process.terminate()
+		app_process.wait()
+		wallet_process.wait()
+		log.close()
+	print_report(report)
+
+	baselines = {}
+	if os.path.exists(BASELINES_FILE):
+		with open(BASELINES_FILE, "r") as file:
+			baselines = json.load(file)
+	if args.save_baseline:
+		name = args.name or "default"
+		if args.tolerance is not None:
+			report["tolerance"] = args.tolerance
+		else:
+			report["tolerance"] = SHARED_CPU_TOLERANCE if report["host"]["shared_cpu"] else TOLERANCE
+		baselines[name] = report
+		with open(BASELINES_FILE, "w") as file:
+			json.dump(baselines, file, indent=1)
+			file.write("\n")
+		print(f"saved baseline {name}")
+		sys.exit()
+	name, baseline = find_baseline(baselines, args.name, report["params"])
+	if baseline is None:
+		print(f"no baseline {args.name or 'with these parameters'} to compare against, record one with --save-baseline")
+		sys.exit()
+	if baseline["params"] != report["params"]:
+		sys.exit(f"baseline {name} was run with {baseline['params']}, rerun with those or save a new baseline")
+	print_diff(name, report, baseline)
+	tolerance = args.tolerance if args.tolerance is not None else baseline.get("tolerance", TOLERANCE)
+	print(f"tolerance {tolerance:.0%}")
+	regressions = compare(report, baseline, tolerance)
+	for regression in regressions:
+		print(f"REGRESSION {regression}")
+	if regressions:
+		sys.exit(1)
+	print(f"no regressions against baseline {name}")
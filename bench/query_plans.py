@@ -0,0 +1,170 @@
+import argparse
+import os
+import random
+import statistics
+import time
+from hashlib import sha256
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+import models
+
+#QUERY PLAN BENCHMARK, fills a scratch sqlite database then times the hot accessors in models.py
+#once on the schema from before the index pass and once on the current one, printing sqlite's plan for every statement they run
+#run from the repo root: python -m bench.query_plans --rows 1000000
+
+#indexes the pass added, and the single column ones it replaced
+NEW_INDEXES = ["uq_games_active_num", "uq_spots_game_spot", "ix_spots_player_id", "ix_login_codes_fingerprint_code", "ix_login_codes_expires",
+	"ix_withdraw_requests_status_created", "ix_withdraw_requests_status_lease", "ix_ledger_entries_player_amount"]
+OLD_INDEXES = {"ix_login_codes_public_fingerprint":"login_codes (public_fingerprint)", "ix_login_codes_code":"login_codes (code)",
+	"ix_ledger_entries_player_id":"ledger_entries (player_id)"}
+BATCH = 20000
+MAX_PLAN_LINES = 6
+
+def get_hash(i):
+	return sha256(str(i).encode()).hexdigest()
+
+def insert_batched(connection, table, rows):
+	batch = []
+	for row in rows:
+		batch.append(row)
+		if len(batch) == BATCH:
+			connection.execute(table.insert(), batch)
+			batch = []
+	if batch:
+		connection.execute(table.insert(), batch)
+
+def fill(db_engine, rows):
+	#rows spots and ledger entries, a tenth as many of everything else, only the last six rounds are live
+	random.seed(1)
+	players = max(rows // 100, 10)
+	games = rows // 4
+	now = models.get_current_time()
+	balances = [0] * players
+	with db_engine.begin() as connection:
+		models.Base.metadata.create_all(connection)
+		models.GameConfig.seed(connection, [{"prize":"1","spot_count":4,"spot_cost":"0.26"}])
+		insert_batched(connection, models.Game.__table__, ({"id":f"g{i}","num":(i % 6) + 1,"active":i >= games - 6,"state":"waiting" if i >= games - 3 else f"4:{i % 4 + 1}",
+			"secret":get_hash(i),"spot_secret":"","config_id":1,"prize":1,"spot_count":4,"spot_cost":0.26,"time_created":now} for i in range(games)))
+		insert_batched(connection, models.Spot.__table__, ({"id":f"s{i}","game_id":f"g{i // 4}","spot_num":i % 4 + 1,"player_id":f"p{i % players}",
+			"cost":0.26,"secret":"","secret_time":0,"time_created":now} for i in range(games * 4)))
+		def ledger():
+			for i in range(rows):
+				amount = random.randint(-1000, 1000)
+				balances[i % players] += amount
+				yield {"id":i + 1,"player_id":f"p{i % players}","amount":amount,"kind":"spot","time_created":now}
+		insert_batched(connection, models.LedgerEntry.__table__, ledger())
+		insert_batched(connection, models.Player.__table__, ({"id":f"p{i}","display":f"player{i}","public_fingerprint":get_hash(-i - 1),"balance":balances[i],
+			"time_active":now,"time_created":now} for i in range(players)))
+		insert_batched(connection, models.LoginCode.__table__, ({"id":f"l{i}","public_fingerprint":get_hash(-(i % players) - 1),"code":f"{i:08d}",
+			"time_created":now,"expires":now + random.randint(-86400, 86400)} for i in range(rows // 10)))
+		insert_batched(connection, models.Transaction.__table__, ({"id":f"t{i}","tx_hash":get_hash(f"t{i}"),"amount":1000,"block_height":i,"unlocked":True,
+			"credited":i % 100 != 0,"time_created":now} for i in range(rows // 10)))
+		insert_batched(connection, models.WithdrawRequest.__table__, ({"id":f"w{i}","player_id":f"p{i % players}","amount":1000,"status":"sent" if i % 1000 else "queued",
+			"lease_expires":now - 1 if i % 1000 == 1 else None,"time_created":now - i} for i in range(rows // 10)))
+
+def use_schema(db_engine, current):
+	with db_engine.begin() as connection:
+		if current:
+			for name in OLD_INDEXES:
+				connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+			for table in models.Base.metadata.sorted_tables:
+				for index in table.indexes:
+					index.create(connection, checkfirst=True)
+		else:
+			for name in NEW_INDEXES:
+				connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+			for name, target in OLD_INDEXES.items():
+				connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+		connection.exec_driver_sql("ANALYZE")
+
+def get_by_tx_hashes_or(db, tx_hashes):
+	#the chained OR the IN rewrite replaced
+	return db.query(models.Transaction).filter(models.or_(*[models.Transaction.tx_hash == tx_hash for tx_hash in tx_hashes])).all()
+
+def get_cases(rows):
+	games = rows // 4
+	players = max(rows // 100, 10)
+	tx_hashes = [get_hash(f"t{i}") for i in range(0, rows // 10, max(rows // 2000, 1))][:200]
+	return [
+		("Game.get_by_num", lambda db: models.Game.get_by_num(db, 3)),
+		("Game.get_current_games", lambda db: models.Game.get_current_games(db)),
+		("Game.get_active_games", lambda db: models.Game.get_active_games(db)),
+		("Game.game_spot_exists", lambda db: models.Game.game_spot_exists(db, f"g{games // 2}", 2)),
+		("Game.spots", lambda db: models.Game.get(db, f"g{games // 2}").spots),
+		("LoginCode.get", lambda db: models.LoginCode.get(db, get_hash(-(rows // 20 % players) - 1), f"{rows // 20:08d}")),
+		("LoginCode.delete_expired", lambda db: models.LoginCode.delete_expired(db)),
+		("Transaction.get_by_tx_hashes OR", lambda db: get_by_tx_hashes_or(db, tx_hashes)),
+		("Transaction.get_by_tx_hashes IN", lambda db: models.Transaction.get_by_tx_hashes(db, tx_hashes)),
+		("WithdrawRequest.get_expired_leases", lambda db: models.WithdrawRequest.get_expired_leases(db, "queued")),
+		("LedgerEntry.reconcile", lambda db: models.LedgerEntry.reconcile(db)),
+	]
+
+def run(db_engine, cases, repeat):
+	#every case runs in a transaction that is rolled back, so deletes and commits don't change the next run
+	statements = []
+	def capture(connection, cursor, statement, parameters, context, executemany):
+		statements.append((statement, parameters))
+	results = {}
+	for name, fn in cases:
+		timings = []
+		for i in range(repeat):
+			connection = db_engine.connect()
+			transaction = connection.begin()
+			db = sessionmaker(bind=connection, join_transaction_mode="create_savepoint")()
+			if i == 0:
+				event.listen(db_engine, "before_cursor_execute", capture)
+			start = time.perf_counter()
+			fn(db)
+			timings.append(time.perf_counter() - start)
+			if i == 0:
+				event.remove(db_engine, "before_cursor_execute", capture)
+			db.close()
+			transaction.rollback()
+			connection.close()
+		plans = []
+		with db_engine.connect() as connection:
+			for statement, parameters in statements:
+				if not statement.lstrip().upper().startswith(("SELECT", "DELETE", "UPDATE")):
+					continue
+				for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters):
+					plans.append(row[-1])
+		statements.clear()
+		results[name] = (statistics.median(timings) * 1000, plans)
+	return results
+
+def print_results(title, results):
+	print(f"== {title}")
+	for name, (ms, plans) in results.items():
+		print(f"{name:<40}{ms:>10.3f} ms")
+		plans = list(dict.fromkeys(plans))
+		for plan in plans[:MAX_PLAN_LINES]:
+			print(f"    {plan}")
+		if len(plans) > MAX_PLAN_LINES:
+			print(f"    ... {len(plans) - MAX_PLAN_LINES} more")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--rows", type=int, default=1000000, help="spots and ledger entries to generate")
+	parser.add_argument("--repeat", type=int, default=5, help="runs per accessor, the median is reported")
+	parser.add_argument("--database", default="data/bench_query_plans.db", help="scratch sqlite file, replaced on every run")
+	args = parser.parse_args()
+
+	for suffix in ("", "-wal", "-shm"):
+		if os.path.exists(args.database + suffix):
+			os.remove(args.database + suffix)
+	db_engine = create_engine(f"sqlite:///{args.database}")
+	start = time.perf_counter()
+	fill(db_engine, args.rows)
+	print(f"filled {args.rows} rows in {time.perf_counter() - start:.1f}s")
+
+	cases = get_cases(args.rows)
+	use_schema(db_engine, current=False)
+	before = run(db_engine, cases, args.repeat)
+	print_results("before the index pass", before)
+	use_schema(db_engine, current=True)
+	after = run(db_engine, cases, args.repeat)
+	print_results("after the index pass", after)
+
+	print("== speedup")
+	for name in after:
+		print(f"{name:<40}{before[name][0] / max(after[name][0], 0.001):>10.1f}x")
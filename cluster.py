@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import socket
+import models
+from database import run_write
+
+#MULTI PROCESS DEPLOYMENT, every web worker serves pages, one of them also holds the engine lease and runs the background jobs
+#the leader hosts a unix socket bus, game and wallet events fan out to followers and followers send the leader what they changed
+
+LEASE_NAME = "engine"
+MAX_BUFFERED = 1024 * 1024
+
+class MessageBus:
+	def __init__(self, path):
+		self.path = path
+		self.handlers = {}
+		self.server = None
+		self.clients = set()
+		self.leader = None
+		self.connect_task = None
+
+	def on(self, message_type, handler):
+		#handler(data), may be async
+		self.handlers[message_type] = handler
+
+	def encode(self, message_type, data):
+		return (json.dumps({"type":message_type,"data":data}, separators=(',', ':')) + "\n").encode()
+
+	async def dispatch(self, line):
+		try:
+			message = json.loads(line)
+		except ValueError:
+			return
+		handler = self.handlers.get(message.get("type"))
+		if handler is None:
+			return
+		try:
+			result = handler(message.get("data"))
+			if asyncio.iscoroutine(result):
+				await result
+		except Exception as e:
+			print(f"bus handler for {message.get('type')} failed: {e}")
+
+	async def read_lines(self, reader):
+		while True:
+			line = await reader.readline()
+			if not line:
+				return
+			await self.dispatch(line)
+
+	async def serve(self):
+		#a leader that died leaves its socket file behind
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		self.server = await asyncio.start_unix_server(self.handle_client, self.path)
+
+	async def handle_client(self, reader, writer):
+		self.clients.add(writer)
+		try:
+			await self.read_lines(reader)
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			self.clients.discard(writer)
+			writer.close()
+
+	def broadcast(self, message_type, data):
+		#encoded once, a follower too far behind is dropped and reconnects
+		message = self.encode(message_type, data)
+		for writer in list(self.clients):
+			if writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+				self.clients.discard(writer)
+				writer.close()
+				continue
+			writer.write(message)
+
+	def send(self, message_type, data):
+		#follower to leader, dropped if the leader is mid failover, the leader's adopt job picks the round up from the database
+		if self.leader is not None:
+			self.leader.write(self.encode(message_type, data))
+
+	async def connect(self, retry_time):
+		while True:
+			try:
+				reader, self.leader = await asyncio.open_unix_connection(self.path)
+				await self.read_lines(reader)
+			except (OSError, asyncio.IncompleteReadError):
+				pass
+			self.leader = None
+			await asyncio.sleep(retry_time)
+
+	def start_following(self, retry_time):
+		if self.connect_task is None:
+			self.connect_task = asyncio.create_task(self.connect(retry_time))
+
+	async def stop_following(self):
+		if self.connect_task is not None:
+			self.connect_task.cancel()
+			await asyncio.gather(self.connect_task, return_exceptions=True)
+			self.connect_task = None
+		if self.leader is not None:
+			self.leader.close()
+			self.leader = None
+
+	async def stop_serving(self):
+		if self.server is not None:
+			self.server.close()
+			for writer in list(self.clients):
+				writer.close()
+			self.clients = set()
+			await self.server.wait_closed()
+			self.server = None
+
+class Cluster:
+	def __init__(self, config, on_elected, on_demoted):
+		self.ENABLED = config["CLUSTER_ENABLED"]
+		self.LEASE_TIME = config["LEADER_LEASE_TIME"]
+		self.RENEW_TIME = config["LEADER_RENEW_TIME"]
+		self.bus = MessageBus(config["CLUSTER_BUS_SOCKET"])
+		self.owner = f"{socket.gethostname()}:{os.getpid()}"
+		self.on_elected = on_elected
+		self.on_demoted = on_demoted
+		self.is_leader = False
+		self.task = None
+
+	async def start(self):
+		if not self.ENABLED:
+			#single process, always the leader and nobody to talk to
+			self.is_leader = True
+			await self.on_elected()
+			return
+		self.bus.start_following(self.RENEW_TIME)
+		self.task = asyncio.create_task(self.run())
+
+	async def run(self):
+		while True:
+			try:
+				held = await run_write(models.LeaderLease.acquire, LEASE_NAME, self.owner, self.LEASE_TIME)
+			except Exception as e:
+				print(f"leader lease check failed: {e}")
+				held = False
+			if held and not self.is_leader:
+				await self.elect()
+			elif not held and self.is_leader:
+				await self.demote()
+			await asyncio.sleep(self.RENEW_TIME)
+
+	async def elect(self):
+		print(f"{self.owner} elected engine leader")
+		self.is_leader = True
+		await self.bus.stop_following()
+		await self.bus.serve()
+		await self.on_elected()
+
+	async def demote(self):
+		#lease lost, most likely stalled past LEADER_LEASE_TIME, another process may already be ticking
+		print(f"{self.owner} lost engine leadership")
+		self.is_leader = False
+		await self.on_demoted()
+		await self.bus.stop_serving()
+		self.bus.start_following(self.RENEW_TIME)
+
+	def publish(self, message_type, data):
+		if self.is_leader:
+			self.bus.broadcast(message_type, data)
+
+	def send(self, message_type, data):
+		if not self.is_leader:
+			self.bus.send(message_type, data)
+
+	async def stop(self):
+		if self.task is not None:
+			self.task.cancel()
+			await asyncio.gather(self.task, return_exceptions=True)
+			self.task = None
+		if self.is_leader and self.ENABLED:
+			await run_write(models.LeaderLease.release, LEASE_NAME, self.owner)
+		await self.bus.stop_serving()
+		await self.bus.stop_following()
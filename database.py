@@ -1,8 +1,107 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects import sqlite, postgresql
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import os
+import metrics
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./data/data.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+#CONFIG_FILE points a checkout at another config, the load test runs the app against a scratch one
+with open(os.environ.get("CONFIG_FILE", "config.json"), 'r') as file:
+    config = json.load(file)
+
+#env var wins so the same checkout can be pointed at another backend
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", config["DATABASE_URL"])
+DIALECT = make_url(SQLALCHEMY_DATABASE_URL).get_backend_name()
+IS_SQLITE = DIALECT == "sqlite"
+CONNECT_ARGS = {
+    "check_same_thread": False,
+    "timeout": config["SQLITE_BUSY_TIMEOUT"] / 1000,
+    "cached_statements": config["SQLITE_STATEMENT_CACHE_SIZE"],
+}
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT'])}")
+    cursor.execute(f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}")
+    cursor.execute(f"PRAGMA cache_size={int(config['SQLITE_CACHE_SIZE'])}")
+    cursor.close()
+
+def set_query_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+def make_engine(pool_size=None, read_only=False):
+    kwargs = {}
+    if IS_SQLITE:
+        kwargs["connect_args"] = CONNECT_ARGS
+    else:
+        kwargs["pool_pre_ping"] = True
+        if read_only:
+            kwargs["connect_args"] = {"options":"-c default_transaction_read_only=on"}
+    if pool_size:
+        kwargs["pool_size"] = pool_size
+        kwargs["max_overflow"] = 0
+    try:
+        db_engine = create_engine(SQLALCHEMY_DATABASE_URL, **kwargs)
+    except ModuleNotFoundError as e:
+        #the postgres driver is an optional install so sqlite deployments don't need it
+        raise SystemExit(f"{DIALECT} needs its driver, pip install -r requirements-postgres.txt ({e})")
+    if IS_SQLITE:
+        event.listen(db_engine, "connect", set_sqlite_pragmas)
+        if read_only:
+            event.listen(db_engine, "connect", set_query_only)
+    return db_engine
+
+def insert_ignore(model, index_elements):
+    #INSERT that skips rows colliding on index_elements, OR IGNORE on sqlite and ON CONFLICT DO NOTHING elsewhere
+    if DIALECT == "postgresql":
+        return postgresql.insert(model).on_conflict_do_nothing(index_elements=index_elements)
+    return sqlite.insert(model).on_conflict_do_nothing(index_elements=index_elements)
+
+#general purpose read/write sessions, migrations, scripts and the deposit page, request writes go through run_write
+engine = make_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
\ No newline at end of file
+
+#pooled read only connections for page renders, WAL (or MVCC on postgres) lets them run alongside the writer
+read_engine = make_engine(config["DATABASE_READ_POOL_SIZE"], read_only=True)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+#one connection on one thread, game loop and ledger writes queue here instead of fighting over the lock
+writer_engine = make_engine(1)
+WriterSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=writer_engine)
+writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+metrics.instrument_engine(engine, "main")
+metrics.instrument_engine(read_engine, "read")
+metrics.instrument_engine(writer_engine, "writer")
+
+def run_write_sync(fn, *args):
+    db = WriterSessionLocal()
+    try:
+        return fn(db, *args)
+    finally:
+        db.close()
+
+async def run_write(fn, *args):
+    #fn(db, *args) runs on the writer thread with its own session, return plain data not ORM objects
+    return await asyncio.get_running_loop().run_in_executor(writer_executor, run_write_sync, fn, *args)
+
+def run_read_sync(fn, *args):
+    db = ReadSessionLocal()
+    try:
+        return fn(db, *args)
+    finally:
+        db.close()
+
+async def run_read(fn, *args):
+    #background reads take a pooled read only session on a worker thread, so they never queue in front of the writer
+    return await asyncio.to_thread(run_read_sync, fn, *args)
+
+Base = declarative_base()
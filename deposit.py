@@ -1,47 +1,161 @@
 import qrcode
-import qrcode.image.svg
-from xmr_wallet_rpc import XMRWalletRPC
+from xmr_wallet_rpc import xmr_wallet_rpc
 import models
-import time
+from database import run_write, run_read
+from collections import OrderedDict
+from hashlib import sha256
+import asyncio
+import threading
+import metrics
 
+CURSOR_NAME = "deposits"
 
-xmr_wallet_rpc = XMRWalletRPC()
+#QR CODES, made once per address when it's created and kept as the bare module grid, one bit a module
+#rendered to svg on first request and served from an lru with a strong etag, an address's code never changes
+
+def pack_qr(address):
+	qr = qrcode.QRCode(border=0)
+	qr.add_data(f"monero:{address}")
+	qr.make(fit=True)
+	matrix = qr.get_matrix()
+	size = len(matrix)
+	bits = bytearray((size * size + 7) // 8)
+	for i, dark in enumerate(dark for row in matrix for dark in row):
+		if dark:
+			bits[i // 8] |= 0x80 >> (i % 8)
+	return bytes([size]) + bytes(bits)
+
+def render_qr_svg(qr):
+	#one rectangle per run of dark modules in a row
+	size = qr[0]
+	def is_dark(x, y):
+		i = y * size + x
+		return qr[1 + i // 8] & (0x80 >> (i % 8))
+	path = []
+	for y in range(size):
+		x = 0
+		while x < size:
+			if not is_dark(x, y):
+				x += 1
+				continue
+			start = x
+			while x < size and is_dark(x, y):
+				x += 1
+			path.append(f"M{start},{y}h{x - start}v1h-{x - start}z")
+	return f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" shape-rendering="crispEdges"><path d="{"".join(path)}"/></svg>'
 
 class Deposit:
-	def __init__(self):
-		pass
-
-	def get_qr_svg(self, address):
-		qr = qrcode.QRCode(image_factory=qrcode.image.svg.SvgPathImage, box_size=10,border=0)
-		qr.add_data(f"monero:{address}")
-		qr.make(fit=True)
-		img = qr.make_image(attrib={'class': 'qr-image-d'})
-		svg = img.to_string(encoding='unicode')
-		return svg
-
-	def check_deposits(self, db):
-		#NO SWEEP ARCHITECHTURE, high read/write when many transactions are unspent, best used for hotwallet frequently spending incoming outputs.
-		transfers = xmr_wallet_rpc.incoming_transfers([])
-		tx_hashes = []
-		tx_hashes_unlocked = set()
+	def __init__(self, config):
+		self.REORG_DEPTH = config["DEPOSIT_REORG_DEPTH"]
+		self.UNLOCK_CONFIRMATIONS = config["DEPOSIT_UNLOCK_CONFIRMATIONS"]
+		self.POOL_MIN = config["DEPOSIT_POOL_MIN"]
+		self.POOL_BATCH = config["DEPOSIT_POOL_BATCH"]
+		self.QR_CACHE_SIZE = config["DEPOSIT_QR_CACHE_SIZE"]
+		self.qr_cache = OrderedDict()
+		self.qr_lock = threading.Lock()
+
+	async def get_qr(self, db, address):
+		#(svg bytes, etag) for an address handed to a player, None for anything else
+		with self.qr_lock:
+			cached = self.qr_cache.get(address)
+			if cached is not None:
+				self.qr_cache.move_to_end(address)
+				return cached
+		found, qr = models.DepositAddress.get_qr(db, address)
+		if not found:
+			return None
+		if qr is None:
+			#claimed before codes were stored
+			qr = await asyncio.to_thread(pack_qr, address)
+			await run_write(models.DepositAddress.set_qr, address, qr)
+		svg = render_qr_svg(qr).encode()
+		cached = (svg, f'"{sha256(svg).hexdigest()[:32]}"')
+		with self.qr_lock:
+			self.qr_cache[address] = cached
+			if len(self.qr_cache) > self.QR_CACHE_SIZE:
+				self.qr_cache.popitem(last=False)
+		return cached
 
+	def is_unlocked(self, transfer):
+		if "locked" in transfer:
+			return not transfer["locked"]
+		return transfer["confirmations"] >= self.UNLOCK_CONFIRMATIONS and transfer["unlock_time"] == 0
+
+	async def check_deposits(self):
+		#HEIGHT CURSOR ARCHITECHTURE, only blocks above the last fully unlocked height (minus a reorg window) are pulled each sweep
+		cursor = await run_read(models.ScanCursor.get_height, CURSOR_NAME)
+		min_height = max(0, cursor - self.REORG_DEPTH)
+		wallet_height, transfers = await xmr_wallet_rpc.batch([
+			("get_height", None),
+			("get_transfers", {"in":True,"account_index":0,"pending":False,"filter_by_height":True,"min_height":min_height}),
+		])
+		wallet_height = wallet_height["result"]["height"]
+		transfers = transfers["result"].get("in", [])
+		await run_write(self.apply_transfers, cursor, min_height, wallet_height, transfers)
+
+	def apply_transfers(self, db, cursor, min_height, wallet_height, transfers):
+		by_tx_hash = {}
 		for transfer in transfers:
-			if transfer["subaddr_index"]["minor"] == 0:
+			if transfer["subaddr_index"]["minor"] == 0 or transfer.get("double_spend_seen"):
 				continue
-			tx_hashes.append(transfer["tx_hash"])
-			if transfer["unlocked"]:
-				tx_hashes_unlocked.add(transfer["tx_hash"])
+			by_tx_hash[transfer["txid"]] = transfer
+
+		#anything recorded inside the window that the wallet no longer reports was reorged out
+		for db_transaction in models.Transaction.get_since_height(db, min_height):
+			transfer = by_tx_hash.get(db_transaction.tx_hash)
+			if transfer is None:
+				if db_transaction.credited:
+					print(f"credited transaction {db_transaction.tx_hash} missing from wallet, possible reorg")
+				else:
+					db.delete(db_transaction)
+			elif db_transaction.block_height != transfer["height"]:
+				db_transaction.block_height = transfer["height"]
+
+		new_transactions = []
+		tx_hashes_unlocked = []
+		next_cursor = wallet_height - 1
+		for tx_hash, transfer in by_tx_hash.items():
+			unlocked = self.is_unlocked(transfer)
+			new_transactions.append({
+				"address_index":transfer["subaddr_index"]["minor"],
+				"amount":transfer["amount"],
+				"tx_hash":tx_hash,
+				"unlocked":unlocked,
+				"block_height":transfer["height"],
+			})
+			if unlocked:
+				tx_hashes_unlocked.append(tx_hash)
+			else:
+				#cursor can't pass a transfer that still has to be credited
+				next_cursor = min(next_cursor, transfer["height"] - 1)
 
-		#tries to insert all given transfers, next line will deal with all edge cases
-		models.Transaction.bulk_insert(db, transfers)
+		#new transfers, credits and the cursor move together in one transaction
+		models.Transaction.bulk_insert(db, new_transactions, commit=False)
+		if tx_hashes_unlocked:
+			for db_transaction in models.Transaction.get_by_tx_hashes_no_credit(db, tx_hashes_unlocked):
+				db_transaction.credit(db, commit=False)
+		models.ScanCursor.set_height(db, CURSOR_NAME, max(cursor, next_cursor))
+		db.commit()
 
-		#credits all pending transactions in db that are unlocked
-		txes_no_credit = models.Transaction.get_by_tx_hashes_no_credit(db, tx_hashes)
-		for transfer in txes_no_credit:
-			if transfer.tx_hash in tx_hashes_unlocked: #o(1) lookup for sets
-				transfer.credit(db)
+	async def refill_pool(self):
+		#SUBADDRESS POOL, a batch is made once free addresses drop under POOL_MIN so a first deposit page is a local claim
+		free = await run_read(models.DepositAddress.count_free)
+		if free < self.POOL_MIN:
+			addresses = await xmr_wallet_rpc.create_addresses(self.POOL_BATCH)
+			#codes made here, off the request path
+			addresses = await asyncio.to_thread(lambda: [(address_index, address, pack_qr(address)) for address_index, address in addresses])
+			await run_write(models.DepositAddress.add_many, addresses)
+			free += len(addresses)
+		metrics.deposit_pool_free.set(free)
 
-	def create_deposit_if_none(self, db, user):
+	async def create_deposit_if_none(self, db, user):
 		if user.xmr_address is None:
-			address = xmr_wallet_rpc.create_address()
-			user.create_address(db, address)
\ No newline at end of file
+			#ends the transaction so the connection isn't held through the claim, user reloads with the address on next access
+			player_id = user.id
+			db.commit()
+			address = await run_write(models.DepositAddress.claim, player_id)
+			if address is None:
+				#pool ran dry, the wallet makes this one while the next refill catches up
+				address = await xmr_wallet_rpc.create_address()
+				qr = await asyncio.to_thread(pack_qr, address["address"])
+				await run_write(models.DepositAddress.add_claimed, player_id, address, qr)
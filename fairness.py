@@ -0,0 +1,264 @@
+from sqlalchemy import select
+from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import asyncio
+import multiprocessing
+import threading
+import models
+from database import ReadSessionLocal
+from login_codes import Throttle
+import time
+import json
+import os
+
+NORMALIZER = 1000 * 1000 * 1000 * 1000
+SECRET_TIME_MODULUS = 100000
+#seconds between generate_spot_secret and the spot row getting its time_created
+SPOT_TIME_LEEWAY = 5
+
+#AUDIT REPLAY, finished rounds are loaded in batches of plain tuples and checked in worker processes
+#the checks only use what a player can see once a round is over: the revealed secrets, spot secret times and the hash chain
+
+def is_payout_checkable(game):
+	return bool(game["payouts"]) or game["ledger_start"] is None or game["time_created"] >= game["ledger_start"]
+
+def verify_round(game):
+	problems = []
+	spot_count = game["spot_count"]
+	chunk_size = 64 // spot_count
+
+	#outcome, same formula as Game.decide
+	try:
+		decision = (int(game["secret"], 16) + int(game["spot_secret"], 16)) % spot_count + 1
+	except ValueError:
+		return ["secrets are not hex"]
+	recorded = game["state"].split(":")[1]
+	if str(decision) != recorded:
+		problems.append(f"recorded winner {recorded} but secrets decide {decision}")
+
+	#spot secret must be exactly the spots' secrets, purchase order isn't stored so chunks compare as a multiset
+	chunks = [game["spot_secret"][i:i+chunk_size] for i in range(0, len(game["spot_secret"]), chunk_size)]
+	spot_secrets = [spot[1] for spot in game["spots"]]
+	if sorted(chunks) != sorted(spot_secrets):
+		extra = len(chunks) - len(spot_secrets)
+		if extra > 0:
+			problems.append(f"spot secret has {extra} chunk(s) not backed by a spot")
+		else:
+			problems.append("spot secret does not match the spots' secrets")
+	if len(game["spots"]) != spot_count:
+		problems.append(f"{len(game['spots'])} spots taken of {spot_count}")
+
+	#each spot secret is sha256 of its secret time, and the time comes from the game secret and the purchase time
+	secret_base = int(game["secret"], 16) % SECRET_TIME_MODULUS
+	for spot_num, secret, secret_time, player_id, time_created in game["spots"]:
+		if sha256(str(secret_time).encode()).hexdigest()[:chunk_size] != secret:
+			problems.append(f"spot {spot_num} secret is not the hash of its secret time")
+		if not any((secret_base + time_created - lag) % SECRET_TIME_MODULUS == secret_time for lag in range(SPOT_TIME_LEEWAY + 1)):
+			problems.append(f"spot {spot_num} secret time does not follow from the game secret")
+
+	#hash chain, the previous round of the same slot was published before this one
+	if game["last_game_id"]:
+		last_game = game["last_game"]
+		if last_game is None:
+			problems.append("previous round missing")
+		elif last_game[0] != game["num"] or last_game[1] or last_game[2] > game["time_created"]:
+			problems.append("previous round is not the finished round before this one")
+
+	#exactly one payout, to the player holding the winning spot, rounds paid before the ledger existed have nothing to check against
+	winners = [spot[3] for spot in game["spots"] if str(spot[0]) == recorded]
+	prize = game["prize"] * NORMALIZER
+	if is_payout_checkable(game):
+		if len(game["payouts"]) != 1:
+			problems.append(f"{len(game['payouts'])} payouts recorded")
+		elif not winners or game["payouts"][0][0] != winners[0] or abs(game["payouts"][0][1] - prize) >= 1:
+			problems.append("payout does not match the winning spot")
+	return problems
+
+def verify_batch(games):
+	flagged = []
+	for game in games:
+		problems = verify_round(game)
+		if problems:
+			flagged.append({"id":game["id"],"num":game["num"],"problems":problems})
+	unchecked = sum(1 for game in games if not is_payout_checkable(game))
+	return len(games), flagged, unchecked
+
+def get_ledger_start(db):
+	#the ledger table came with the first schema version, on upgraded installs that's when it was stamped
+	return db.execute(select(models.SchemaVersion.time_applied).order_by(models.SchemaVersion.version.asc()).limit(1)).scalar()
+
+def add_payouts_and_chain(db, games, ledger_start):
+	ids = list(games)
+	payouts = db.execute(select(models.LedgerEntry.ref_id, models.LedgerEntry.player_id, models.LedgerEntry.amount)
+		.where(models.LedgerEntry.kind == "payout", models.LedgerEntry.ref_id.in_(ids)))
+	for ref_id, player_id, amount in payouts:
+		games[ref_id]["payouts"].append((player_id, amount))
+	#the previous round may be live or already archived
+	last_ids = list({game["last_game_id"] for game in games.values() if game["last_game_id"]})
+	last_games = db.execute(select(models.Game.id, models.Game.num, models.Game.active, models.Game.time_created).where(models.Game.id.in_(last_ids)))
+	by_id = {row.id: (row.num, row.active, row.time_created) for row in last_games}
+	archived = db.execute(select(models.ArchivedRound.id, models.ArchivedRound.num, models.ArchivedRound.time_created).where(models.ArchivedRound.id.in_(last_ids)))
+	by_id.update({row.id: (row.num, False, row.time_created) for row in archived})
+	for game in games.values():
+		game["last_game"] = by_id.get(game["last_game_id"])
+		game["ledger_start"] = ledger_start
+	return list(games.values())
+
+LIVE_COLUMNS = (models.Game.id, models.Game.num, models.Game.secret, models.Game.spot_secret, models.Game.state, models.Game.spot_count,
+	models.Game.prize, models.Game.last_game_id, models.Game.time_created)
+
+def filter_rounds(query, model, game_id=None, num=None, start=None, end=None):
+	if game_id:
+		query = query.where(model.id == game_id)
+	if num:
+		query = query.where(model.num == num)
+	if start:
+		query = query.where(model.time_created >= start)
+	if end:
+		query = query.where(model.time_created < end)
+	return query
+
+def load_archived(db, archive, rows, ledger_start):
+	#rounds archive.py moved out, found through archived_rounds and read back from their day files
+	by_day = {}
+	for row in rows:
+		by_day.setdefault(row.day, []).append(row.id)
+	loaded = {game["id"]: game for day, ids in by_day.items() for game in archive.load_rounds(day, ids)}
+	games = {row.id: loaded[row.id] for row in rows if row.id in loaded}
+	return add_payouts_and_chain(db, games, ledger_start)
+
+def load_live(db, rows, ledger_start):
+	games = {row.id: dict(row._mapping, spots=[], payouts=[], last_game=None) for row in rows}
+	spots = db.execute(select(models.Spot.game_id, models.Spot.spot_num, models.Spot.secret, models.Spot.secret_time, models.Spot.player_id, models.Spot.time_created)
+		.where(models.Spot.game_id.in_(list(games))))
+	for ref_id, *spot in spots:
+		games[ref_id]["spots"].append(tuple(spot))
+	return add_payouts_and_chain(db, games, ledger_start)
+
+def load_batches(db, batch_size, game_id=None, num=None, start=None, end=None, limit=None, archive=None):
+	#archived rounds are older than every live one, so they come first
+	filters = {"game_id":game_id,"num":num,"start":start,"end":end}
+	ledger_start = get_ledger_start(db)
+	live = filter_rounds(select(*LIVE_COLUMNS).where(models.Game.active == False, models.Game.state.like("4:%")), models.Game, **filters)
+	archived = None
+	if archive is not None:
+		archived = filter_rounds(select(models.ArchivedRound.id, models.ArchivedRound.day), models.ArchivedRound, **filters)
+	if limit:
+		#the newest rounds, found newest first and replayed oldest first so the chain reads in order
+		live_rows = db.execute(live.order_by(models.Game.time_created.desc()).limit(limit)).all()[::-1]
+		archived_rows = []
+		if archived is not None and len(live_rows) < limit:
+			archived_rows = db.execute(archived.order_by(models.ArchivedRound.time_created.desc()).limit(limit - len(live_rows))).all()[::-1]
+		for rows in models.chunked(archived_rows, batch_size):
+			yield load_archived(db, archive, rows, ledger_start)
+		for rows in models.chunked(live_rows, batch_size):
+			yield load_live(db, rows, ledger_start)
+		return
+	if archived is not None:
+		for rows in db.execute(archived.order_by(models.ArchivedRound.time_created.asc()).execution_options(yield_per=batch_size)).partitions():
+			yield load_archived(db, archive, rows, ledger_start)
+	for rows in db.execute(live.order_by(models.Game.time_created.asc()).execution_options(yield_per=batch_size)).partitions():
+		yield load_live(db, rows, ledger_start)
+
+class FairnessVerifier:
+	def __init__(self, config, archive=None):
+		self.archive = archive
+		self.WORKERS = config["FAIRNESS_WORKERS"]
+		self.BATCH_SIZE = config["FAIRNESS_BATCH_SIZE"]
+		self.MAX_ROUNDS = config["FAIRNESS_VERIFY_MAX_ROUNDS"]
+		self.MAX_CONCURRENT = config["FAIRNESS_VERIFY_MAX_CONCURRENT"]
+		#the endpoint is public, each ip gets a few verifications per window and only so many run at once
+		self.ip_throttle = Throttle(config["FAIRNESS_VERIFY_IP_LIMIT"], config["FAIRNESS_VERIFY_THROTTLE_WINDOW"])
+		self.running = 0
+		self.executor = None
+		self.lock = threading.Lock()
+
+	def allow(self, ip):
+		return self.ip_throttle.hit(ip)
+
+	def get_executor(self):
+		#spawned rather than forked, by now the server has the writer, gpg and db threads and forking those can hang a worker
+		#workers import this module fresh and only run verify_batch on plain data
+		with self.lock:
+			if self.executor is None:
+				self.executor = ProcessPoolExecutor(max_workers=self.WORKERS, mp_context=multiprocessing.get_context("spawn"))
+			return self.executor
+
+	def get_report(self, results, started):
+		rounds = sum(result[0] for result in results)
+		flagged = [game for result in results for game in result[1]]
+		#pre ledger rounds, everything but the payout was checked
+		unchecked_payouts = sum(result[2] for result in results)
+		return {"rounds":rounds,"flagged":flagged,"fair":not flagged,"unchecked_payouts":unchecked_payouts,"seconds":round(time.time() - started, 3)}
+
+	def verify(self, db, **filters):
+		#keeps a couple of batches per worker in flight so loading overlaps checking without holding every round in memory
+		started = time.time()
+		executor = self.get_executor()
+		pending = set()
+		results = []
+		for batch in load_batches(db, self.BATCH_SIZE, archive=self.archive, **filters):
+			if len(pending) >= self.WORKERS * 2:
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				results += [future.result() for future in done]
+			pending.add(executor.submit(verify_batch, batch))
+		results += [future.result() for future in pending]
+		return self.get_report(results, started)
+
+	def submit_batches(self, filters):
+		#runs in a thread with its own read session, each batch goes to the pool as soon as it's loaded
+		db = ReadSessionLocal()
+		try:
+			executor = self.get_executor()
+			return [executor.submit(verify_batch, batch) for batch in load_batches(db, self.BATCH_SIZE, archive=self.archive, **filters)]
+		finally:
+			db.close()
+
+	async def verify_async(self, **filters):
+		#endpoint version, capped so one request can't tie up the pool, loading stays off the event loop
+		#None when MAX_CONCURRENT verifications are already running
+		if self.running >= self.MAX_CONCURRENT:
+			return None
+		self.running += 1
+		try:
+			started = time.time()
+			filters["limit"] = min(filters.get("limit") or self.MAX_ROUNDS, self.MAX_ROUNDS)
+			futures = await asyncio.to_thread(self.submit_batches, filters)
+			return self.get_report(await asyncio.gather(*[asyncio.wrap_future(future) for future in futures]), started)
+		finally:
+			self.running -= 1
+
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown(cancel_futures=True)
+			self.executor = None
+
+if __name__ == "__main__":
+	from archive import Archive
+
+	with open(os.environ.get("CONFIG_FILE", "config.json"), 'r') as file:
+		config = json.load(file)
+
+	parser = argparse.ArgumentParser(description="replay finished rounds and flag any whose outcome doesn't check out")
+	parser.add_argument("--game-id")
+	parser.add_argument("--num", type=int, help="only rounds of this game slot")
+	parser.add_argument("--start", type=int, help="unix time, rounds created at or after")
+	parser.add_argument("--end", type=int, help="unix time, rounds created before")
+	parser.add_argument("--limit", type=int)
+	parser.add_argument("--workers", type=int, default=config["FAIRNESS_WORKERS"])
+	args = parser.parse_args()
+	config["FAIRNESS_WORKERS"] = args.workers
+
+	verifier = FairnessVerifier(config, Archive(config))
+	db = ReadSessionLocal()
+	try:
+		report = verifier.verify(db, game_id=args.game_id, num=args.num, start=args.start, end=args.end, limit=args.limit)
+	finally:
+		db.close()
+		verifier.close()
+	for game in report["flagged"]:
+		print(f"game {game['num']} {game['id']}: {'; '.join(game['problems'])}")
+	print(f"{report['rounds']} rounds checked in {report['seconds']}s, {len(report['flagged'])} flagged")
+	if report["unchecked_payouts"]:
+		print(f"{report['unchecked_payouts']} rounds were paid before the ledger, their payouts can't be checked")
@@ -0,0 +1,149 @@
+from fastapi import FastAPI, Request
+import uvicorn
+import asyncio
+import argparse
+import secrets
+import time
+
+#in-memory stand-in for monero-wallet-rpc, used to load test the arcade offline
+#fake_receive and fake_mine are extra methods to drive the wallet from a test harness
+
+UNLOCK_CONFIRMATIONS = 10
+FEE_PER_DESTINATION = 30000000
+
+class FakeWallet:
+	def __init__(self, latency=0):
+		self.latency = latency
+		self.height = 1000
+		self.addresses = [self.new_address()]
+		self.incoming = []
+		self.outgoing = []
+		self.pending = {}
+		self.stores = 0
+
+	def new_address(self):
+		return "8" + secrets.token_hex(47)
+
+	def unlocked(self, transfer):
+		return self.height - transfer["height"] >= UNLOCK_CONFIRMATIONS
+
+	def balances(self):
+		received = sum(t["amount"] for t in self.incoming)
+		unlocked = sum(t["amount"] for t in self.incoming if self.unlocked(t))
+		spent = sum(t["amount"] + t["fee"] for t in self.outgoing)
+		locked_heights = [t["height"] for t in self.incoming if not self.unlocked(t)]
+		blocks_to_unlock = 0
+		if locked_heights:
+			blocks_to_unlock = min(locked_heights) + UNLOCK_CONFIRMATIONS - self.height
+		return received - spent, unlocked - spent, blocks_to_unlock
+
+	def create_address(self, params):
+		count = params.get("count", 1)
+		indices = []
+		for _ in range(count):
+			self.addresses.append(self.new_address())
+			indices.append(len(self.addresses) - 1)
+		addresses = [self.addresses[i] for i in indices]
+		return {"address":addresses[0],"address_index":indices[0],"addresses":addresses,"address_indices":indices}
+
+	def store(self, params):
+		self.stores += 1
+		return {}
+
+	def get_height(self, params):
+		return {"height":self.height}
+
+	def get_balance(self, params):
+		balance, unlocked_balance, blocks_to_unlock = self.balances()
+		return {"balance":balance,"unlocked_balance":unlocked_balance,"blocks_to_unlock":blocks_to_unlock}
+
+	def incoming_transfers(self, params):
+		transfers = []
+		for t in self.incoming:
+			transfers.append({"amount":t["amount"],"block_height":t["height"],"spent":False,"subaddr_index":t["subaddr_index"],"tx_hash":t["txid"],"unlocked":self.unlocked(t)})
+		if not transfers:
+			return {}
+		return {"transfers":transfers}
+
+	def get_transfers(self, params):
+		min_height = params.get("min_height", 0) if params.get("filter_by_height") else 0
+		result = {}
+		if params.get("in"):
+			result["in"] = [self.format_in(t) for t in self.incoming if t["height"] > min_height]
+		if params.get("out"):
+			result["out"] = [t for t in self.outgoing if t["height"] > min_height]
+		return {key: value for key, value in result.items() if value}
+
+	def format_in(self, t):
+		confirmations = self.height - t["height"]
+		return {"txid":t["txid"],"amount":t["amount"],"height":t["height"],"confirmations":confirmations,"locked":not self.unlocked(t),"subaddr_index":t["subaddr_index"],"type":"in","unlock_time":0,"double_spend_seen":False}
+
+	def transfer(self, params):
+		destinations = params["destinations"]
+		fee = FEE_PER_DESTINATION * (1 + len(destinations))
+		amount = sum(d["amount"] for d in destinations)
+		if any(len(d["address"]) != 95 for d in destinations):
+			raise ValueError("Invalid destination address")
+		if amount + fee > self.balances()[1]:
+			raise ValueError("not enough unlocked money")
+		txid = secrets.token_hex(32)
+		tx = {"txid":txid,"amount":amount,"fee":fee,"destinations":destinations,"type":"out","height":self.height,"timestamp":int(time.time())}
+		if params.get("do_not_relay"):
+			metadata = secrets.token_hex(64)
+			self.pending[metadata] = tx
+			return {"amount":amount,"fee":fee,"tx_hash":txid,"tx_metadata":metadata,"amounts_by_dest":{"amounts":[d["amount"] for d in destinations]}}
+		self.outgoing.append(tx)
+		return {"amount":amount,"fee":fee,"tx_hash":txid,"amounts_by_dest":{"amounts":[d["amount"] for d in destinations]}}
+
+	def relay_tx(self, params):
+		tx = self.pending.pop(params["hex"], None)
+		if tx is None:
+			raise ValueError("Failed to parse tx metadata")
+		if tx["amount"] + tx["fee"] > self.balances()[1]:
+			raise ValueError("double spend")
+		self.outgoing.append(tx)
+		return {"tx_hash":tx["txid"]}
+
+	def fake_receive(self, params):
+		#address_index, or the address itself as a player sees it on the deposit page
+		address_index = params["address_index"] if "address_index" in params else self.addresses.index(params["address"])
+		t = {"txid":secrets.token_hex(32),"amount":params["amount"],"height":self.height,"subaddr_index":{"major":0,"minor":address_index}}
+		self.incoming.append(t)
+		return {"tx_hash":t["txid"]}
+
+	def fake_mine(self, params):
+		self.height += params.get("blocks", 1)
+		return {"height":self.height}
+
+	async def call(self, request):
+		method = getattr(self, request.get("method", ""), None)
+		response = {"jsonrpc":"2.0","id":request.get("id", "0")}
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		if method is None or request["method"] in {"call","new_address","unlocked","balances","format_in"}:
+			response["error"] = {"code":-32601,"message":"Method not found"}
+			return response
+		try:
+			response["result"] = method(request.get("params", {}))
+		except (ValueError, KeyError) as e:
+			response["error"] = {"code":-4,"message":str(e)}
+		return response
+
+app = FastAPI(docs_url=None,redoc_url=None,openapi_url=None)
+wallet = FakeWallet()
+
+@app.post("/json_rpc")
+async def path_json_rpc(request: Request):
+	body = await request.json()
+	if isinstance(body, list):
+		return [await wallet.call(call) for call in body]
+	return await wallet.call(body)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=18082)
+	parser.add_argument("--latency", type=float, default=0)
+	args = parser.parse_args()
+	wallet.latency = args.latency
+	uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,229 @@
+import random
+import models
+
+WAITING = 0
+COUNTDOWN = 1
+ROLLING = 2
+RESOLVED = 3
+
+#the 4 spot board is a 2x2 grid, so its spots aren't in clockwise order
+GRID_4_OFFSETS = {1:0, 2:.75, 3:.25, 4:.5}
+
+def get_spot_offset(spot_count, decision):
+	#turns from the caret to the start of the decided spot, other boards are wheels going clockwise from spot 1 just left of the caret
+	if spot_count == 4:
+		return GRID_4_OFFSETS[decision]
+	return ((spot_count - decision + 1) % spot_count) / spot_count
+
+def get_end_position(spot_count, decision):
+	#turns the wheel spins before stopping on the decided spot
+	rand_end = ((random.random()*0.8) / spot_count) + (0.1/spot_count)
+	return round(random.randint(5, 7) + get_spot_offset(spot_count, decision) + rand_end, 4)
+
+class LiveGame:
+	def __init__(self, game):
+		self.id = game.id
+		self.num = game.num
+		self.spot_count = game.spot_count
+		event = game.get_live_event()
+		self.spots = event["spots"]
+		self.players = event["players"]
+		self.win_spot = game.decide(None)
+		self.phase = WAITING
+		self.countdown = 0
+		self.end_position = 0
+		self.load_state(game.state)
+
+	def load_state(self, state):
+		split_state = state.split(":")
+		if split_state[0] == "1":
+			self.phase = COUNTDOWN
+			self.countdown = int(split_state[1])
+		elif split_state[0] == "2":
+			self.phase = ROLLING
+			self.countdown = int(split_state[1])
+			self.end_position = float(split_state[2])
+		elif split_state[0] == "3":
+			self.phase = RESOLVED
+			self.countdown = int(split_state[1])
+			self.end_position = float(split_state[3])
+
+	@property
+	def state(self):
+		if self.phase == COUNTDOWN:
+			return f"1:{self.countdown}"
+		if self.phase == ROLLING:
+			return f"2:{self.countdown}:{self.end_position}"
+		if self.phase == RESOLVED:
+			return f"3:{self.countdown}:{self.win_spot}:{self.end_position}"
+		return "waiting"
+
+	def get_live_event(self):
+		return {"id":self.id, "num":self.num, "state":self.state, "spots":self.spots, "players":self.players}
+
+	def advance(self):
+		#returns the name of the phase boundary crossed, if any, so the engine knows what to persist
+		if self.phase == COUNTDOWN:
+			if self.countdown != 1:
+				self.countdown -= 1
+				return None
+			self.phase = ROLLING
+			self.countdown = 3
+			self.end_position = get_end_position(self.spot_count, self.win_spot)
+			return "resolve"
+		if self.phase == ROLLING:
+			if self.countdown != 1:
+				self.countdown -= 1
+				return None
+			self.phase = RESOLVED
+			self.countdown = 3
+			return None
+		if self.phase == RESOLVED:
+			if self.countdown != 0:
+				self.countdown -= 1
+				return None
+			return "payout"
+		return None
+
+class GameEngine:
+	def __init__(self, game_configs):
+		#seeds an empty catalogue, after that tables come from the game_configs table
+		self.game_configs = game_configs
+		self.games = {}
+		#bumped on every visible change, render caches key on it
+		self.versions = {}
+		self.current = {}
+		#only the process holding the engine lease ticks, followers mirror its events into states
+		self.leading = True
+		self.states = {}
+
+	def recover(self, db):
+		#rebuilds live rounds from the last persisted phase boundary
+		self.games = {}
+		self.states = {}
+		self.current = {}
+		models.GameConfig.seed(db, self.game_configs)
+		models.Game.start_missing_games(db)
+		for game in models.Game.get_current_games(db):
+			self.current[game.num] = game.id
+			self.touch(game.id)
+			self.load(game)
+
+	def touch(self, game_id):
+		self.versions[game_id] = self.versions.get(game_id, 0) + 1
+
+	def get_version(self, game_id):
+		return self.versions.get(game_id, 0)
+
+	def update(self, game):
+		#called after a spot purchase outside the engine
+		self.touch(game.id)
+		if not self.leading:
+			self.states[game.id] = game.state
+			return
+		self.load(game)
+
+	def follow(self):
+		#leadership lost, live rounds belong to the new leader now
+		self.leading = False
+		self.games = {}
+
+	def apply_event(self, event):
+		#follower side of tick, keeps states, versions and current in step with the leader
+		if event["state"].startswith("4:"):
+			self.states.pop(event["id"], None)
+			self.versions.pop(event["id"], None)
+			if self.current.get(event["num"]) == event["id"]:
+				del self.current[event["num"]]
+			return
+		self.current[event["num"]] = event["id"]
+		self.touch(event["id"])
+		if event["state"] == "waiting":
+			self.states.pop(event["id"], None)
+		else:
+			self.states[event["id"]] = event["state"]
+
+	def load(self, game):
+		if not game.active or game.state == "waiting":
+			return None
+		live = LiveGame(game)
+		self.games[game.id] = live
+		return live
+
+	def adopt(self, db):
+		#rounds started by a follower whose game_updated never reached the leader, without this they'd sit mid round forever
+		events = []
+		for game in models.Game.get_active_games(db):
+			if game.id in self.games:
+				continue
+			self.current[game.num] = game.id
+			self.touch(game.id)
+			if self.load(game):
+				events.append(game.get_live_event())
+		return events
+
+	def get_state(self, game):
+		live = self.games.get(game.id)
+		if live:
+			return live.state
+		return self.states.get(game.id, game.state)
+
+	def tick(self, db):
+		events = []
+		boundaries = {}
+		for live in list(self.games.values()):
+			boundary = live.advance()
+			if boundary:
+				boundaries[live.id] = boundary
+			else:
+				events.append(live.get_live_event())
+		if boundaries:
+			events += self.persist(db, boundaries)
+		for event in events:
+			self.touch(event["id"])
+		for game_id in boundaries:
+			if game_id not in self.games:
+				self.versions.pop(game_id, None)
+		return events
+
+	def persist(self, db, boundaries):
+		#every boundary crossed this tick is written in a single transaction
+		events = []
+		closed = []
+		#rows may have changed under other sessions since this one last looked
+		db.expire_all()
+		try:
+			for game in models.Game.get_many_for_update(db, list(boundaries)):
+				live = self.games[game.id]
+				if not game.active:
+					#already paid out by a leader this process overlapped with during failover, dropped like a finished round
+					boundaries[game.id] = "payout"
+					continue
+				if boundaries[game.id] == "resolve":
+					game.state = live.state
+					events.append(live.get_live_event())
+				elif boundaries[game.id] == "payout":
+					game.end(db)
+					new_game = game.start_new_game(db, commit=False)
+					events.append(game.get_live_event())
+					if new_game:
+						events.append(new_game.get_live_event())
+					else:
+						closed.append(game.num)
+			db.commit()
+		except Exception as e:
+			db.rollback()
+			print(f"failed to persist game states: {e}")
+			for game_id in boundaries:
+				self.games.pop(game_id, None)
+			for game in models.Game.get_many(db, list(boundaries)):
+				self.load(game)
+			return []
+		for game_id, boundary in boundaries.items():
+			if boundary == "payout":
+				self.games.pop(game_id, None)
+		for event in events:
+			self.current[event["num"]] = event["id"]
+		for num in closed:
+			self.current.pop(num, None)
+		return events
@@ -1,29 +1,84 @@
 import time
+from sqlalchemy import func
+from xmr_wallet_rpc import xmr_wallet_rpc
+from database import run_read
 import models
 
+#statuses whose amount has left the player's balance but not the wallet yet
+#initiated is kept for legacy rows withdraw recovery hasn't looked at yet, those it can't match go to review
+PENDING_WITHDRAW_STATUSES = ("initiated", "queued", "sending", "built")
+#possibly sent, possibly not, owed until an operator settles them either way, so counted as liabilities and shown on their own
+HELD_WITHDRAW_STATUSES = ("review",)
+
 class HotWalletStatus:
-	def __init__(self, config):
+	def __init__(self, config, stream):
 		self.LEEWAY = config["HOTWALLET_STAUTS_LEEWAY"]
+		self.RESCAN_TIME = config["HOTWALLET_LIABILITY_RESCAN_TIME"]
+		self.stream = stream
 		self.balance = 0
 		self.unlocked_balance = 0
 		self.last_updated_time = 0
 		self.blocks_to_unlock = 0
-		self.check()
+		#player balances summed from the append only ledger, only entries past last_ledger_id are read each refresh
+		self.ledger_total = 0
+		self.last_ledger_id = 0
+		self.last_rescan_time = 0
+		self.pending_withdraws = 0
+		self.held_withdraws = 0
 
 	def check(self):
-		current_time = int(time.time())
+		#served from memory, the background refresh keeps it current
+		return self.balance, self.unlocked_balance, self.blocks_to_unlock
 
-		if current_time > self.last_updated_time + self.LEEWAY:
-			self.update_balance()
+	def get_status(self):
+		liabilities = self.ledger_total + self.pending_withdraws + self.held_withdraws
+		return {"total_balance":self.balance,"unlocked_balance":self.unlocked_balance,"blocks_to_unlock":self.blocks_to_unlock,
+			"player_balances":self.ledger_total,"pending_withdraws":self.pending_withdraws,"held_withdraws":self.held_withdraws,"liabilities":liabilities,
+			"surplus":self.balance - liabilities,"solvent":self.balance >= liabilities,"last_updated_time":self.last_updated_time}
 
-		return self.balance, self.unlocked_balance, self.blocks_to_unlock
+	async def refresh(self):
+		await self.update_balance()
+		await run_read(self.update_liabilities)
+		status = self.get_status()
+		self.stream.publish("status", status)
+		return status
 
-	def update_balance(self):
+	def apply(self, status):
+		#follower processes take the leader's figures instead of asking the wallet themselves
+		self.balance = status["total_balance"]
+		self.unlocked_balance = status["unlocked_balance"]
+		self.blocks_to_unlock = status["blocks_to_unlock"]
+		self.ledger_total = status["player_balances"]
+		self.pending_withdraws = status["pending_withdraws"]
+		self.held_withdraws = status["held_withdraws"]
+		self.last_updated_time = status["last_updated_time"]
+		#the running total is the leader's, a rescan rebuilds it if this process is elected
+		self.last_rescan_time = 0
+		self.stream.publish("status", status)
+
+	async def update_balance(self):
 		try:
-			balance = models.xmr_wallet_rpc.get_balance()
+			balance = await xmr_wallet_rpc.get_balance()
 			self.balance = balance["balance"]
 			self.unlocked_balance = balance["unlocked_balance"]
 			self.blocks_to_unlock = balance["blocks_to_unlock"]
 			self.last_updated_time = int(time.time())
 		except:
-			print("failed to get hotwallet balance")
\ No newline at end of file
+			print("failed to get hotwallet balance")
+
+	def update_liabilities(self, db):
+		current_time = int(time.time())
+		if current_time > self.last_rescan_time + self.RESCAN_TIME:
+			#from scratch now and then, ids from concurrent writers on other backends can commit out of order
+			self.ledger_total = 0
+			self.last_ledger_id = 0
+			self.last_rescan_time = current_time
+		total, last_ledger_id = db.query(func.coalesce(func.sum(models.LedgerEntry.amount), 0), func.max(models.LedgerEntry.id))\
+			.filter(models.LedgerEntry.id > self.last_ledger_id).one()
+		if last_ledger_id is not None:
+			self.ledger_total += int(total)
+			self.last_ledger_id = last_ledger_id
+		self.pending_withdraws = int(db.query(func.coalesce(func.sum(models.WithdrawRequest.amount), 0))
+			.filter(models.WithdrawRequest.status.in_(PENDING_WITHDRAW_STATUSES)).scalar())
+		self.held_withdraws = int(db.query(func.coalesce(func.sum(models.WithdrawRequest.amount), 0))
+			.filter(models.WithdrawRequest.status.in_(HELD_WITHDRAW_STATUSES)).scalar())
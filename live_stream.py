@@ -0,0 +1,43 @@
+import asyncio
+import json
+from fastapi.responses import StreamingResponse
+
+KEEPALIVE_TIME = 15
+
+class Broadcaster:
+	def __init__(self, queue_size=32):
+		self.queue_size = queue_size
+		self.subscribers = set()
+
+	def subscribe(self):
+		queue = asyncio.Queue(self.queue_size)
+		self.subscribers.add(queue)
+		return queue
+
+	def unsubscribe(self, queue):
+		self.subscribers.discard(queue)
+
+	def publish(self, event, data):
+		#encoded once, every subscriber gets the same bytes
+		message = f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+		for queue in self.subscribers:
+			if queue.full():
+				#slow client, drop its oldest message instead of blocking the publisher
+				queue.get_nowait()
+			queue.put_nowait(message)
+
+	async def events(self, request):
+		queue = self.subscribe()
+		try:
+			while not await request.is_disconnected():
+				try:
+					message = await asyncio.wait_for(queue.get(), KEEPALIVE_TIME)
+				except asyncio.TimeoutError:
+					message = b": keepalive\n\n"
+				yield message
+		finally:
+			self.unsubscribe(queue)
+
+	def response(self, request):
+		headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+		return StreamingResponse(self.events(request), media_type="text/event-stream", headers=headers)
@@ -0,0 +1,110 @@
+import time
+from collections import OrderedDict, deque
+
+#LOGIN CODES, live codes indexed in memory next to their rows in login_codes
+#every code gets the same lifetime, so creation order is expiry order and expired ones come off the front of a deque
+#the rows are the durable copy, other workers and a restarted process verify against them
+
+MAX_THROTTLE_KEYS = 100000
+
+class LoginCodeStore:
+	def __init__(self, expire_time, max_per_fingerprint, complete):
+		self.EXPIRE_TIME = expire_time
+		self.MAX_PER_FINGERPRINT = max_per_fingerprint
+		#complete when this is the only process handing out codes and it loaded the live rows at startup, a miss is then a wrong code
+		self.complete = complete
+		self.codes = {}
+		self.by_fingerprint = {}
+		self.expiry = deque()
+
+	def load(self, rows):
+		for fingerprint, code, expires in sorted(rows, key=lambda row: row[2]):
+			self.add(fingerprint, code, expires)
+
+	def add(self, fingerprint, code, expires=None, now=None):
+		#returns the codes pushed out by the per fingerprint cap, oldest first
+		now = now or time.time()
+		self.purge(now)
+		expires = expires or int(now) + self.EXPIRE_TIME
+		self.codes[(fingerprint, code)] = expires
+		self.expiry.append((expires, fingerprint, code))
+		live = self.by_fingerprint.setdefault(fingerprint, deque())
+		live.append(code)
+		dropped = []
+		while len(live) > self.MAX_PER_FINGERPRINT:
+			dropped_code = live.popleft()
+			self.codes.pop((fingerprint, dropped_code), None)
+			dropped.append(dropped_code)
+		return dropped
+
+	def consume(self, fingerprint, code, now=None):
+		#True or False when the index knows, None when only the database can tell
+		now = now or time.time()
+		self.purge(now)
+		expires = self.codes.pop((fingerprint, code), None)
+		if expires is None:
+			return False if self.complete else None
+		self.remove_live(fingerprint, code)
+		return True
+
+	def remove_live(self, fingerprint, code):
+		live = self.by_fingerprint.get(fingerprint)
+		if live is None:
+			return
+		try:
+			live.remove(code)
+		except ValueError:
+			pass
+		if not live:
+			del self.by_fingerprint[fingerprint]
+
+	def purge(self, now=None):
+		#entries for codes already consumed or capped away are skipped on the way past
+		now = now or time.time()
+		purged = 0
+		while self.expiry and self.expiry[0][0] <= now:
+			expires, fingerprint, code = self.expiry.popleft()
+			if self.codes.get((fingerprint, code)) == expires:
+				del self.codes[(fingerprint, code)]
+				self.remove_live(fingerprint, code)
+				purged += 1
+		return purged
+
+	def __len__(self):
+		return len(self.codes)
+
+class Throttle:
+	#fixed window per key, windows all last as long so they expire in the order they opened
+	#counts are per process, with several workers each allows its own limit
+	def __init__(self, limit, window):
+		self.LIMIT = limit
+		self.WINDOW = window
+		self.hits = OrderedDict()
+
+	def purge(self, now):
+		while self.hits:
+			start, count = next(iter(self.hits.values()))
+			if start + self.WINDOW > now:
+				break
+			self.hits.popitem(last=False)
+
+	def check(self, key, now=None):
+		now = now or time.time()
+		self.purge(now)
+		entry = self.hits.get(key)
+		return entry is None or entry[1] < self.LIMIT
+
+	def hit(self, key, now=None):
+		#counts the attempt and says whether it's within the limit
+		now = now or time.time()
+		self.purge(now)
+		entry = self.hits.get(key)
+		if entry is None:
+			self.hits[key] = [now, 1]
+			if len(self.hits) > MAX_THROTTLE_KEYS:
+				self.hits.popitem(last=False)
+			return True
+		if entry[1] >= self.LIMIT:
+			return False
+		entry[1] += 1
+		return True
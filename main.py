@@ -1,26 +1,38 @@
-from fastapi import FastAPI, Request, Depends, BackgroundTasks
+from fastapi import FastAPI, Request, Depends
 from sqlalchemy.orm import Session
 import models
-from database import SessionLocal, engine
+from database import SessionLocal, ReadSessionLocal, engine, run_write
+import migrations
 import uvicorn
 from xmr_rate import XMRRate
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, PlainTextResponse, Response
 import jwt
-import asyncio
 from hashlib import sha256
 import json
+import os
+import asyncio
 from pgplogin import PGPLogin
 from deposit import Deposit
 from withdraw import Withdraw
 import base64
 from hotwallet_status import HotWalletStatus
+from xmr_wallet_rpc import xmr_wallet_rpc
+from live_stream import Broadcaster
+from render_cache import RenderCache
+from player_cache import player_cache
+from game_engine import GameEngine
+from fairness import FairnessVerifier
+from scheduler import Scheduler
+from cluster import Cluster
+from archive import Archive, get_player_history
+import metrics
 
 NORMALIZER = 1000 * 1000 * 1000 * 1000
 
 
-with open('config.json', 'r') as file:
+with open(os.environ.get("CONFIG_FILE", "config.json"), 'r') as file:
     config = json.load(file)
 
 with open('secrets.json', 'r') as file:
@@ -28,34 +40,120 @@ with open('secrets.json', 'r') as file:
 
 JWT_SECRET = server_secrets["JWT_SECRET"]
 
-models.Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
 
 xmr_rate = XMRRate(config)
-pgp_login = PGPLogin(server_secrets["CONF_PEPPER"])
-deposit = Deposit()
+pgp_login = PGPLogin(server_secrets["CONF_PEPPER"], config)
+deposit = Deposit(config)
 withdraw = Withdraw(config)
-hotwallet_status = HotWalletStatus(config)
+game_stream = Broadcaster()
+hotwallet_stream = Broadcaster()
+hotwallet_status = HotWalletStatus(config, hotwallet_stream)
+game_engine = GameEngine(config["GAME_CONFIGS"])
+render_cache = RenderCache(config["RENDER_CACHE_SIZE"])
+archive = Archive(config)
+fairness_verifier = FairnessVerifier(config, archive)
 
 
 app = FastAPI(docs_url=None,redoc_url=None,openapi_url=None)#for security all = None
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-template = Jinja2Templates(directory="templates").TemplateResponse
+templates = Jinja2Templates(directory="templates")
+template = templates.TemplateResponse
 
 
-def get_db():
+async def get_db():
     db = SessionLocal()
     try:
+        #pool checkout happens on a thread, blocking on a full pool here would also hold up the requests that would free a connection
+        #handing a connection back never waits, so close stays on the event loop
+        await asyncio.to_thread(db.connection)
+        yield db
+    finally:
+        db.close()
+
+async def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        await asyncio.to_thread(db.connection)
         yield db
     finally:
         db.close()
 
+def buy_spot(db, game_id, spot_num, player_id):
+    #runs on the writer thread
+    #game before player, every writer locks in this order
+    game = models.Game.get_for_update(db, game_id)
+    player = models.Player.get_for_update(db, player_id)
+    if not game or not player:
+        return None
+    spot = game.add_spot(db, spot_num, player)
+    if not spot:
+        return None
+    game_engine.update(game)
+    return game.get_live_event()
+
+def reload_game(db, game_id):
+    #leader side of a spot bought on a follower
+    game = models.Game.get(db, game_id)
+    if not game:
+        return None
+    game_engine.update(game)
+    return game.get_live_event()
+
+def create_withdraw_request(db, player_id, amount, address):
+    player = models.Player.get_for_update(db, player_id)
+    db_withdraw_request = models.WithdrawRequest.create(db, player, amount, address)
+    if not db_withdraw_request:
+        return None
+    return db_withdraw_request.id
+
+def login_player(db, display_name, fingerprint):
+    #the existing player for this key, or a new one
+    return models.Player.create(db, display_name, fingerprint).id
+
+def render_lobby(db, bal_display, curr_xmr_rate):
+    #one fragment per table keyed on its own version, a waiting table stays cached until a spot sells
+    #tables in play change every tick since the countdown is in the markup, only they are loaded and rendered again
+    keys = {game_id: ("lobby", game_id, game_engine.get_version(game_id), bal_display, curr_xmr_rate) for game_id in models.Game.get_current_ids(db)}
+    fragments = {game_id: render_cache.lookup(key) for game_id, key in keys.items()}
+    missing = [game_id for game_id, html in fragments.items() if html is None]
+    if missing:
+        lobby_game = templates.get_template("components/lobby-game.html")
+        for game in models.Game.get_many_with_spots(db, missing):
+            context = {"game":game,"curr_xmr_rate":curr_xmr_rate,"bal_display":bal_display,"config":config,"game_state":game_engine.get_state}
+            fragments[game.id] = render_cache.put(keys[game.id], lobby_game.render(context))
+    return "".join(fragments[game_id] or "" for game_id in keys)
+
+def render_game_board(db, game_id, bal_display, curr_xmr_rate, logged_in):
+    game = models.Game.get(db, game_id)
+    last_hashed_secret = None
+    if game.last_game:
+        last_hashed_secret = sha256(game.last_game.secret.encode()).hexdigest()
+    context = {"game":game,"logged_in":logged_in,"taken_spots":game.get_taken_spots(db),"curr_xmr_rate":curr_xmr_rate,"bal_display":bal_display,"config":config,"game_state":game_engine.get_state,
+        "hashed_secret":sha256(game.secret.encode()).hexdigest(),"last_hashed_secret":last_hashed_secret}
+    return templates.get_template("arcade/game-board.html").render(context)
+
 def get_jwt_token(player_id):
     encoded_jwt = jwt.encode({"player_id": player_id}, JWT_SECRET, algorithm="HS256")
     return encoded_jwt
 
-def get_player(db, request):
+def get_client_ip(request):
+    return request.client.host if request.client else "unknown"
+
+def too_many_logins():
+    return PlainTextResponse("Too many login attempts, try again later", status_code=429)
+
+def too_many_verifications():
+    return PlainTextResponse("Too many verifications, try again later", status_code=429)
+
+def verifier_busy():
+    return PlainTextResponse("Verifier busy, try again shortly", status_code=503)
+
+def get_player(db, request, cached=False):
+    #cached=True returns a read-only snapshot, balance mutating routes must read through
     encoded_jwt = request.cookies.get("auth")
     if not encoded_jwt:
         return None
@@ -64,97 +162,182 @@ def get_player(db, request):
     except:
         return None
 
+    if cached:
+        snapshot = player_cache.get(player_id)
+        if snapshot:
+            return snapshot
+        generation = player_cache.generation
+
     player = models.Player.get(db, player_id)
+    if cached and player:
+        player_cache.put(player, generation)
+        return player_cache.get(player_id) or player
     return player
 
-class BackgroundRunner:
-    def __init__(self):
-        self.db = next(get_db())
+def publish_game(event):
+    #local subscribers first, then the other processes, the leader fans out and a follower tells the leader
+    game_stream.publish("game", event)
+    cluster.publish("game", event)
+    cluster.send("game_updated", {"id":event["id"]})
+
+async def on_game_updated(data):
+    event = await run_write(reload_game, data["id"])
+    if event:
+        publish_game(event)
 
+def on_game(event):
+    game_engine.apply_event(event)
+    game_stream.publish("game", event)
+
+class BackgroundRunner:
+    #one run of each background job, timing is left to the scheduler
     async def run_game(self):
-        current_games = models.Game.get_current_games(self.db)
-        if not current_games:
-            models.Game.start_first_games(self.db)
-        while True:
-            active_games = models.Game.get_active_games(self.db)
-            for game in active_games:
-                print(game.state)
-                game.next_state(self.db)
-            await asyncio.sleep(1)
+        for event in await run_write(game_engine.tick):
+            publish_game(event)
+
+    async def run_adopt_games(self):
+        for event in await run_write(game_engine.adopt):
+            publish_game(event)
 
     async def run_delete_old_login_codes(self):
-        while True:
-            models.LoginCode.delete_expired(self.db, config["LOGIN_CODE_EXPIRE_TIME"])
-            await asyncio.sleep(config["LOGIN_CODE_SWEEP_TIME"])
+        await run_write(models.LoginCode.delete_expired)
+
+    async def run_reconcile_ledger(self):
+        await run_write(models.LedgerEntry.reconcile)
+
+    async def run_archive_rounds(self):
+        await archive.archive_old_rounds()
 
     async def run_check_deposits(self):
-        while True:
-            try:
-                deposit.check_deposits(self.db)
-            except Exception as e:
-                print(str(e))
-            await asyncio.sleep(config["DEPOSIT_SWEEP_TIME"])
+        await deposit.check_deposits()
+
+    async def run_deposit_pool(self):
+        await deposit.refill_pool()
+
+    async def run_withdraw_queue(self):
+        await withdraw.process_queue()
+
+    async def run_update_xmr_rate(self):
+        await xmr_rate.update_price()
+
+    async def run_hotwallet_status(self):
+        cluster.publish("hotwallet", await hotwallet_status.refresh())
 
 
 runner = BackgroundRunner()
+#every process keeps its own rate, everything else runs once per deployment on the engine leader
+scheduler = Scheduler()
+leader_scheduler = Scheduler()
+
+async def on_elected():
+    game_engine.leading = True
+    await run_write(game_engine.recover)
+    jitter = config["SCHEDULER_JITTER"]
+    leader_scheduler.add("game", runner.run_game, config["GAME_TICK_TIME"])
+    leader_scheduler.add("adopt_games", runner.run_adopt_games, config["GAME_ADOPT_TIME"], config["GAME_ADOPT_TIME"] * jitter)
+    leader_scheduler.add("hotwallet_status", runner.run_hotwallet_status, config["HOTWALLET_STAUTS_LEEWAY"])
+    leader_scheduler.add("delete_old_login_codes", runner.run_delete_old_login_codes, config["LOGIN_CODE_SWEEP_TIME"], config["LOGIN_CODE_SWEEP_TIME"] * jitter)
+    leader_scheduler.add("check_deposits", runner.run_check_deposits, config["DEPOSIT_SWEEP_TIME"], config["DEPOSIT_SWEEP_TIME"] * jitter)
+    leader_scheduler.add("deposit_pool", runner.run_deposit_pool, config["DEPOSIT_POOL_SWEEP_TIME"], config["DEPOSIT_POOL_SWEEP_TIME"] * jitter)
+    leader_scheduler.add("withdraw_queue", runner.run_withdraw_queue, config["WITHDRAW_BATCH_WINDOW"])
+    leader_scheduler.add("reconcile_ledger", runner.run_reconcile_ledger, config["LEDGER_RECONCILE_TIME"], config["LEDGER_RECONCILE_TIME"] * jitter)
+    leader_scheduler.add("archive_rounds", runner.run_archive_rounds, config["ARCHIVE_SWEEP_TIME"], config["ARCHIVE_SWEEP_TIME"] * jitter)
+
+async def on_demoted():
+    await leader_scheduler.stop()
+    game_engine.follow()
+
+cluster = Cluster(config, on_elected, on_demoted)
+cluster.bus.on("game", on_game)
+cluster.bus.on("hotwallet", hotwallet_status.apply)
+cluster.bus.on("game_updated", on_game_updated)
 
 @app.on_event('startup')
 async def app_startup():
-    asyncio.create_task(runner.run_game())
-    asyncio.create_task(runner.run_delete_old_login_codes())
-    asyncio.create_task(runner.run_check_deposits())
+    scheduler.add("update_xmr_rate", runner.run_update_xmr_rate, config["XMR_RATE_LEEWAY"])
+    if config["CLUSTER_ENABLED"]:
+        game_engine.follow()
+    db = SessionLocal()
+    try:
+        pgp_login.load_codes(db)
+    finally:
+        db.close()
+    await cluster.start()
+
+@app.on_event('shutdown')
+async def app_shutdown():
+    await cluster.stop()
+    await leader_scheduler.stop()
+    await scheduler.stop()
+    await xmr_wallet_rpc.close()
+    await xmr_rate.close()
+    fairness_verifier.close()
+    archive.close()
 
 @app.get("/")
-async def path_root(request: Request, db: Session = Depends(get_db)):
+async def path_root(request: Request, db: Session = Depends(get_read_db)):
     return RedirectResponse("/arcade")
 
 @app.get("/arcade")
-async def path_arcade(request: Request, db: Session = Depends(get_db)):
-    player = get_player(db, request)
+async def path_arcade(request: Request, db: Session = Depends(get_read_db)):
+    player = get_player(db, request, cached=True)
     return template(request=request, name="arcade.html", context={"page":"arcade","player":player})
 
 @app.get("/arcade/iframe")
-async def path_arcade_iframe(request: Request, db: Session = Depends(get_db)):
-    player = get_player(db, request)
-    current_games = models.Game.get_current_games(db)
+async def path_arcade_iframe(request: Request, db: Session = Depends(get_read_db)):
+    player = get_player(db, request, cached=True)
     bal_display = request.cookies.get("bal_display", "XMR")
-    return template(request=request, name="arcade-iframe.html", context={"page":"arcade-i","player":player,"current_games":current_games,"curr_xmr_rate":xmr_rate.check(),"db":db,"bal_display":bal_display,"config":config})
+    curr_xmr_rate = xmr_rate.check()
+    #shared markup is rendered once per table state change, only the balance bar is per player
+    lobby_html = render_lobby(db, bal_display, curr_xmr_rate)
+    return template(request=request, name="arcade-iframe.html", context={"page":"arcade-i","player":player,"lobby_html":lobby_html,"curr_xmr_rate":curr_xmr_rate,"bal_display":bal_display,"config":config})
 
 @app.get("/deposit")
 async def path_deposit(request: Request, db: Session = Depends(get_db)):
     player = get_player(db, request)
     if not player:
         return RedirectResponse("/player/login")
-    player.create_deposit_if_none(db)
+    await deposit.create_deposit_if_none(db, player)
     bal_display = request.cookies.get("bal_display", "XMR")
-    return template(request=request, name="deposit.html", context={"page":"deposit","player":player, "get_qr_svg":deposit.get_qr_svg,"curr_xmr_rate":xmr_rate.check(),"bal_display":bal_display})
+    return template(request=request, name="deposit.html", context={"page":"deposit","player":player,"curr_xmr_rate":xmr_rate.check(),"bal_display":bal_display})
+
+@app.get("/deposit/qr/{address}")
+async def path_deposit_qr(request: Request, address: str, db: Session = Depends(get_read_db)):
+    qr = await deposit.get_qr(db, address)
+    if not qr:
+        return Response(status_code=404)
+    svg, etag = qr
+    #private, the address ties a player to their deposits so shared caches shouldn't keep it
+    headers = {"ETag":etag,"Cache-Control":"private, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(svg, media_type="image/svg+xml", headers=headers)
 
 @app.get("/withdraw")
-async def path_withdraw(request: Request, result: str = "", db: Session = Depends(get_db)):
-    player = get_player(db, request)
+async def path_withdraw(request: Request, result: str = "", db: Session = Depends(get_read_db)):
+    player = get_player(db, request, cached=True)
     if not player:
         return RedirectResponse("/player/login", status_code=302)
     bal_display = request.cookies.get("bal_display", "XMR")
     return template(request=request, name="withdraw.html", context={"player":player,"curr_xmr_rate":xmr_rate.check(),"page":"withdraw","bal_display":bal_display,"result":base64.b64decode(result.encode()).decode()})
 
 @app.post("/withdraw")
-async def path_withdraw_post(request: Request, background_tasks: BackgroundTasks):
-    db = next(get_db()) #fixes issues with background tasks
+async def path_withdraw_post(request: Request, db: Session = Depends(get_read_db)):
+    form = await request.form()
     player = get_player(db, request)
     if not player:
         return RedirectResponse("/user/login", status_code=302)
 
-    form = await request.form()
     address = form.get("address")
     amount = form.get("amount")
     if float(amount) < 0.0001:
         transfer_final = 'amount has to be greater than 0.0001'
     else:
         original_amount = int(float(amount) * NORMALIZER)
-        db_withdraw_request = models.WithdrawRequest.create(db, player, original_amount)
-        if db_withdraw_request:
-            background_tasks.add_task(withdraw.request_withdraw, db, db_withdraw_request, address)
-            transfer_final = 'transfer requested'
+        db.close() #see path_arcade_game_spot
+        withdraw_request_id = await run_write(create_withdraw_request, player.id, original_amount, address)
+        if withdraw_request_id:
+            transfer_final = 'transfer queued'
         else:
             transfer_final = 'not enough balance'
 
@@ -162,74 +345,96 @@ async def path_withdraw_post(request: Request, background_tasks: BackgroundTasks
 
 
 @app.get("/player")
-async def path_player(request: Request, db: Session = Depends(get_db)):
+async def path_player(request: Request, db: Session = Depends(get_read_db)):
     player = get_player(db, request)
     if not player:
         return RedirectResponse("/player/login")
     bal_display = request.cookies.get("bal_display", "XMR")    
     return template(request=request, name="player.html", context={"page":"player","player":player,"curr_xmr_rate":xmr_rate.check(),"bal_display":bal_display})
 
+@app.get("/player/history")
+async def path_player_history(request: Request, limit: int = 50, db: Session = Depends(get_read_db)):
+    player = get_player(db, request, cached=True)
+    if not player:
+        return RedirectResponse("/player/login")
+    return get_player_history(db, player.id, min(max(limit, 1), 500))
+
 @app.get("/player/login")
-async def path_player_login(request: Request, db: Session = Depends(get_db)):
-    player = get_player(db, request)
+async def path_player_login(request: Request, db: Session = Depends(get_read_db)):
+    player = get_player(db, request, cached=True)
     if player:
         return RedirectResponse("/player")
     return template(request=request, name="player/login.html", context={"page":"player_login"})
 
 @app.post("/player/login")
-async def path_player_login_post(request: Request, db: Session = Depends(get_db)):
-    player = get_player(db, request)
+async def path_player_login_post(request: Request, db: Session = Depends(get_read_db)):
+    player = get_player(db, request, cached=True)
     if player:
         return RedirectResponse("/player", status_code=302)
     form = await request.form()
     public_pgp_key = form.get("public_pgp")
     if not public_pgp_key:
         return "No valid public pgp key provided"
-    fingerprint, confirmation_code, encrypted_data = pgp_login.generate_encrypted_confirmation_code(public_pgp_key)
+    if not pgp_login.allow(get_client_ip(request), public_pgp_key):
+        return too_many_logins()
+    db.close()
+    fingerprint, confirmation_code, encrypted_data = await pgp_login.generate_encrypted_confirmation_code(public_pgp_key)
     if not fingerprint:
         return RedirectResponse("/player/login", status_code=302)
-    login_code = pgp_login.create_login_code_in_db(db, fingerprint, confirmation_code)
+    login_code_id = await pgp_login.create_login_code(fingerprint, confirmation_code)
+    if not login_code_id:
+        return too_many_logins()
     return template(request=request, name="player/code-display.html", context={"message":encrypted_data.data,"public_pgp_key":public_pgp_key})
 
 @app.post("/player/login/verify")
-async def path_player_login_verify(request: Request, db: Session = Depends(get_db)):
-    player = get_player(db, request)
+async def path_player_login_verify(request: Request, db: Session = Depends(get_read_db)):
+    player = get_player(db, request, cached=True)
     if player:
         return RedirectResponse("/player", status_code=302)
     form = await request.form()
     code = form.get("code")
     public_pgp_key = form.get("public_pgp")
-    login_code, display_name, fingerprint = pgp_login.verify_login_code(db, public_pgp_key, code)
+    if not pgp_login.allow(get_client_ip(request)):
+        return too_many_logins()
+    db.close()
+    login_ok, display_name, fingerprint = await pgp_login.verify_login_code(public_pgp_key, code)
 
-    if not login_code:
+    if not login_ok:
         return RedirectResponse("/player/login", status_code=302)
 
-    if not login_code.player:
-        db_player = models.Player.create(db, display_name, fingerprint)
-    else:
-        db_player = login_code.player
+    player_id = await run_write(login_player, display_name, fingerprint)
 
     response = RedirectResponse("/", status_code=302)
-    response.set_cookie("auth", get_jwt_token(db_player.id), max_age=86400 * 365, expires=86400 * 365)
+    response.set_cookie("auth", get_jwt_token(player_id), max_age=86400 * 365, expires=86400 * 365)
     return response
 
 @app.get("/player/logout")
-async def path_player_logout(request: Request, db: Session = Depends(get_db)):
+async def path_player_logout(request: Request, db: Session = Depends(get_read_db)):
     response = RedirectResponse("/")
     response.delete_cookie("auth")
     return response
 
 
 @app.get("/arcade/game/{game_num}")
-async def path_arcade_game(request: Request, game_num: int, db: Session = Depends(get_db)):
-    game = models.Game.get_by_num(db, game_num)
-    player = get_player(db, request)
-    taken_spots = game.get_taken_spots(db)
+async def path_arcade_game(request: Request, game_num: int, db: Session = Depends(get_read_db)):
+    game_id = game_engine.current.get(game_num)
+    if not game_id:
+        game = models.Game.get_by_num(db, game_num)
+        if not game:
+            return RedirectResponse("/arcade/iframe", status_code=302)
+        game_id = game.id
+    player = get_player(db, request, cached=True)
     bal_display = request.cookies.get("bal_display", "XMR")
-    return template(request=request, name="arcade/game.html", context={"page":"game","game":game,"player":player,"taken_spots":taken_spots,"curr_xmr_rate":xmr_rate.check(),"db":db,"bal_display":bal_display, "sha256":sha256,"config":config})
+    curr_xmr_rate = xmr_rate.check()
+    logged_in = player is not None
+    cache_key = ("game", game_id, game_engine.get_version(game_id), bal_display, curr_xmr_rate, logged_in)
+    board_html = render_cache.get(cache_key, lambda: render_game_board(db, game_id, bal_display, curr_xmr_rate, logged_in))
+    return template(request=request, name="arcade/game.html", context={"page":"game","game_num":game_num,"player":player,"board_html":board_html,"curr_xmr_rate":curr_xmr_rate,"bal_display":bal_display,"config":config})
 
 @app.post("/arcade/game/{game_id}/spot")
-async def path_arcade_game_spot(request: Request, game_id: str, db: Session = Depends(get_db)):
+async def path_arcade_game_spot(request: Request, game_id: str, db: Session = Depends(get_read_db)):
+    form = await request.form()
+    spot_num = form.get("spot")
     player = get_player(db, request)
     if not player:
         return None
@@ -237,22 +442,76 @@ async def path_arcade_game_spot(request: Request, game_id: str, db: Session = De
     if not game:
         return None
 
-    form = await request.form()
-    spot_num = form.get("spot")
-
-    game.add_spot(db, spot_num, player)
+    #the read connection goes back to the pool before waiting on the writer, requests parked holding one drain the pool
+    #and the next checkout then blocks the whole event loop, loaded attributes stay readable after close
+    db.close()
+    event = await run_write(buy_spot, game.id, spot_num, player.id)
+    if event:
+        publish_game(event)
     return RedirectResponse(f"/arcade/game/{game.num}", status_code=302)
 
+@app.get("/arcade/stream")
+async def path_arcade_stream(request: Request):
+    return game_stream.response(request)
+
+@app.get("/render/cache/stats")
+async def path_render_cache_stats(request: Request):
+    return render_cache.stats()
+
+@app.get("/scheduler/stats")
+async def path_scheduler_stats(request: Request):
+    return {**scheduler.stats(), **leader_scheduler.stats()}
+
+@app.get("/metrics")
+async def path_metrics(request: Request, db: Session = Depends(get_read_db)):
+    #gauges nothing else needs are read only when scraped
+    current_time = models.get_current_time()
+    for name, last_updated_time in (("xmr_rate", xmr_rate.last_updated_time), ("hotwallet_status", hotwallet_status.last_updated_time)):
+        if last_updated_time:
+            metrics.cache_age_seconds.set(current_time - last_updated_time, name)
+    pending = models.WithdrawRequest.count_pending(db)
+    for status in ("queued", "sending"):
+        metrics.withdraw_queue_depth.set(pending.get(status, 0), status)
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/cluster/status")
+async def path_cluster_status(request: Request):
+    return {"owner":cluster.owner,"leader":cluster.is_leader,"followers":len(cluster.bus.clients),"connected":cluster.bus.leader is not None}
+
+@app.get("/fairness")
+async def path_fairness(request: Request, game_id: str = "", num: int = 0, db: Session = Depends(get_read_db)):
+    player = get_player(db, request, cached=True)
+    report = None
+    if game_id or num:
+        if not fairness_verifier.allow(get_client_ip(request)):
+            return too_many_verifications()
+        db.close()
+        report = await fairness_verifier.verify_async(game_id=game_id, num=num, limit=100)
+        if report is None:
+            return verifier_busy()
+    bal_display = request.cookies.get("bal_display", "XMR")
+    return template(request=request, name="fairness.html", context={"page":"fairness","player":player,"report":report,"game_id":game_id,"num":num,"curr_xmr_rate":xmr_rate.check(),"bal_display":bal_display})
+
+@app.get("/fairness/verify")
+async def path_fairness_verify(request: Request, game_id: str = "", num: int = 0, start: int = 0, end: int = 0, limit: int = 0):
+    if not fairness_verifier.allow(get_client_ip(request)):
+        return too_many_verifications()
+    report = await fairness_verifier.verify_async(game_id=game_id, num=num, start=start, end=end, limit=limit)
+    if report is None:
+        return verifier_busy()
+    return report
+
 @app.get("/rate/xmr")
-async def path_rate_xmr(request: Request, db: Session = Depends(get_db)):
+async def path_rate_xmr(request: Request, db: Session = Depends(get_read_db)):
     return xmr_rate.check()
 
 
 @app.get("/balance/display/{currency_type}")
-async def path_balance_display(request: Request, currency_type: str, from_pg: str, db: Session = Depends(get_db)):
+async def path_balance_display(request: Request, currency_type: str, from_pg: str, db: Session = Depends(get_read_db)):
     if currency_type not in {"XMR","USD"}:
         return "fail"
-    if from_pg not in {"arcade","deposit","withdraw","player"} and "game" not in from_pg:
+    game_page = from_pg.startswith("game-") and from_pg[5:].isdecimal()
+    if from_pg not in {"arcade","deposit","withdraw","player","fairness","accounting"} and not game_page:
         return "fail"
 
     redirect_url = ""
@@ -265,18 +524,37 @@ async def path_balance_display(request: Request, currency_type: str, from_pg: st
         redirect_url = "/withdraw"
     elif from_pg == "player":
         redirect_url = "/player"
-    elif "game" in from_pg:
-        redirect_url = f"/arcade/game/{from_pg[5]}" #fails over 9 displayed games, better against injection, 6 displayed games is good enough.
+    elif from_pg == "fairness":
+        redirect_url = "/fairness"
+    elif from_pg == "accounting":
+        redirect_url = "/hotwallet/accounting"
+    elif game_page:
+        redirect_url = f"/arcade/game/{int(from_pg[5:])}" #digits only, so nothing but a game num reaches the url
 
     response = RedirectResponse(redirect_url, status_code=302)
     response.set_cookie("bal_display", currency_type, max_age=86400 * 365)
     return response
 
 @app.get("/hotwallet/status")
-async def path_hotwallet_status(request: Request, db: Session = Depends(get_db)):
+async def path_hotwallet_status(request: Request, db: Session = Depends(get_read_db)):
     balance = hotwallet_status.check()
     return {"total_balance":balance[0]/NORMALIZER,"unlocked_balance":balance[1]/NORMALIZER,"blocks_to_unlock":balance[2]}
 
+@app.get("/hotwallet/stream")
+async def path_hotwallet_stream(request: Request):
+    return hotwallet_stream.response(request)
+
+@app.get("/hotwallet/accounting")
+async def path_hotwallet_accounting(request: Request, db: Session = Depends(get_read_db)):
+    player = get_player(db, request, cached=True)
+    withdraws_and_deposits = [("deposit", deposit) for deposit in models.Transaction.get_recent(db, 25)] + [("withdraw", withdraw) for withdraw in models.WithdrawRequest.get_recent(db, 25)]
+    withdraws_and_deposits.sort(key=lambda transaction: transaction[1].time_created, reverse=True)
+    held_withdraws = models.WithdrawRequest.get_by_status(db, "review")
+    bal_display = request.cookies.get("bal_display", "XMR")
+    return template(request=request, name="hotwallet_accounting.html", context={"page":"accounting","player":player,"status":hotwallet_status.get_status(),"withdraws_and_deposits":withdraws_and_deposits,
+        "held_withdraws":held_withdraws,
+        "curr_xmr_rate":xmr_rate.check(),"bal_display":bal_display})
+
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host=config["HOST"], port=config["PORT"], reload=config["LIVE_RELOAD"])
+    uvicorn.run("main:app", host=config["HOST"], port=config["PORT"], reload=config["LIVE_RELOAD"], workers=config["WEB_WORKERS"])
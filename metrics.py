@@ -0,0 +1,166 @@
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+
+#METRICS, counters, gauges and histograms kept in process and rendered in prometheus text format on /metrics
+#recording is an add under a lock, nothing is formatted until something scrapes
+#with several web workers each process answers for itself
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+registry = []
+
+def escape(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names, values, extra=""):
+	pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+	kind = None
+
+	def __init__(self, name, help_text, labels=()):
+		self.name = name
+		self.help_text = help_text
+		self.labels = labels
+		self.values = {}
+		self.lock = threading.Lock()
+		registry.append(self)
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+		with self.lock:
+			values = self.snapshot()
+		for label_values, value in sorted(values.items()):
+			lines += self.render_value(label_values, value)
+		return lines
+
+	def snapshot(self):
+		return dict(self.values)
+
+	def render_value(self, label_values, value):
+		return [f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}"]
+
+class Counter(Metric):
+	kind = "counter"
+
+	def inc(self, *label_values, amount=1):
+		with self.lock:
+			self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+	kind = "gauge"
+
+	def set(self, value, *label_values):
+		with self.lock:
+			self.values[label_values] = value
+
+class Histogram(Metric):
+	kind = "histogram"
+
+	def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+		super().__init__(name, help_text, labels)
+		self.buckets = buckets
+
+	def observe(self, value, *label_values):
+		#one count per bucket, made cumulative when rendered
+		with self.lock:
+			counts = self.values.get(label_values)
+			if counts is None:
+				counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0]
+			counts[bisect.bisect_left(self.buckets, value)] += 1
+			counts[-1] += value
+
+	def snapshot(self):
+		return {label_values: list(counts) for label_values, counts in self.values.items()}
+
+	def render_value(self, label_values, counts):
+		lines = []
+		total = 0
+		for bucket, count in zip(self.buckets + (float("inf"),), counts):
+			total += count
+			le = 'le="' + format_value(bucket) + '"'
+			lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, le)} {total}")
+		labels = format_labels(self.labels, label_values)
+		lines.append(f"{self.name}_sum{labels} {format_value(counts[-1])}")
+		lines.append(f"{self.name}_count{labels} {total}")
+		return lines
+
+def render():
+	lines = []
+	for metric in registry:
+		lines += metric.render()
+	return "\n".join(lines) + "\n"
+
+http_request_seconds = Histogram("arcade_http_request_seconds", "time to serve a request, server sent event streams excluded", ("route", "method", "status"))
+http_request_db_queries = Histogram("arcade_http_request_db_queries", "database queries run for one request off the writer thread", ("route",), COUNT_BUCKETS)
+http_request_db_seconds = Histogram("arcade_http_request_db_seconds", "time one request spent in those queries", ("route",))
+db_query_seconds = Histogram("arcade_db_query_seconds", "time in the database driver per statement", ("engine",))
+scheduler_job_seconds = Histogram("arcade_scheduler_job_seconds", "time one run of a background job took", ("job",))
+scheduler_job_lag_seconds = Histogram("arcade_scheduler_job_lag_seconds", "how late a background job run started, the game tick is job game", ("job",))
+scheduler_job_failures = Counter("arcade_scheduler_job_failures_total", "background job runs that raised", ("job",))
+wallet_rpc_seconds = Histogram("arcade_wallet_rpc_seconds", "wallet rpc round trip including retries", ("method",))
+wallet_rpc_errors = Counter("arcade_wallet_rpc_errors_total", "wallet rpc calls that failed after retries", ("method",))
+rounds_started = Counter("arcade_rounds_started_total", "rounds opened", ("config",))
+cache_age_seconds = Gauge("arcade_cache_age_seconds", "seconds since a background cached value was refreshed", ("cache",))
+deposit_pool_free = Gauge("arcade_deposit_pool_free", "pre made deposit subaddresses not yet handed out")
+withdraw_queue_depth = Gauge("arcade_withdraw_queue_depth", "withdraw requests not yet sent", ("status",))
+
+#queries made while serving a request add to [count, seconds] here, copied into to_thread workers with the rest of the context
+request_db = ContextVar("request_db", default=None)
+
+def instrument_engine(db_engine, name):
+	def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+		connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+	def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+		duration = time.perf_counter() - connection.info["query_start"].pop()
+		db_query_seconds.observe(duration, name)
+		stats = request_db.get()
+		if stats is not None:
+			stats[0] += 1
+			stats[1] += duration
+
+	event.listen(db_engine, "before_cursor_execute", before_cursor_execute)
+	event.listen(db_engine, "after_cursor_execute", after_cursor_execute)
+
+class MetricsMiddleware:
+	#plain asgi so streaming responses pass straight through, routes are labelled by their template to keep the label set small
+	def __init__(self, app):
+		self.app = app
+
+	async def __call__(self, scope, receive, send):
+		if scope["type"] != "http":
+			return await self.app(scope, receive, send)
+		response = {"status":500,"stream":False}
+
+		async def send_wrapper(message):
+			if message["type"] == "http.response.start":
+				response["status"] = message["status"]
+				response["stream"] = any(name == b"content-type" and value.startswith(b"text/event-stream") for name, value in message.get("headers", ()))
+			await send(message)
+
+		stats = [0, 0.0]
+		token = request_db.set(stats)
+		start = time.perf_counter()
+		try:
+			await self.app(scope, receive, send_wrapper)
+		finally:
+			request_db.reset(token)
+			if not response["stream"]:
+				route = getattr(scope.get("route"), "path", "other")
+				http_request_seconds.observe(time.perf_counter() - start, route, scope["method"], str(response["status"]))
+				http_request_db_queries.observe(stats[0], route)
+				http_request_db_seconds.observe(stats[1], route)
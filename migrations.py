@@ -0,0 +1,161 @@
+from sqlalchemy import inspect, func, select
+from database import engine, config
+import models
+import argparse
+
+#VERSIONED SCHEMA, each migration is (version, name, fn(connection)) and runs once in version order
+#append new ones to the end and never edit one that has shipped, fresh databases get create_all and are stamped as current
+
+def baseline(connection):
+    #installs from before migrations existed were built by create_all, this only fills in missing tables
+    models.Base.metadata.create_all(connection)
+
+def add_column(connection, table, column):
+    #baseline may already have created the table at its newest shape, so adding a column is skipped when present
+    columns = [c["name"] for c in inspect(connection).get_columns(table)]
+    if column.name in columns:
+        return
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column.name} {column_type}")
+
+def add_index(connection, model, *columns):
+    #creates the index the model declares over exactly these columns, if it's missing
+    for index in model.__table__.indexes:
+        if [c.name for c in index.columns] == list(columns):
+            index.create(connection, checkfirst=True)
+
+def drop_index(connection, name):
+    connection.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+def withdraw_request_owner(connection):
+    #requests used to find their player through the deposit address index, now they keep the player and payout address
+    table = models.WithdrawRequest.__table__
+    add_column(connection, table.name, table.c.player_id)
+    add_column(connection, table.name, table.c.address)
+    add_index(connection, models.WithdrawRequest, "player_id")
+    add_index(connection, models.WithdrawRequest, "status")
+    connection.exec_driver_sql("""
+        UPDATE withdraw_requests SET player_id = (SELECT id FROM players WHERE players.xmr_address_index = withdraw_requests.address_index)
+        WHERE player_id IS NULL
+    """)
+
+def withdraw_queue(connection):
+    #leases, retries and the built transaction each request went out in
+    models.WithdrawBatch.__table__.create(connection, checkfirst=True)
+    table = models.WithdrawRequest.__table__
+    for column in ("batch_id", "attempts", "lease_owner", "lease_expires", "last_error"):
+        add_column(connection, table.name, table.c[column])
+    add_index(connection, models.WithdrawRequest, "batch_id")
+    add_index(connection, models.WithdrawRequest, "lease_expires")
+
+def leader_leases(connection):
+    #engine leadership for multi process deployments
+    models.LeaderLease.__table__.create(connection, checkfirst=True)
+
+def game_catalogue(connection):
+    #the six tables used to be hard coded, GAME_CONFIGS keeps their order so config ids line up with the old nums
+    models.GameConfig.__table__.create(connection, checkfirst=True)
+    add_column(connection, "games", models.Game.__table__.c.config_id)
+    add_index(connection, models.Game, "active", "num")
+    models.GameConfig.seed(connection, config["GAME_CONFIGS"])
+    connection.exec_driver_sql("UPDATE games SET config_id = num WHERE config_id IS NULL AND num IN (SELECT id FROM game_configs)")
+
+def query_indexes(connection):
+    #composite and partial indexes for the hot lookups, single column ones they make redundant are dropped
+    duplicate = connection.exec_driver_sql("SELECT game_id, spot_num FROM spots GROUP BY game_id, spot_num HAVING COUNT(*) > 1").first()
+    if duplicate:
+        raise RuntimeError(f"game {duplicate[0]} has spot {duplicate[1]} taken twice, resolve it before upgrading")
+    drop_index(connection, "ix_games_active_num")
+    add_index(connection, models.Game, "num")
+    add_index(connection, models.Spot, "game_id", "spot_num")
+    add_index(connection, models.Spot, "player_id")
+    drop_index(connection, "ix_login_codes_public_fingerprint")
+    drop_index(connection, "ix_login_codes_code")
+    add_index(connection, models.LoginCode, "public_fingerprint", "code")
+    add_index(connection, models.LoginCode, "time_created")
+    add_index(connection, models.WithdrawRequest, "status", "time_created")
+    add_index(connection, models.WithdrawRequest, "status", "lease_expires")
+    drop_index(connection, "ix_ledger_entries_player_id")
+    add_index(connection, models.LedgerEntry, "player_id", "amount")
+
+def round_archive(connection):
+    #summary index for rounds moved to the day archive files, and the columns the archiver picks rounds by
+    models.ArchivedRound.__table__.create(connection, checkfirst=True)
+    models.ArchivedSpot.__table__.create(connection, checkfirst=True)
+    add_index(connection, models.Game, "time_created")
+    add_index(connection, models.Game, "last_game_id")
+    #a round's predecessor can now be archived, sqlite never enforced the foreign key and can't drop it without a rebuild
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("ALTER TABLE games DROP CONSTRAINT IF EXISTS games_last_game_id_fkey")
+
+def deposit_address_pool(connection):
+    models.DepositAddress.__table__.create(connection, checkfirst=True)
+
+def deposit_qr(connection):
+    table = models.DepositAddress.__table__
+    add_column(connection, table.name, table.c.qr)
+
+def login_code_expiry(connection):
+    #codes carry their own expiry so the sweep only touches expired rows
+    table = models.LoginCode.__table__
+    add_column(connection, table.name, table.c.expires)
+    connection.execute(table.update().where(table.c.expires == None).values(expires=table.c.time_created + config["LOGIN_CODE_EXPIRE_TIME"]))
+    drop_index(connection, "ix_login_codes_time_created")
+    add_index(connection, models.LoginCode, "expires")
+
+def opening_balances(connection):
+    #used to be written when a process won leadership, by then a follower could already have put a live entry first
+    #now it runs once, before any request can add a ledger row
+    models.LedgerEntry.open_balances(connection)
+
+MIGRATIONS = [
+    (1, "baseline", baseline),
+    (2, "withdraw request owner", withdraw_request_owner),
+    (3, "withdraw queue", withdraw_queue),
+    (4, "leader leases", leader_leases),
+    (5, "game catalogue", game_catalogue),
+    (6, "query indexes", query_indexes),
+    (7, "round archive", round_archive),
+    (8, "deposit address pool", deposit_address_pool),
+    (9, "deposit qr", deposit_qr),
+    (10, "login code expiry", login_code_expiry),
+    (11, "opening balances", opening_balances),
+]
+
+def get_version(connection):
+    if not inspect(connection).has_table(models.SchemaVersion.__tablename__):
+        return None
+    return connection.execute(select(func.max(models.SchemaVersion.version))).scalar() or 0
+
+def stamp(connection, version, name):
+    connection.execute(models.SchemaVersion.__table__.insert().values(version=version, name=name, time_applied=models.get_current_time()))
+
+def upgrade(db_engine=engine):
+    with db_engine.begin() as connection:
+        version = get_version(connection)
+        if version is None and not inspect(connection).has_table(models.Player.__tablename__):
+            models.Base.metadata.create_all(connection)
+            for migration_version, name, fn in MIGRATIONS:
+                stamp(connection, migration_version, name)
+            return MIGRATIONS[-1][0]
+        if version is None:
+            models.SchemaVersion.__table__.create(connection)
+            version = 0
+        for migration_version, name, fn in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            print(f"applying migration {migration_version} {name}")
+            fn(connection)
+            stamp(connection, migration_version, name)
+            version = migration_version
+    return version
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--status", action="store_true", help="print the schema version without upgrading")
+    args = parser.parse_args()
+    if args.status:
+        with engine.connect() as connection:
+            print(f"schema version {get_version(connection)}, latest {MIGRATIONS[-1][0]}")
+    else:
+        print(f"schema version {upgrade()}")
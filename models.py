@@ -1,23 +1,14 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, exists
-from sqlalchemy.orm import relationship
-from database import Base
+from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Index, Integer, LargeBinary, Numeric, String, exists, update, event, func, text, select
+from sqlalchemy.orm import relationship, selectinload, Session
+from sqlalchemy.exc import IntegrityError
+from database import Base, insert_ignore
+from player_cache import player_cache
+import metrics
 import time
 from uuid import uuid4
 from hashlib import sha256
-from xmr_wallet_rpc import XMRWalletRPC
 import random
-from sqlalchemy import or_, insert
-
-xmr_wallet_rpc = XMRWalletRPC()
-
-game_configs = [
-    {"prize":"0.015","spot_count":4, "spot_cost":"0.004"},
-    {"prize":"0.04","spot_count":2, "spot_cost":"0.021"},
-    {"prize":"0.15","spot_count":4, "spot_cost":"0.04"},
-    {"prize":"0.5","spot_count":4, "spot_cost":"0.13"},
-    {"prize":"0.6","spot_count":2, "spot_cost":"0.31"},
-    {"prize":"1","spot_count":4, "spot_cost":"0.26"},
-]
+from sqlalchemy import or_
 
 NORMALIZER = 1000 * 1000 * 1000 * 1000
 
@@ -37,6 +28,27 @@ def generate_spot_secret(spot_count, game_secret):
     curr_time = (int(game_secret, 16) + int(time.time())) % 100000
     return sha256(str(curr_time).encode()).hexdigest()[:64//spot_count], curr_time
 
+#stays under sqlite's bound parameter limit on older builds
+MAX_IN_PARAMS = 900
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def mark_balance_changed(db, player_id):
+    #dropped now so readers racing the write don't cache, and again once the write is visible
+    player_cache.invalidate(player_id)
+    db.info.setdefault("changed_players", set()).add(player_id)
+
+@event.listens_for(Session, "after_commit")
+def invalidate_changed_players(session):
+    for player_id in session.info.pop("changed_players", ()):
+        player_cache.invalidate(player_id)
+
+@event.listens_for(Session, "after_rollback")
+def forget_changed_players(session):
+    session.info.pop("changed_players", None)
+
 def rigger_emulate_result_flip_the_switch(game, new_spot_secret):
     total_spot_secret = game.spot_secret + new_spot_secret
     result = (int(game.secret, 16) + int(total_spot_secret, 16)) % game.spot_count
@@ -53,10 +65,10 @@ class Player(Base):
     login_codes = relationship("LoginCode", back_populates="player", order_by='LoginCode.time_created.asc()')
     xmr_address = Column(String, unique=True, index=True)
     xmr_address_index = Column(Integer, unique=True, index=True)
-    balance = Column(Integer, default=0)
+    balance = Column(BigInteger, default=0)
     spots = relationship("Spot", back_populates="player")
     transactions = relationship("Transaction", back_populates="player", order_by='Transaction.time_created.desc()')
-    withdraw_requests = relationship("WithdrawRequest", back_populates="player", order_by='WithdrawRequest.time_created.desc()')
+    withdraw_requests = relationship("WithdrawRequest", back_populates="player", foreign_keys="WithdrawRequest.player_id", order_by='WithdrawRequest.time_created.desc()')
     time_active = Column(Integer, default=get_current_time)
     time_created = Column(Integer, default=get_current_time)
 
@@ -85,29 +97,38 @@ class Player(Base):
         player = db.query(Player).filter(Player.id == id).one_or_none()
         return player
 
+    def get_for_update(db, id):
+        #row lock on backends that have one, sqlite already serializes writers
+        player = db.query(Player).filter(Player.id == id).with_for_update().one_or_none()
+        return player
+
     def get_by_display(db, display):
         player = db.query(Player).filter(Player.display == display).one_or_none()
         return player
 
-    def balance_deduct(self, db, amount):
-        new_bal = self.balance - amount
-        if (new_bal) < 0:
+    def balance_deduct(self, db, amount, kind, ref_id=None):
+        #caller commits, the balance check happens inside the UPDATE so concurrent debits can't overdraw
+        query = update(Player).where(Player.id == self.id, Player.balance >= amount).values(balance=Player.balance - amount)
+        result = db.execute(query.execution_options(synchronize_session=False))
+        if result.rowcount != 1:
             return False
-        self.balance = new_bal
-        db.commit()
+        LedgerEntry.append(db, self.id, -amount, kind, ref_id)
+        db.expire(self, ["balance"])
         return True
 
-    def balance_add(self, db, amount):
-        self.balance += amount
-        db.commit()
+    def balance_add(self, db, amount, kind, ref_id=None):
+        #caller commits
+        query = update(Player).where(Player.id == self.id).values(balance=Player.balance + amount)
+        db.execute(query.execution_options(synchronize_session=False))
+        LedgerEntry.append(db, self.id, amount, kind, ref_id)
+        db.expire(self, ["balance"])
         return True
 
-    def create_deposit_if_none(self, db):
-        if self.xmr_address is None:
-            address = xmr_wallet_rpc.create_address()
-            self.xmr_address = address["address"]
-            self.xmr_address_index = address["address_index"]
-            db.commit()
+    def create_address(self, db, address):
+        self.xmr_address = address["address"]
+        self.xmr_address_index = address["address_index"]
+        db.commit()
+        player_cache.invalidate(self.id)
 
     def get_by_public_fingerprint(db, public_fingerprint):
         player = db.query(Player).filter(Player.public_fingerprint == public_fingerprint).one_or_none()
@@ -115,8 +136,45 @@ class Player(Base):
 
 
 
+class GameConfig(Base):
+    __tablename__ = "game_configs" #kinds of table, seeded from GAME_CONFIGS in config.json and edited here afterwards
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    prize = Column(Numeric(asdecimal=False))
+    spot_count = Column(Integer)
+    spot_cost = Column(Numeric(asdecimal=False))
+    instances = Column(Integer, default=1)
+    enabled = Column(Boolean, default=True)
+    time_created = Column(Integer, default=get_current_time)
+
+    def seed(db, game_configs):
+        #caller commits, only an empty catalogue is seeded so changes made in the database stick, works on a session or a connection
+        if db.scalar(select(func.count()).select_from(GameConfig)):
+            return False
+        rows = []
+        for game_config in game_configs:
+            spot_count = int(game_config["spot_count"])
+            #every spot gets a chunk of the 64 hex digit spot secret
+            if not 2 <= spot_count <= 64:
+                raise ValueError(f"spot_count {spot_count} must be between 2 and 64")
+            rows.append({"prize":game_config["prize"],"spot_count":spot_count,"spot_cost":game_config["spot_cost"],
+                "instances":game_config.get("instances", 1),"enabled":True,"time_created":get_current_time()})
+        db.execute(GameConfig.__table__.insert(), rows)
+        return True
+
+    def get(db, id):
+        db_game_config = db.query(GameConfig).filter(GameConfig.id == id).one_or_none()
+        return db_game_config
+
+    def get_enabled(db):
+        db_game_configs = db.query(GameConfig).filter(GameConfig.enabled).order_by(GameConfig.id.asc()).all()
+        return db_game_configs
+
 class Game(Base):
     __tablename__ = "games"
+    #active tables are a handful among every round ever played, so the lobby and num lookups read a partial index over just those
+    #unique as well, a num is only ever one live table
+    __table_args__ = (Index("uq_games_active_num", "num", unique=True, sqlite_where=text("active = 1"), postgresql_where=text("active")),)
 
     id = Column(String, primary_key=True, default=get_uuid)
     state = Column(String, default="waiting")
@@ -124,127 +182,127 @@ class Game(Base):
     num = Column(Integer)
     secret = Column(String)
     spot_secret = Column(String, default="")
-    last_game_id = Column(String, ForeignKey("games.id"))
-    last_game = relationship("Game", remote_side=[id])
-    prize = Column(Integer)
+    #not a foreign key, the previous round may have moved to the archive, see archive.py
+    last_game_id = Column(String, index=True)
+    last_game = relationship("Game", primaryjoin="Game.last_game_id == Game.id", foreign_keys="Game.last_game_id", remote_side="Game.id")
+    config_id = Column(Integer, ForeignKey("game_configs.id"))
+    config = relationship("GameConfig")
+    #copied from the config so a round keeps its terms if the config is edited later
+    prize = Column(Numeric(asdecimal=False))
     spots = relationship("Spot", back_populates="game", order_by='Spot.spot_num.asc()')
     spot_count = Column(Integer)
-    spot_cost = Column(Integer)
-    time_created = Column(Integer, default=get_current_time)
+    spot_cost = Column(Numeric(asdecimal=False))
+    time_created = Column(Integer, default=get_current_time, index=True)
 
-    def create(db, num, prize, spot_count, spot_cost, last_game_id=None):
+    def create(db, num, game_config, last_game_id=None, commit=True):
         db_game = Game(
             num = num,
-            prize = prize,
+            config_id = game_config.id,
+            prize = game_config.prize,
             secret = generate_secret(),
             last_game_id = last_game_id,
-            spot_count = spot_count,
-            spot_cost = spot_cost,
+            spot_count = game_config.spot_count,
+            spot_cost = game_config.spot_cost,
         )
         db.add(db_game)
-        db.commit()
-        db.refresh(db_game)
+        if commit:
+            db.commit()
+            db.refresh(db_game)
+        else:
+            db.flush()
         return db_game
 
     def get(db, id):
         db_game = db.query(Game).filter(Game.id == id).one_or_none()
         return db_game
 
+    def get_for_update(db, id):
+        db_game = db.query(Game).filter(Game.id == id).with_for_update().one_or_none()
+        return db_game
+
     def get_by_num(db, num):
-        db_game = db.query(Game).filter(Game.num == num, Game.active).one_or_none()
+        db_game = db.query(Game).filter(Game.active, Game.num == num).one_or_none()
         return db_game
 
     def get_current_games(db):
         db_games = db.query(Game).filter(Game.active).order_by(Game.num.asc()).all()
         return db_games
 
+    def get_current_ids(db):
+        #what the lobby shows, by num, off the partial index without loading rows
+        return [game_id for game_id, in db.query(Game.id).filter(Game.active).order_by(Game.num.asc())]
+
+    def get_many_with_spots(db, ids):
+        #spots and their players in two more queries instead of one per table and one per spot
+        db_games = db.query(Game).filter(Game.id.in_(ids)).options(selectinload(Game.spots).selectinload(Spot.player)).all()
+        return db_games
+
     def get_active_games(db):
+        #state is checked on the few rows the partial index returns
         db_games = db.query(Game).filter(Game.active, Game.state != "waiting").order_by(Game.num.asc()).all()
         return db_games
 
-    def start_first_games(db):
-        for num in range(1,7):
-            game_config = game_configs[num-1]
-            Game.create(db, num, game_config["prize"], game_config["spot_count"], game_config["spot_cost"])
+    def get_many(db, ids):
+        db_games = db.query(Game).filter(Game.id.in_(ids)).all()
+        return db_games
+
+    def get_many_for_update(db, ids):
+        db_games = db.query(Game).filter(Game.id.in_(ids)).with_for_update().all()
+        return db_games
+
+    def start_missing_games(db):
+        #tops every enabled config up to its instances, new tables take the next free num so existing ones keep theirs
+        running = dict(db.query(Game.config_id, func.count(Game.id)).filter(Game.active).group_by(Game.config_id).all())
+        next_num = (db.query(func.max(Game.num)).filter(Game.active).scalar() or 0) + 1
+        for game_config in GameConfig.get_enabled(db):
+            for _ in range(game_config.instances - running.get(game_config.id, 0)):
+                Game.create(db, next_num, game_config, commit=False)
+                next_num += 1
+        db.commit()
 
     def game_spot_exists(db, game_id, spot_num):
-        db_spot = db.scalar(exists().where(Spot.game_id == game_id, Spot.spot_num == spot_num).select())
+        db_spot = db.scalar(exists().where(Spot.game_id == game_id, Spot.spot_num == int(spot_num)).select())
         return db_spot
 
     def get_spot_num(self, db, num):
-        db_spot = db.query(Spot).filter(Spot.game_id == self.id, Spot.spot_num == num).one_or_none()
+        db_spot = db.query(Spot).filter(Spot.game_id == self.id, Spot.spot_num == int(num)).one_or_none()
         return db_spot
 
 
     def start(self, db):
+        #caller commits
         self.state = "1:5"
-        db.commit()
-        print("Game is Starting")
-
-    def next_state(self, db):
-        split_state = self.state.split(":")
-        if split_state[0] == "1":
-            #time before roll
-            curr_second = int(split_state[1])
-            if curr_second != 1:
-                self.state = f"1:{curr_second - 1}"
-            else:
-                decision = self.decide(db)
-                rand_end = ((random.random()*0.8) / self.spot_count) + (0.1/self.spot_count)
-                if self.spot_count == 2:
-                    if decision == 2:
-                        end_state = round(random.randint(5, 7) + .5 + rand_end, 2)
-                    if decision == 1:
-                        end_state = round(random.randint(5, 7) + rand_end, 2)
-                elif self.spot_count == 4:
-                    if decision == 2:
-                        end_state = round(random.randint(5, 7) + .75 + rand_end, 2)
-                    if decision == 1:
-                        end_state = round(random.randint(5, 7) + rand_end, 2)
-                    elif decision == 4:
-                        end_state = round(random.randint(5, 7) + .5 + rand_end, 2)
-                    elif decision == 3:
-                        end_state = round(random.randint(5, 7) + .25 + rand_end, 2)
-
-                self.state = f"2:3:{end_state}"
-        elif split_state[0] == "2":
-            #rolling
-            curr_seconds = int(split_state[1])
-            total_seconds = float(split_state[2])
-            if curr_seconds != 1:
-                curr_seconds = curr_seconds-1
-                self.state = f"2:{curr_seconds}:{total_seconds}"
-            else:
-                decision = self.decide(db)
-                self.state = f"3:3:{decision}:{total_seconds}"
-        elif split_state[0] == "3":
-            #win spot stay
-            #credit account when revealed winner
-            curr_second = int(split_state[1])
-            win_spot = int(split_state[2])
-            total_seconds = float(split_state[3])
-            if curr_second != 0:
-                self.state = f"3:{curr_second - 1}:{win_spot}:{total_seconds}"
-            else:
-                self.end(db)
-                self.start_new_game(db)
-        db.commit()
-
+        metrics.rounds_started.inc(self.config_id)
 
     def decide(self, db):
         result = (int(self.secret, 16) + int(self.spot_secret, 16)) % self.spot_count
         return result + 1
 
     def end(self, db):
+        #caller commits, payout and next round go in one transaction
         self.state = f"4:{self.decide(db)}"
         self.active = False
         db_win_spot = self.get_spot_num(db, self.decide(db))
-        db_win_spot.player.balance_add(db, db_win_spot.game.prize * NORMALIZER)
-        #db.commit() done in balance_add ^
+        db_win_spot.player.balance_add(db, db_win_spot.game.prize * NORMALIZER, "payout", self.id)
+
+    def start_new_game(self, db, commit=True):
+        #a disabled config, or one cut down to fewer instances, closes the table instead of dealing another round
+        game_config = self.config
+        if not game_config.enabled:
+            return None
+        running = db.query(func.count(Game.id)).filter(Game.active, Game.config_id == game_config.id, Game.id != self.id).scalar()
+        if running >= game_config.instances:
+            return None
+        return Game.create(db, self.num, game_config, self.id, commit)
 
-    def start_new_game(self, db):
-        game_config = game_configs[self.num-1]
-        Game.create(db, self.num, game_config["prize"], game_config["spot_count"], game_config["spot_cost"], self.id)
+    def get_live_event(self):
+        #players carries the id prefix the templates pick a spot's color from, so clients can paint a sale without a reload
+        spots = {}
+        players = {}
+        for spot in self.spots:
+            spots[spot.spot_num] = spot.player.display[0:8].capitalize()
+            players[spot.spot_num] = spot.player_id[:8]
+        return {"id":self.id, "num":self.num, "state":self.state, "spots":spots, "players":players}
 
     def get_taken_spots(self, db):
         spots = {}
@@ -257,20 +315,24 @@ class Game(Base):
         return spot
 
     def update_spot_secret(self, db, new_spot_secret):
+        #caller commits, appended in SQL then reloaded so later reads see the combined secret
         self.spot_secret = Game.spot_secret + new_spot_secret
-        db.commit()
+        db.flush()
+        db.expire(self, ["spot_secret"])
 
 class Spot(Base):
     __tablename__ = "spots"
+    #one taker per spot even if two purchases race, also how a round's spots are loaded
+    __table_args__ = (Index("uq_spots_game_spot", "game_id", "spot_num", unique=True),)
 
     id = Column(String, primary_key=True, default=get_uuid)
-    cost = Column(Integer)
+    cost = Column(Numeric(asdecimal=False))
     spot_num = Column(Integer)
     secret = Column(String)
     secret_time = Column(Integer)
     game_id = Column(String, ForeignKey("games.id"))
     game = relationship("Game", back_populates="spots")
-    player_id = Column(String, ForeignKey("players.id"))
+    player_id = Column(String, ForeignKey("players.id"), index=True)
     player = relationship("Player", back_populates="spots")
     time_created = Column(Integer, default=get_current_time)
 
@@ -292,7 +354,9 @@ class Spot(Base):
             if all_one_player:
                 return None
 
-        deducted = player.balance_deduct(db, game.spot_cost * NORMALIZER)
+        #atomic units, the rigger's refunds have to give back exactly what was taken
+        spot_cost = int(game.spot_cost * NORMALIZER)
+        deducted = player.balance_deduct(db, spot_cost, "spot", game.id)
         if not deducted:
             return None
 
@@ -302,11 +366,13 @@ class Spot(Base):
 
         if player.display == "rigger":
             if not last_spot:
-                refund = player.balance_add(db, game.spot_cost)
+                refund = player.balance_add(db, spot_cost, "refund", game.id)
+                db.commit()
                 return None
             emulated_result = rigger_emulate_result_flip_the_switch(game, secret)
             if emulated_result != int(spot_num):
-                refund = player.balance_add(db, game.spot_cost)
+                refund = player.balance_add(db, spot_cost, "refund", game.id)
+                db.commit()
                 return None
                 
         db_spot = Spot(
@@ -318,12 +384,18 @@ class Spot(Base):
             player_id = player.id
         )
         db.add(db_spot)
-        db.commit()
-        db.refresh(db_spot)
 
         if last_spot:
             game.start(db)
 
+        #deduct, spot secret, spot and game start commit together
+        try:
+            db.commit()
+        except IntegrityError:
+            #another purchase took the spot first, the deduct goes with the rollback
+            db.rollback()
+            return None
+        db.refresh(db_spot)
         return db_spot
 
     def get(db, id):
@@ -332,15 +404,19 @@ class Spot(Base):
 
 class LoginCode(Base):
     __tablename__ = "login_codes"
+    #verify looks up both columns at once, the expiry sweep walks expires up to now
+    __table_args__ = (Index("ix_login_codes_fingerprint_code", "public_fingerprint", "code"),)
 
     id = Column(String, primary_key=True, default=get_uuid)
-    public_fingerprint = Column(String, index=True)
-    code = Column(String, index=True)
+    public_fingerprint = Column(String)
+    code = Column(String)
     player_id = Column(String, ForeignKey("players.id"))
     player = relationship("Player", back_populates="login_codes")
     time_created = Column(Integer, default=get_current_time)
+    expires = Column(Integer, index=True)
 
-    def create(db, public_fingerprint, code):
+    def create(db, public_fingerprint, code, expires, max_per_fingerprint):
+        #only the newest few codes per key stay usable, so repeated logins can't pile up rows
         db_player = Player.get_by_public_fingerprint(db, public_fingerprint)
         player_id = None
         if db_player:
@@ -349,95 +425,201 @@ class LoginCode(Base):
             public_fingerprint = public_fingerprint,
             player_id = player_id,
             code = code,
+            expires = expires,
         )
         db.add(db_login_code)
+        db.flush()
+        #codes from the same second share an expiry, the new one is kept explicitly so a tie can't cap it away
+        others = (LoginCode.public_fingerprint == public_fingerprint, LoginCode.id != db_login_code.id)
+        keep = select(LoginCode.id).where(*others).order_by(LoginCode.expires.desc()).limit(max_per_fingerprint - 1)
+        db.execute(LoginCode.__table__.delete().where(*others, LoginCode.id.not_in(keep)))
         db.commit()
-        db.refresh(db_login_code)
         return db_login_code
 
     def get(db, public_fingerprint, code):
-        db_login_code = db.query(LoginCode).filter(LoginCode.public_fingerprint == public_fingerprint, LoginCode.code == code).order_by(LoginCode.time_created.desc()).one_or_none()
+        db_login_code = db.query(LoginCode).filter(LoginCode.public_fingerprint == public_fingerprint, LoginCode.code == code,
+            LoginCode.expires > get_current_time()).order_by(LoginCode.expires.desc()).first()
         return db_login_code
 
-    def get_expired(db):
-        expired_codes = db.query(LoginCode).filter(LoginCode.time_created < int(time.time()) - 86400).all()
-        return expired_codes
+    def consume(db, public_fingerprint, code):
+        #a code logs in once, whichever request deletes the row first gets it
+        db_login_code = LoginCode.get(db, public_fingerprint, code)
+        if db_login_code is None:
+            return False
+        result = db.execute(LoginCode.__table__.delete().where(LoginCode.id == db_login_code.id))
+        db.commit()
+        return result.rowcount == 1
+
+    def get_live(db):
+        return db.query(LoginCode.public_fingerprint, LoginCode.code, LoginCode.expires).filter(LoginCode.expires > get_current_time()).all()
 
-    def delete_expired(db, expire_time):
-        query = LoginCode.__table__.delete().where(LoginCode.time_created < int(time.time()) - expire_time)
+    def delete_expired(db):
+        query = LoginCode.__table__.delete().where(LoginCode.expires <= get_current_time())
         db.execute(query)
         db.commit()
 
+class DepositAddress(Base):
+    __tablename__ = "deposit_addresses" #subaddresses made ahead of time by deposit.py, player_id is set once one is handed out
+    #free ones are a few dozen next to every address ever claimed
+    __table_args__ = (Index("ix_deposit_addresses_free", "address_index", sqlite_where=text("player_id IS NULL"), postgresql_where=text("player_id IS NULL")),)
+
+    address_index = Column(Integer, primary_key=True)
+    address = Column(String, unique=True)
+    player_id = Column(String, ForeignKey("players.id"), unique=True)
+    qr = Column(LargeBinary) #packed module matrix, see deposit.pack_qr
+    time_claimed = Column(Integer)
+    time_created = Column(Integer, default=get_current_time)
+
+    def add_many(db, addresses):
+        #addresses is a list of (address_index, address, qr)
+        now = get_current_time()
+        db.execute(insert_ignore(DepositAddress, ["address_index"]), [{"address_index":address_index,"address":address,"qr":qr,"time_created":now}
+            for address_index, address, qr in addresses])
+        db.commit()
+
+    def add_claimed(db, player_id, address, qr):
+        #runs on the writer thread, an address the wallet made for one player when the pool was empty
+        player = Player.get_for_update(db, player_id)
+        if not player:
+            return None
+        if player.xmr_address is not None:
+            return {"address":player.xmr_address,"address_index":player.xmr_address_index}
+        now = get_current_time()
+        db.execute(insert_ignore(DepositAddress, ["address_index"]), [{"address_index":address["address_index"],"address":address["address"],"player_id":player.id,"qr":qr,
+            "time_claimed":now,"time_created":now}])
+        player.create_address(db, address)
+        return address
+
+    def get_qr(db, address):
+        #(found, qr), found is False for an address that was never handed to a player
+        row = db.query(DepositAddress.player_id, DepositAddress.qr).filter(DepositAddress.address == address).one_or_none()
+        if row is not None:
+            return row.player_id is not None, row.qr
+        #players from before the pool
+        return db.scalar(exists().where(Player.xmr_address == address).select()), None
+
+    def set_qr(db, address, qr):
+        result = db.execute(update(DepositAddress).where(DepositAddress.address == address, DepositAddress.qr == None).values(qr=qr).execution_options(synchronize_session=False))
+        if result.rowcount == 0:
+            #players from before the pool have no row yet, theirs is added claimed so the code is only made once
+            player = db.query(Player.id, Player.xmr_address_index, Player.time_created).filter(Player.xmr_address == address).one_or_none()
+            if player is not None:
+                db.execute(insert_ignore(DepositAddress, ["address_index"]), [{"address_index":player.xmr_address_index,"address":address,"player_id":player.id,"qr":qr,
+                    "time_claimed":player.time_created,"time_created":player.time_created}])
+        db.commit()
+
+    def count_free(db):
+        return db.query(func.count(DepositAddress.address_index)).filter(DepositAddress.player_id == None).scalar()
+
+    def claim(db, player_id):
+        #runs on the writer thread, hands the player the lowest free subaddress, None when the pool is empty
+        player = Player.get_for_update(db, player_id)
+        if not player:
+            return None
+        if player.xmr_address is not None:
+            return {"address":player.xmr_address,"address_index":player.xmr_address_index}
+        db_address = db.query(DepositAddress).filter(DepositAddress.player_id == None).order_by(DepositAddress.address_index.asc()).limit(1).with_for_update(skip_locked=True).one_or_none()
+        if not db_address:
+            return None
+        db_address.player_id = player.id
+        db_address.time_claimed = get_current_time()
+        address = {"address":db_address.address,"address_index":db_address.address_index}
+        player.create_address(db, address)
+        return address
+
 class Transaction(Base):
     __tablename__ = "transactions"
 
     id = Column(String, primary_key=True, default=get_uuid)
     address_index = Column(Integer, ForeignKey("players.xmr_address_index"), index=True)
     player = relationship("Player", back_populates="transactions")
-    amount = Column(Integer, index=True)
+    amount = Column(BigInteger, index=True)
     tx_hash = Column(String, index=True, unique=True)
     unlocked = Column(Boolean, default=False, index=True)
     block_height = Column(Integer, index=True)
     credited = Column(Boolean, default=False, index=True)
     time_created = Column(Integer, default=get_current_time)
 
-    def bulk_insert(db, transactions):
-        for transaction in transactions:
-            transaction["address_index"] = transaction["subaddr_index"]["minor"]
-        db.execute(insert(Transaction).prefix_with("OR IGNORE"),transactions)
-        db.commit()
+    def bulk_insert(db, transactions, commit=True):
+        if transactions:
+            db.execute(insert_ignore(Transaction, ["tx_hash"]),transactions)
+        if commit:
+            db.commit()
 
     def get_by_tx_hash(db, tx_hash):
         db_transaction = db.query(Transaction).filter(Transaction.tx_hash == tx_hash).one_or_none()
         return db_transaction
 
     def get_by_tx_hashes(db, tx_hashes):
-        filter_arg = []
-        for tx in tx_hashes:
-            filter_arg.append(Transaction.tx_hash == tx)
-        db_transaction = db.query(Transaction).filter(or_(*filter_arg)).all()
-        return db_transaction
+        #one IN probe of the unique tx_hash index, chained ORs stopped using it past a few terms
+        db_transactions = []
+        for chunk in chunked(list(tx_hashes), MAX_IN_PARAMS):
+            db_transactions += db.query(Transaction).filter(Transaction.tx_hash.in_(chunk)).all()
+        return db_transactions
 
     def get_by_tx_hashes_no_credit(db, tx_hashes):
-        filter_arg = []
-        for tx in tx_hashes:
-            filter_arg.append(Transaction.tx_hash == tx)
-        db_transaction = db.query(Transaction).filter(Transaction.credited == False).filter(or_(*filter_arg)).all()
-        return db_transaction
+        db_transactions = []
+        for chunk in chunked(list(tx_hashes), MAX_IN_PARAMS):
+            db_transactions += db.query(Transaction).filter(Transaction.tx_hash.in_(chunk), Transaction.credited == False).with_for_update().all()
+        return db_transactions
+
+    def get_recent(db, limit):
+        db_transactions = db.query(Transaction).order_by(Transaction.block_height.desc()).limit(limit).all()
+        return db_transactions
+
+    def get_since_height(db, min_height):
+        db_transactions = db.query(Transaction).filter(Transaction.block_height > min_height).all()
+        return db_transactions
 
     def exists(db, tx_hash):
         exist = db.scalar(exists().where(Transaction.tx_hash == tx_hash).select())
         return exist
 
-    def credit(self, db):
+    def credit(self, db, commit=True):
         if not self.credited:
             if self.player:
-                self.player.balance_add(db, self.amount)
+                self.player.balance_add(db, self.amount, "deposit", self.tx_hash)
                 print(f"{self.amount} credited to {self.player.display}")
             self.unlocked = True
             self.credited = True
-            db.commit()
+            if commit:
+                db.commit()
 
 class WithdrawRequest(Base):
     __tablename__ = "withdraw_requests" #used to monitor withdraws, if one stays unsuccessful for a while, error occured somehow, most likely server restart during withdraw call
+    #the queue claims oldest first and recovery looks for run out leases, both within one status
+    __table_args__ = (Index("ix_withdraw_requests_status_created", "status", "time_created"), Index("ix_withdraw_requests_status_lease", "status", "lease_expires"))
 
     id = Column(String, primary_key=True, default=get_uuid)
     address_index = Column(Integer, ForeignKey("players.xmr_address_index"), index=True)
-    player = relationship("Player", back_populates="withdraw_requests")
-    amount = Column(Integer)
-    fee = Column(Integer, default=0)
+    player_id = Column(String, ForeignKey("players.id"), index=True)
+    player = relationship("Player", back_populates="withdraw_requests", foreign_keys=[player_id])
+    address = Column(String)
+    amount = Column(BigInteger)
+    fee = Column(BigInteger, default=0)
     tx_hash = Column(String, default=None, index=True)
+    batch_id = Column(String, ForeignKey("withdraw_batches.id"), index=True)
+    batch = relationship("WithdrawBatch", back_populates="withdraw_requests")
     success = Column(Boolean, default=False, index=True)
     refunded = Column(Boolean, default=False, index=True)
-    status = Column(String, default="initiated")
+    status = Column(String, default="initiated", index=True)
+    attempts = Column(Integer, default=0)
+    lease_owner = Column(String)
+    lease_expires = Column(Integer, index=True) #held by lease_owner until then, or for a requeued request not retried before then
+    last_error = Column(String)
     time_created = Column(Integer, default=get_current_time)
 
-    def create(db, player, amount):
-        deducted = player.balance_deduct(db, amount)
+    def create(db, player, amount, address):
+        withdraw_request_id = get_uuid()
+        deducted = player.balance_deduct(db, amount, "withdraw", withdraw_request_id)
         if deducted:
             db_withdraw_request = WithdrawRequest(
+                id = withdraw_request_id,
                 address_index = player.xmr_address_index,
-                amount = amount
+                player_id = player.id,
+                address = address,
+                amount = amount,
+                status = "queued",
             )
             db.add(db_withdraw_request)
             db.commit()
@@ -446,17 +628,264 @@ class WithdrawRequest(Base):
             return db_withdraw_request
         return None
 
-    def succeed(self, db, fee, tx_hash):
+    def get(db, id):
+        db_withdraw_request = db.query(WithdrawRequest).filter(WithdrawRequest.id == id).one_or_none()
+        return db_withdraw_request
+
+    def get_for_update(db, id):
+        db_withdraw_request = db.query(WithdrawRequest).filter(WithdrawRequest.id == id).with_for_update().one_or_none()
+        return db_withdraw_request
+
+    def get_many_for_update(db, ids):
+        db_withdraw_requests = db.query(WithdrawRequest).filter(WithdrawRequest.id.in_(ids)).with_for_update().all()
+        return db_withdraw_requests
+
+    def get_recent(db, limit):
+        db_withdraw_requests = db.query(WithdrawRequest).order_by(WithdrawRequest.time_created.desc()).limit(limit).all()
+        return db_withdraw_requests
+
+    def count_pending(db):
+        #status to count for requests not yet sent, off the status index
+        counts = db.query(WithdrawRequest.status, func.count()).filter(WithdrawRequest.status.in_(["queued", "sending"])).group_by(WithdrawRequest.status).all()
+        return dict(counts)
+
+    def claim_queued(db, worker, limit, lease_time):
+        #oldest first, leased in the same transaction so a request is only ever in one batch, other workers skip locked rows
+        now = get_current_time()
+        db_withdraw_requests = db.query(WithdrawRequest).filter(WithdrawRequest.status == "queued", or_(WithdrawRequest.lease_expires == None, WithdrawRequest.lease_expires <= now))\
+            .order_by(WithdrawRequest.time_created.asc()).limit(limit).with_for_update(skip_locked=True).all()
+        for db_withdraw_request in db_withdraw_requests:
+            db_withdraw_request.status = "sending"
+            db_withdraw_request.lease(worker, lease_time)
+        db.commit()
+        return db_withdraw_requests
+
+    def get_expired_leases(db, status):
+        db_withdraw_requests = db.query(WithdrawRequest).filter(WithdrawRequest.status == status, WithdrawRequest.lease_expires <= get_current_time()).with_for_update(skip_locked=True).all()
+        return db_withdraw_requests
+
+    def get_by_status(db, status):
+        db_withdraw_requests = db.query(WithdrawRequest).filter(WithdrawRequest.status == status).order_by(WithdrawRequest.time_created.asc()).all()
+        return db_withdraw_requests
+
+    def get_claimed_tx_hashes(db, tx_hashes):
+        #hashes already settled against a request or a batch, an outgoing transfer is only ever matched once
+        claimed = {row[0] for row in db.query(WithdrawRequest.tx_hash).filter(WithdrawRequest.tx_hash.in_(tx_hashes)).all()}
+        claimed.update(row[0] for row in db.query(WithdrawBatch.tx_hash).filter(WithdrawBatch.tx_hash.in_(tx_hashes)).all())
+        return claimed
+
+    def lease(self, worker, lease_time):
+        self.lease_owner = worker
+        self.lease_expires = get_current_time() + lease_time
+
+    def retry(self, db, error, retry_max, backoff):
+        #caller commits, only for requests known not to have been sent
+        self.attempts = (self.attempts or 0) + 1
+        self.last_error = error
+        self.lease_owner = None
+        if self.attempts >= retry_max:
+            print(f"{self.player.display}'s withdraw request gave up after {self.attempts} attempts: {error}")
+            self.refund(db, commit=False, status="dead")
+            return
+        self.status = "queued"
+        self.lease_expires = get_current_time() + backoff * 2 ** (self.attempts - 1)
+
+    def succeed(self, db, fee, tx_hash, commit=True):
         self.success = True
         self.fee = fee
         self.tx_hash = tx_hash
         self.status = "sent"
-        db.commit()
+        self.lease_owner = None
+        if commit:
+            db.commit()
         print(f"{self.player.display}'s withdraw request succeeded")
 
-    def refund(self, db):
+    def hold(self, error):
+        #caller commits, left for an operator to refund or mark sent, not counted as a liability meanwhile
+        self.status = "review"
+        self.last_error = error
+        self.lease_owner = None
+        print(f"{self.player.display}'s withdraw request held for review: {error}")
+
+    def refund(self, db, commit=True, status="refunded"):
         if not (self.refunded or self.success):
             self.refunded = True
-            self.status = "refunded"
-            self.player.balance_add(db, self.amount)
+            self.status = status
+            self.lease_owner = None
+            self.player.balance_add(db, self.amount, "refund", self.id)
+            if commit:
+                db.commit()
         print(f"{self.player.display}'s withdraw request failed, user refunded")
+
+class WithdrawBatch(Base):
+    __tablename__ = "withdraw_batches" #one built transaction, saved before relaying so tx_hash can settle it after a crash
+
+    id = Column(String, primary_key=True, default=get_uuid)
+    tx_hash = Column(String, unique=True, index=True)
+    tx_metadata = Column(String)
+    fee = Column(BigInteger)
+    status = Column(String, default="built", index=True)
+    withdraw_requests = relationship("WithdrawRequest", back_populates="batch")
+    time_created = Column(Integer, default=get_current_time)
+    time_updated = Column(Integer, default=get_current_time)
+
+    def create(db, tx_hash, tx_metadata, fee, withdraw_requests, fees):
+        #caller commits
+        db_withdraw_batch = WithdrawBatch(
+            tx_hash = tx_hash,
+            tx_metadata = tx_metadata,
+            fee = fee,
+        )
+        db.add(db_withdraw_batch)
+        db.flush()
+        for db_withdraw_request in withdraw_requests:
+            db_withdraw_request.batch_id = db_withdraw_batch.id
+            db_withdraw_request.fee = fees[db_withdraw_request.id]
+            db_withdraw_request.status = "built"
+        return db_withdraw_batch
+
+    def get_for_update(db, id):
+        db_withdraw_batch = db.query(WithdrawBatch).filter(WithdrawBatch.id == id).with_for_update().one_or_none()
+        return db_withdraw_batch
+
+    def succeed(self, db):
+        #caller commits
+        if self.status == "sent":
+            return
+        self.status = "sent"
+        self.time_updated = get_current_time()
+        for db_withdraw_request in self.withdraw_requests:
+            db_withdraw_request.succeed(db, db_withdraw_request.fee, self.tx_hash, commit=False)
+
+    def fail(self, db, error, retry_max, backoff):
+        #caller commits, the wallet refused the transaction so its requests get rebuilt
+        if self.status != "built":
+            return
+        self.status = "failed"
+        self.time_updated = get_current_time()
+        for db_withdraw_request in list(self.withdraw_requests):
+            db_withdraw_request.retry(db, error, retry_max, backoff)
+
+class ScanCursor(Base):
+    __tablename__ = "scan_cursors" #last block height fully processed by a wallet scanner
+
+    name = Column(String, primary_key=True)
+    height = Column(Integer, default=0)
+    time_updated = Column(Integer, default=get_current_time)
+
+    def get_height(db, name):
+        db_cursor = db.query(ScanCursor).filter(ScanCursor.name == name).one_or_none()
+        if not db_cursor:
+            return 0
+        return db_cursor.height
+
+    def set_height(db, name, height):
+        #caller commits, cursor moves in the same transaction as the credits
+        db_cursor = db.query(ScanCursor).filter(ScanCursor.name == name).one_or_none()
+        if not db_cursor:
+            db_cursor = ScanCursor(name = name)
+            db.add(db_cursor)
+        db_cursor.height = height
+        db_cursor.time_updated = get_current_time()
+
+class LeaderLease(Base):
+    __tablename__ = "leader_leases" #which process runs a singleton role, see cluster.py
+
+    name = Column(String, primary_key=True)
+    owner = Column(String)
+    expires = Column(Integer, default=0)
+
+    def acquire(db, name, owner, lease_time):
+        #one conditional update, taken when free or expired and renewed when already held, so two processes can never both win
+        now = get_current_time()
+        db.execute(insert_ignore(LeaderLease, ["name"]).values(name=name, owner=None, expires=0))
+        result = db.execute(update(LeaderLease).where(LeaderLease.name == name, or_(LeaderLease.owner == owner, LeaderLease.expires < now))
+            .values(owner=owner, expires=now + lease_time).execution_options(synchronize_session=False))
+        db.commit()
+        return result.rowcount == 1
+
+    def release(db, name, owner):
+        db.execute(update(LeaderLease).where(LeaderLease.name == name, LeaderLease.owner == owner).values(expires=0).execution_options(synchronize_session=False))
+        db.commit()
+
+class LedgerEntry(Base):
+    __tablename__ = "ledger_entries" #append only, a player's balance is the sum of their entries
+    #covers the per player sums reconcile runs, without visiting the table
+    __table_args__ = (Index("ix_ledger_entries_player_amount", "player_id", "amount"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    player_id = Column(String, ForeignKey("players.id"))
+    amount = Column(BigInteger)
+    kind = Column(String)
+    ref_id = Column(String, index=True)
+    time_created = Column(Integer, default=get_current_time)
+
+    def append(db, player_id, amount, kind, ref_id=None):
+        db.add(LedgerEntry(
+            player_id = player_id,
+            amount = amount,
+            kind = kind,
+            ref_id = ref_id,
+        ))
+        mark_balance_changed(db, player_id)
+
+    def open_balances(connection):
+        #players from before the ledger existed get one opening entry so reconcile keeps their balance
+        #run by a migration before anything serves, caller commits
+        query = text("""
+            INSERT INTO ledger_entries (player_id, amount, kind, time_created)
+            SELECT id, balance, 'opening', :now FROM players
+            WHERE balance != 0 AND NOT EXISTS (SELECT 1 FROM ledger_entries WHERE ledger_entries.player_id = players.id)
+        """)
+        connection.execute(query, {"now":get_current_time()})
+
+    def reconcile(db):
+        ledger_balance = db.query(func.coalesce(func.sum(LedgerEntry.amount), 0)).filter(LedgerEntry.player_id == Player.id).scalar_subquery()
+        mismatched = db.query(Player.id, Player.display, Player.balance, ledger_balance).filter(Player.balance != ledger_balance).all()
+        for player_id, display, balance, expected in mismatched:
+            print(f"ledger mismatch for {display}: balance {balance}, ledger {expected}")
+        if mismatched:
+            #one statement so a business operation can't land between the read and the write
+            db.execute(update(Player).where(Player.balance != ledger_balance).values(balance=ledger_balance).execution_options(synchronize_session=False))
+            for player_id, display, balance, expected in mismatched:
+                mark_balance_changed(db, player_id)
+            db.commit()
+        return mismatched
+
+class ArchivedRound(Base):
+    __tablename__ = "archived_rounds" #rounds moved out of games by archive.py, the full round is in the archive file for its day
+    __table_args__ = (Index("ix_archived_rounds_num_time", "num", "time_created"),)
+
+    id = Column(String, primary_key=True)
+    num = Column(Integer)
+    config_id = Column(Integer)
+    day = Column(String)
+    winner_id = Column(String)
+    prize = Column(Numeric(asdecimal=False))
+    time_created = Column(Integer, index=True)
+
+    def get_many(db, ids):
+        db_archived_rounds = db.query(ArchivedRound).filter(ArchivedRound.id.in_(ids)).all()
+        return db_archived_rounds
+
+class ArchivedSpot(Base):
+    __tablename__ = "archived_spots" #what each player took in an archived round, secrets stay in the archive file
+    __table_args__ = (Index("ix_archived_spots_player_time", "player_id", "time_created"),)
+
+    game_id = Column(String, primary_key=True)
+    spot_num = Column(Integer, primary_key=True)
+    player_id = Column(String)
+    cost = Column(Numeric(asdecimal=False))
+    won = Column(Boolean)
+    time_created = Column(Integer)
+
+    def get_by_player(db, player_id, limit):
+        db_archived_spots = db.query(ArchivedSpot).filter(ArchivedSpot.player_id == player_id).order_by(ArchivedSpot.time_created.desc()).limit(limit).all()
+        return db_archived_spots
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_versions" #one row per applied migration, see migrations.py
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String)
+    time_applied = Column(Integer, default=get_current_time)
@@ -3,37 +3,128 @@ from hashlib import sha256, sha512
 import time
 from uuid import uuid4
 import models
+from database import run_write
+from login_codes import LoginCodeStore, Throttle
+import asyncio
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 class PGPLogin:
-	def __init__(self, PEPPER):
-		self.gpg = gnupg.GPG()
+	def __init__(self, PEPPER, config):
 		self.PEPPER = PEPPER
+		self.KEY_CACHE_SIZE = config["PGP_KEY_CACHE_SIZE"]
+		#gpg runs as a subprocess, threads are enough to keep it off the event loop
+		self.executor = ThreadPoolExecutor(max_workers=config["PGP_WORKERS"], thread_name_prefix="pgplogin")
+		self.keys = OrderedDict()
+		#flooding /player/login is cut off per address before any gpg work, and per key once its fingerprint is known
+		self.ip_throttle = Throttle(config["LOGIN_IP_LIMIT"], config["LOGIN_THROTTLE_WINDOW"])
+		self.fingerprint_throttle = Throttle(config["LOGIN_FINGERPRINT_LIMIT"], config["LOGIN_THROTTLE_WINDOW"])
+		self.codes = LoginCodeStore(config["LOGIN_CODE_EXPIRE_TIME"], config["LOGIN_CODE_MAX_PER_FINGERPRINT"],
+			config["WEB_WORKERS"] == 1 and not config["CLUSTER_ENABLED"])
 
-	def generate_encrypted_confirmation_code(self, pubkey):
-		importres = self.gpg.import_keys(pubkey)
+	def load_codes(self, db):
+		if self.codes.complete:
+			self.codes.load(models.LoginCode.get_live(db))
+
+	def allow(self, ip, pubkey=None):
+		if not self.ip_throttle.hit(ip):
+			return False
+		key = self.get_cached_key(pubkey) if pubkey else None
+		return key is None or self.fingerprint_throttle.check(key[0])
+
+	async def run(self, fn, *args):
+		return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+	def get_key_digest(self, pubkey):
+		return sha256(pubkey.strip().encode()).hexdigest()
+
+	def get_cached_key(self, pubkey):
+		digest = self.get_key_digest(pubkey)
+		key = self.keys.get(digest)
+		if key is not None:
+			self.keys.move_to_end(digest)
+		return key
+
+	def cache_key(self, pubkey, fingerprint, display_name):
+		self.keys[self.get_key_digest(pubkey)] = (fingerprint, display_name)
+		if len(self.keys) > self.KEY_CACHE_SIZE:
+			self.keys.popitem(last=False)
+
+	def import_key(self, gpg, pubkey):
+		importres = gpg.import_keys(pubkey)
 		if len(importres.fingerprints) != 1:
-			return None, None, None
+			return None, None
 		fingerprint = importres.fingerprints[0]
 		if not fingerprint:
-			return None, None, None
+			return None, None
+		try:
+			display_name = importres.stderr.split('"')[1]
+		except IndexError:
+			return None, None
+		return fingerprint, display_name
+
+	def get_gpg(self, gnupghome):
+		#only public keys are handled, so gpg never needs an agent and one per throwaway home would outlive it
+		return gnupg.GPG(gnupghome=gnupghome, options=["--no-autostart"])
+
+	def read_key(self, pubkey):
+		#every call gets a throwaway keyring, concurrent logins never share gpg state
+		with tempfile.TemporaryDirectory(prefix="pgplogin-") as gnupghome:
+			return self.import_key(self.get_gpg(gnupghome), pubkey)
+
+	def encrypt(self, pubkey, confirmation_code):
+		with tempfile.TemporaryDirectory(prefix="pgplogin-") as gnupghome:
+			gpg = self.get_gpg(gnupghome)
+			fingerprint, display_name = self.import_key(gpg, pubkey)
+			if not fingerprint:
+				return None, None, None
+			encrypted_data = gpg.encrypt(confirmation_code, fingerprint, always_trust=True)
+			if not encrypted_data.ok:
+				return None, None, None
+			return fingerprint, display_name, encrypted_data
+
+	async def generate_encrypted_confirmation_code(self, pubkey):
 		confirmation_code = self.generate_confirmation_code()
-		self.gpg.trust_keys([fingerprint], 'TRUST_ULTIMATE')
-		encrypted_data = self.gpg.encrypt(confirmation_code, fingerprint)
-		self.gpg.delete_keys([fingerprint])
+		fingerprint, display_name, encrypted_data = await self.run(self.encrypt, pubkey, confirmation_code)
+		if not fingerprint:
+			return None, None, None
+		self.cache_key(pubkey, fingerprint, display_name)
 		return fingerprint, confirmation_code, encrypted_data
 
 	def generate_confirmation_code(self):
 		code = sha512(f"{time.time()}{uuid4()}{self.PEPPER}".encode()).hexdigest()
 		return code
 
-	def create_login_code_in_db(self, db, fingerprint, confirmation_code):
-		login_code = models.LoginCode.create(db, fingerprint, confirmation_code)
-		return login_code
-
-	def verify_login_code(self, db,  pubkey, confirmation_code):
-		importres = self.gpg.import_keys(pubkey)
-		display_name = importres.stderr.split('"')[1]
-		fingerprint = importres.results[0]["fingerprint"]
-		login_code = models.LoginCode.get(db, fingerprint, confirmation_code)
-		self.gpg.delete_keys([fingerprint])
-		return login_code, display_name, fingerprint
\ No newline at end of file
+	#the in memory index and throttles are only touched on the event loop, the rows are written by the single writer
+
+	def store_login_code(self, db, fingerprint, confirmation_code, expires):
+		return models.LoginCode.create(db, fingerprint, confirmation_code, expires, self.codes.MAX_PER_FINGERPRINT).id
+
+	async def create_login_code(self, fingerprint, confirmation_code):
+		#None once the key asked for too many codes this window
+		if not self.fingerprint_throttle.hit(fingerprint):
+			return None
+		expires = models.get_current_time() + self.codes.EXPIRE_TIME
+		self.codes.add(fingerprint, confirmation_code, expires)
+		return await run_write(self.store_login_code, fingerprint, confirmation_code, expires)
+
+	async def consume_login_code(self, fingerprint, confirmation_code):
+		#wrong and expired codes are turned away from memory when it holds every live code, the row delete decides the rest
+		if self.codes.consume(fingerprint, confirmation_code) is False:
+			return False
+		return await run_write(models.LoginCode.consume, fingerprint, confirmation_code)
+
+	async def verify_login_code(self, pubkey, confirmation_code):
+		if not pubkey or not confirmation_code:
+			return None, None, None
+		key = self.get_cached_key(pubkey)
+		if key is None:
+			key = await self.run(self.read_key, pubkey)
+			if not key[0]:
+				return None, None, None
+			self.cache_key(pubkey, *key)
+		fingerprint, display_name = key
+		if not await self.consume_login_code(fingerprint, confirmation_code):
+			return None, None, None
+		return True, display_name, fingerprint
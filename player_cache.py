@@ -0,0 +1,57 @@
+import time
+import threading
+import json
+import os
+from collections import OrderedDict
+
+with open(os.environ.get("CONFIG_FILE", "config.json"), 'r') as file:
+	config = json.load(file)
+
+class PlayerSnapshot:
+	#read-only copy of the columns page renders use, safe to share between requests
+	def __init__(self, player):
+		self.id = player.id
+		self.display = player.display
+		self.public_fingerprint = player.public_fingerprint
+		self.xmr_address = player.xmr_address
+		self.xmr_address_index = player.xmr_address_index
+		self.balance = player.balance
+
+class PlayerCache:
+	def __init__(self, ttl, max_size):
+		self.TTL = ttl
+		self.MAX_SIZE = max_size
+		self.entries = OrderedDict()
+		self.generation = 0
+		#invalidate runs on the writer thread from the after_commit hook, get and put on the event loop
+		self.lock = threading.Lock()
+
+	def get(self, player_id):
+		with self.lock:
+			entry = self.entries.get(player_id)
+			if entry is None:
+				return None
+			expires, snapshot = entry
+			if expires < time.monotonic():
+				del self.entries[player_id]
+				return None
+			self.entries.move_to_end(player_id)
+			return snapshot
+
+	def put(self, player, generation):
+		#a write that landed while the row was being read makes the snapshot unsafe to keep
+		snapshot = PlayerSnapshot(player)
+		with self.lock:
+			if generation != self.generation:
+				return
+			self.entries[player.id] = (time.monotonic() + self.TTL, snapshot)
+			self.entries.move_to_end(player.id)
+			if len(self.entries) > self.MAX_SIZE:
+				self.entries.popitem(last=False)
+
+	def invalidate(self, player_id):
+		with self.lock:
+			self.generation += 1
+			self.entries.pop(player_id, None)
+
+player_cache = PlayerCache(config["PLAYER_CACHE_TTL"], config["PLAYER_CACHE_SIZE"])
@@ -0,0 +1,35 @@
+from collections import OrderedDict
+
+class RenderCache:
+	def __init__(self, max_size):
+		self.MAX_SIZE = max_size
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, render):
+		html = self.lookup(key)
+		if html is None:
+			html = self.put(key, render())
+		return html
+
+	def lookup(self, key):
+		#for callers that batch the renders of their misses
+		html = self.entries.get(key)
+		if html is not None:
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return html
+		self.misses += 1
+		return None
+
+	def put(self, key, html):
+		self.entries[key] = html
+		if len(self.entries) > self.MAX_SIZE:
+			self.entries.popitem(last=False)
+		return html
+
+	def stats(self):
+		total = self.hits + self.misses
+		hit_rate = self.hits / total if total else 0
+		return {"hits":self.hits,"misses":self.misses,"hit_rate":hit_rate,"size":len(self.entries),"max_size":self.MAX_SIZE}
@@ -0,0 +1,91 @@
+import asyncio
+import random
+import time
+import metrics
+
+#FIXED RATE SCHEDULER, each job is its own task so a slow wallet call in one can't hold up another
+#run times are fixed on the start time plus whole intervals, work time and jitter never push later runs back
+
+class Job:
+	def __init__(self, name, fn, interval, jitter=0):
+		self.name = name
+		self.fn = fn
+		self.interval = interval
+		self.jitter = jitter
+		self.task = None
+		self.runs = 0
+		self.failures = 0
+		self.skipped = 0
+		self.last_duration = 0
+		self.max_duration = 0
+		self.total_duration = 0
+		self.last_run_time = 0
+		self.last_lag = 0
+		self.max_lag = 0
+		self.last_error = None
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		next_time = loop.time()
+		while True:
+			start_time = next_time
+			if self.jitter and self.runs:
+				start_time += random.uniform(0, self.jitter)
+			delay = start_time - loop.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+
+			started = loop.time()
+			#how late the run started, a busy event loop shows up here before it shows up as skipped ticks
+			self.last_lag = max(started - start_time, 0)
+			self.max_lag = max(self.max_lag, self.last_lag)
+			metrics.scheduler_job_lag_seconds.observe(self.last_lag, self.name)
+			self.last_run_time = int(time.time())
+			try:
+				await self.fn()
+			except Exception as e:
+				self.failures += 1
+				self.last_error = str(e)
+				metrics.scheduler_job_failures.inc(self.name)
+				print(f"scheduled job {self.name} failed: {e}")
+			self.record(loop.time() - started)
+
+			#a run that overran drops the ticks it covered instead of firing them back to back
+			next_time += self.interval
+			behind = loop.time() - next_time
+			if behind > 0:
+				missed = int(behind // self.interval) + 1
+				self.skipped += missed
+				next_time += missed * self.interval
+
+	def record(self, duration):
+		self.runs += 1
+		self.last_duration = duration
+		self.max_duration = max(self.max_duration, duration)
+		self.total_duration += duration
+		metrics.scheduler_job_seconds.observe(duration, self.name)
+
+	def stats(self):
+		average = self.total_duration / self.runs if self.runs else 0
+		return {"interval":self.interval,"runs":self.runs,"failures":self.failures,"skipped":self.skipped,"last_duration":round(self.last_duration, 4),
+			"average_duration":round(average, 4),"max_duration":round(self.max_duration, 4),"last_run_time":self.last_run_time,"last_lag":round(self.last_lag, 4),"max_lag":round(self.max_lag, 4),"last_error":self.last_error}
+
+class Scheduler:
+	def __init__(self):
+		self.jobs = {}
+
+	def add(self, name, fn, interval, jitter=0):
+		#fn is an async callable doing one run, a job never overlaps itself since the next run waits for it
+		job = Job(name, fn, interval, jitter)
+		self.jobs[name] = job
+		job.task = asyncio.create_task(job.run())
+		return job
+
+	async def stop(self):
+		for job in self.jobs.values():
+			job.task.cancel()
+		await asyncio.gather(*[job.task for job in self.jobs.values()], return_exceptions=True)
+		self.jobs = {}
+
+	def stats(self):
+		return {name: job.stats() for name, job in self.jobs.items()}
@@ -1,8 +1,12 @@
-from xmr_wallet_rpc import XMRWalletRPC
+from xmr_wallet_rpc import xmr_wallet_rpc
 import models
-import requests
-
-xmr_wallet_rpc = XMRWalletRPC()
+from database import run_read, run_read_sync, run_write, run_write_sync
+import httpx
+import asyncio
+import argparse
+import socket
+import json
+import os
 
 NORMALIZER = 1000 * 1000 * 1000 * 1000
 
@@ -11,46 +15,261 @@ class Withdraw:
 		self.ESTIMATE_LOOP = config["ESTIMATE_LOOP"]
 		self.ESTIMATE_RETRY_MAX = config["ESTIMATE_RETRY_MAX"]
 		self.ESTIMATE_PERCENT_DOWN = config["ESTIMATE_PERCENT_DOWN"]
+		self.BATCH_MAX_DESTINATIONS = config["WITHDRAW_BATCH_MAX_DESTINATIONS"]
+		self.WORKERS = config["WITHDRAW_WORKERS"]
+		self.LEASE_TIME = config["WITHDRAW_LEASE_TIME"]
+		self.RETRY_MAX = config["WITHDRAW_RETRY_MAX"]
+		self.RETRY_BACKOFF = config["WITHDRAW_RETRY_BACKOFF"]
+		self.LEGACY_MATCH_WINDOW = config["WITHDRAW_LEGACY_MATCH_WINDOW"]
+		self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
 
-	def request_withdraw(self, db, db_withdraw_request, address):
-		amount = db_withdraw_request.amount
+	#DURABLE QUEUE, every state change is committed before the wallet call that depends on it
+	#queued -> sending (leased) -> built (tx saved, idempotency key is its tx_hash) -> sent
+	#anything that provably never left the wallet is retried with backoff, then dead lettered and refunded
 
-		try:
-			if self.ESTIMATE_LOOP:
-
-				retry_count = 0
-				transfer = xmr_wallet_rpc.transfer_no_relay(amount, address)
-				while not transfer and retry_count < self.ESTIMATE_RETRY_MAX:
-					amount = int(amount * (1-(self.ESTIMATE_PERCENT_DOWN/100)))
-					transfer = xmr_wallet_rpc.transfer_no_relay(amount, address)
-					retry_count += 1
-				
-				if not transfer:
-					db_withdraw_request.refund(db)
-					return "unable to estimate transfer"
+	def claim(self, db, worker):
+		db_withdraw_requests = models.WithdrawRequest.claim_queued(db, worker, self.BATCH_MAX_DESTINATIONS, self.LEASE_TIME)
+		return [(db_withdraw_request.id, db_withdraw_request.amount, db_withdraw_request.address) for db_withdraw_request in db_withdraw_requests]
+
+	def retry(self, db, withdraw_request_ids, error):
+		for db_withdraw_request in models.WithdrawRequest.get_many_for_update(db, withdraw_request_ids):
+			if db_withdraw_request.status == "sending":
+				db_withdraw_request.retry(db, error, self.RETRY_MAX, self.RETRY_BACKOFF)
+		db.commit()
+
+	def refund(self, db, withdraw_request_ids):
+		for db_withdraw_request in models.WithdrawRequest.get_many_for_update(db, withdraw_request_ids):
+			db_withdraw_request.refund(db, commit=False)
+		db.commit()
+
+	def build(self, db, worker, tx_hash, tx_metadata, fee, fees):
+		#the lease may have run out while estimating, if so the tx is dropped unrelayed
+		db_withdraw_requests = models.WithdrawRequest.get_many_for_update(db, list(fees))
+		if any(db_withdraw_request.status != "sending" or db_withdraw_request.lease_owner != worker for db_withdraw_request in db_withdraw_requests):
+			db.rollback()
+			return None
+		for db_withdraw_request in db_withdraw_requests:
+			db_withdraw_request.lease(worker, self.LEASE_TIME)
+		db_withdraw_batch = models.WithdrawBatch.create(db, tx_hash, tx_metadata, fee, db_withdraw_requests, fees)
+		db.commit()
+		return db_withdraw_batch.id
+
+	def settle(self, db, withdraw_batch_id):
+		models.WithdrawBatch.get_for_update(db, withdraw_batch_id).succeed(db)
+		db.commit()
+
+	def fail(self, db, withdraw_batch_id, error):
+		models.WithdrawBatch.get_for_update(db, withdraw_batch_id).fail(db, error, self.RETRY_MAX, self.RETRY_BACKOFF)
+		db.commit()
+
+	def release_expired(self, db):
+		#leased but never built, the worker died before anything reached the wallet
+		for db_withdraw_request in models.WithdrawRequest.get_expired_leases(db, "sending"):
+			db_withdraw_request.retry(db, "lease expired", self.RETRY_MAX, self.RETRY_BACKOFF)
+		db.commit()
+
+	def claim_stale_batches(self, db, worker):
+		#built but never settled, the relay outcome was lost
+		stale = {}
+		for db_withdraw_request in models.WithdrawRequest.get_expired_leases(db, "built"):
+			db_withdraw_request.lease(worker, self.LEASE_TIME)
+			stale[db_withdraw_request.batch_id] = (db_withdraw_request.batch.tx_hash, db_withdraw_request.batch.tx_metadata)
+		db.commit()
+		return [(withdraw_batch_id, tx_hash, tx_metadata) for withdraw_batch_id, (tx_hash, tx_metadata) in stale.items()]
+
+	#LEGACY, requests from before the queue were sent inline and left "initiated" if the process died mid send
+	#they carry no tx_hash and usually no address, so they're matched to outgoing transfers by amount and time
+	#only a match that is unique both ways settles a request, the rest are held for review rather than guessed at
+	#a transfer that already settled a withdraw is out of the pool, and one that settles a request here is taken out before the next
+
+	def get_initiated(self, db):
+		return [(db_withdraw_request.id, db_withdraw_request.amount, db_withdraw_request.address, db_withdraw_request.time_created)
+			for db_withdraw_request in models.WithdrawRequest.get_by_status(db, "initiated")]
+
+	def get_legacy_bounds(self, amount):
+		#the old estimate loop could shave ESTIMATE_PERCENT_DOWN off up to ESTIMATE_RETRY_MAX times before the fee came out
+		return int(amount * (1-(self.ESTIMATE_PERCENT_DOWN/100)) ** self.ESTIMATE_RETRY_MAX), amount
+
+	def is_legacy_match(self, initiated, transfer):
+		_, amount, address, time_created = initiated
+		destinations = transfer.get("destinations") or []
+		if len(destinations) > 1 or abs(transfer.get("timestamp", 0) - time_created) > self.LEGACY_MATCH_WINDOW:
+			return False
+		if address and destinations and destinations[0]["address"] != address:
+			return False
+		low, high = self.get_legacy_bounds(amount)
+		return low - 2 * transfer["fee"] <= transfer["amount"] <= high
+
+	def match_legacy(self, initiated, transfers, claimed):
+		#withdraw_request_id -> transfer for unique matches, None for the ones to hold
+		pool = [transfer for transfer in transfers if transfer["txid"] not in claimed]
+		candidates = {request[0]: [transfer for transfer in pool if self.is_legacy_match(request, transfer)] for request in initiated}
+		claims = {}
+		for matched in candidates.values():
+			for transfer in matched:
+				claims[transfer["txid"]] = claims.get(transfer["txid"], 0) + 1
+		matches = {}
+		taken = set()
+		for withdraw_request_id, matched in candidates.items():
+			matched = [transfer for transfer in matched if transfer["txid"] not in taken]
+			#more than one candidate, or a candidate another request could also be, is a guess
+			if len(matched) == 1 and claims[matched[0]["txid"]] == 1:
+				matches[withdraw_request_id] = matched[0]
+				taken.add(matched[0]["txid"])
+			else:
+				matches[withdraw_request_id] = None
+		return matches
+
+	def settle_legacy(self, db, initiated, transfers):
+		#matched on the writer so the claimed hashes can't change between the lookup and the settle
+		claimed = models.WithdrawRequest.get_claimed_tx_hashes(db, [transfer["txid"] for transfer in transfers])
+		matches = self.match_legacy(initiated, transfers, claimed)
+		for db_withdraw_request in models.WithdrawRequest.get_many_for_update(db, list(matches)):
+			if db_withdraw_request.status != "initiated":
+				continue
+			transfer = matches[db_withdraw_request.id]
+			if transfer and transfer["txid"] not in claimed:
+				db_withdraw_request.succeed(db, transfer["fee"], transfer["txid"], commit=False)
+				claimed.add(transfer["txid"])
+			elif transfer:
+				db_withdraw_request.hold("matching transfer already settled another withdraw")
+			else:
+				db_withdraw_request.hold("no unique outgoing transfer matched")
+		db.commit()
+
+	async def resolve_legacy(self):
+		initiated = await run_read(self.get_initiated)
+		if not initiated:
+			return
+		transfers = await xmr_wallet_rpc.get_outgoing_transfers()
+		await run_write(self.settle_legacy, initiated, transfers)
+
+	def get_held(self, db):
+		return [(db_withdraw_request.id, db_withdraw_request.amount, db_withdraw_request.time_created, db_withdraw_request.last_error)
+			for db_withdraw_request in models.WithdrawRequest.get_by_status(db, "review")]
+
+	def resolve_held(self, db, withdraw_request_id, tx_hash=None):
+		#operator's call on a held request, sent under tx_hash or refunded to the player
+		db_withdraw_request = models.WithdrawRequest.get_for_update(db, withdraw_request_id)
+		if db_withdraw_request is None or db_withdraw_request.status != "review":
+			db.rollback()
+			return False
+		if tx_hash:
+			db_withdraw_request.succeed(db, 0, tx_hash)
+		else:
+			db_withdraw_request.refund(db)
+		return True
+
+	def split_fee(self, fee, count):
+		#fee grows with the number of outputs, not their amounts, so every destination pays an equal share
+		share, remainder = divmod(fee, count)
+		return [share + (1 if i < remainder else 0) for i in range(count)]
+
+	def get_destinations(self, amounts, addresses):
+		return [{"amount":amount,"address":address} for amount, address in zip(amounts, addresses)]
+
+	async def process_queue(self):
+		await self.recover(f"{self.worker_prefix}:recover")
+		await asyncio.gather(*[self.run_worker(f"{self.worker_prefix}:{i}") for i in range(self.WORKERS)])
 
+	async def run_worker(self, worker):
+		while True:
+			batch = await run_write(self.claim, worker)
+			if not batch:
+				return
+			await self.send_batch(worker, batch)
+			if len(batch) < self.BATCH_MAX_DESTINATIONS:
+				return
+
+	async def recover(self, worker):
+		await self.resolve_legacy()
+		await run_write(self.release_expired)
+		stale_batches = await run_write(self.claim_stale_batches, worker)
+		if not stale_batches:
+			return
+		sent = await xmr_wallet_rpc.get_outgoing_tx_hashes()
+		for withdraw_batch_id, tx_hash, tx_metadata in stale_batches:
+			if tx_hash in sent:
+				await run_write(self.settle, withdraw_batch_id)
 			else:
+				await self.relay(withdraw_batch_id, tx_hash, tx_metadata)
+
+	async def estimate_batch(self, batch):
+		original_amounts = [amount for _, amount, _ in batch]
+		addresses = [address for _, _, address in batch]
 
-				transfer = xmr_wallet_rpc.transfer_no_relay(amount, address)
-				if not transfer:
-					db_withdraw_request.refund(db)
-					return "estimate transfer failed"
+		amounts = original_amounts
+		transfer = await xmr_wallet_rpc.transfer_no_relay(self.get_destinations(amounts, addresses))
+		retry_count = 0
+		while not transfer and self.ESTIMATE_LOOP and retry_count < self.ESTIMATE_RETRY_MAX:
+			amounts = [int(amount * (1-(self.ESTIMATE_PERCENT_DOWN/100))) for amount in amounts]
+			transfer = await xmr_wallet_rpc.transfer_no_relay(self.get_destinations(amounts, addresses))
+			retry_count += 1
+		if not transfer:
+			return None
 
+		#sends adjusted amounts with the fee taken out, perfect above 0.0002 XMR
+		adjusted_amounts = [amount - share for amount, share in zip(amounts, self.split_fee(transfer["fee"], len(batch)))]
+		if min(adjusted_amounts) <= 0:
+			return None
+		transfer2 = await xmr_wallet_rpc.transfer_no_relay(self.get_destinations(adjusted_amounts, addresses))
+		if not transfer2 or (transfer2["amount"] + transfer["fee"]) > sum(original_amounts): #second statement makes sure transfer being sent wont drain wallet
+			return None
+		fees = dict(zip([withdraw_request_id for withdraw_request_id, _, _ in batch], self.split_fee(transfer2["fee"], len(batch))))
+		return transfer2, fees
+
+	async def send_batch(self, worker, batch):
+		withdraw_request_ids = [withdraw_request_id for withdraw_request_id, _, _ in batch]
+		try:
+			estimate = await self.estimate_batch(batch)
+		except httpx.HTTPError as e:
+			#nothing was relayed, the requests go back in the queue with backoff
+			await run_write(self.retry, withdraw_request_ids, f"estimate failed: {e}")
+			return "estimate failed"
 
-			transfer2 = xmr_wallet_rpc.transfer_no_relay(amount - transfer["fee"], address) #sends adjusted amount with fee, perfect above 0.0002 XMR
-			if not transfer2 or (transfer2["amount"] + transfer["fee"]) > amount: #second statement makes sure transfer being sent wont drain wallet
-				db_withdraw_request.refund(db)
+		if not estimate:
+			if len(batch) == 1:
+				await run_write(self.refund, withdraw_request_ids)
 				return "transfer failed"
+			#a bad address or too little unlocked balance fails the whole transaction, halves are retried so only the culprits get refunded
+			middle = len(batch) // 2
+			await self.send_batch(worker, batch[:middle])
+			await self.send_batch(worker, batch[middle:])
+			return "batch split"
 
-			transfer_final = xmr_wallet_rpc.relay_tx(transfer2["tx_metadata"])
-			if not transfer_final:
-				db_withdraw_request.refund(db)
+		transfer2, fees = estimate
+		withdraw_batch_id = await run_write(self.build, worker, transfer2["tx_hash"], transfer2["tx_metadata"], transfer2["fee"], fees)
+		if not withdraw_batch_id:
+			return "lease lost"
+		return await self.relay(withdraw_batch_id, transfer2["tx_hash"], transfer2["tx_metadata"])
+
+	async def relay(self, withdraw_batch_id, tx_hash, tx_metadata):
+		try:
+			transfer_final = await xmr_wallet_rpc.relay_tx(tx_metadata)
+		except httpx.HTTPError:
+			#When RPC relay throws a request exception the outcome is unknown, recovery settles it by tx_hash once the lease runs out
+			return "relay unknown"
+		if not transfer_final:
+			#refused, possibly because an earlier attempt already relayed it
+			if tx_hash not in await xmr_wallet_rpc.get_outgoing_tx_hashes():
+				await run_write(self.fail, withdraw_batch_id, "relay refused")
 				return "relay failed"
-		except requests.exceptions.RequestException:
-			#When RPC relay throws a request exception and quits before refund.
-			db_withdraw_request.refund(db)
-			return "relay failed"
+		await run_write(self.settle, withdraw_batch_id)
+		return "transfered"
+
+if __name__ == "__main__":
+	with open(os.environ.get("CONFIG_FILE", "config.json"), 'r') as file:
+		config = json.load(file)
 
-		db_withdraw_request.succeed(db, transfer2["fee"], transfer_final["tx_hash"])
-		db.close()
-		return "transfered"
\ No newline at end of file
+	parser = argparse.ArgumentParser(description="list withdraws held for review, or settle one")
+	parser.add_argument("--refund", metavar="ID", help="refund a held withdraw to its player")
+	parser.add_argument("--sent", nargs=2, metavar=("ID", "TX_HASH"), help="mark a held withdraw as sent in that transaction")
+	args = parser.parse_args()
+	withdraw = Withdraw(config)
+	if args.refund or args.sent:
+		withdraw_request_id, tx_hash = args.sent or (args.refund, None)
+		if not run_write_sync(withdraw.resolve_held, withdraw_request_id, tx_hash):
+			raise SystemExit(f"{withdraw_request_id} is not held for review")
+	else:
+		for withdraw_request_id, amount, time_created, error in run_read_sync(withdraw.get_held):
+			print(f"{withdraw_request_id} {amount/NORMALIZER:.6f} XMR created {time_created}: {error}")
@@ -1,24 +1,119 @@
 import time
-import requests
+import httpx
+import asyncio
+import statistics
+import json
+import os
+
+#PRICE SOURCES, each turns one public ticker into a float USD price per XMR
+#most recent price from top exchanges, good as estimate, not advised if using to convert.
+
+class RateSource:
+	def __init__(self, name, url, parse):
+		self.name = name
+		self.url = url
+		#picks the price out of the ticker's json body
+		self.parse = parse
+
+	async def fetch(self, client):
+		response = await client.get(self.url)
+		response.raise_for_status()
+		return float(self.parse(response.json()))
+
+class StubSource:
+	#fixed price for tests and offline runs, never touches the network
+	name = "stub"
+
+	def __init__(self, price):
+		self.price = price
+
+	async def fetch(self, client):
+		return float(self.price)
+
+RATE_SOURCES = [
+	RateSource("whitebit", "https://whitebit.com/api/v1/public/ticker?market=XMR_USDT", lambda body: body["result"]["last"]),
+	RateSource("kraken", "https://api.kraken.com/0/public/Ticker?pair=XMRUSD", lambda body: body["result"]["XXMRZUSD"]["c"][0]),
+	RateSource("coingecko", "https://api.coingecko.com/api/v3/simple/price?ids=monero&vs_currencies=usd", lambda body: body["monero"]["usd"]),
+]
 
 class XMRRate:
 	def __init__(self, config):
 		self.LEEWAY = config["XMR_RATE_LEEWAY"]
+		self.TIMEOUT = config["XMR_RATE_TIMEOUT"]
+		self.CACHE_FILE = config["XMR_RATE_CACHE_FILE"]
+		sources = {source.name: source for source in RATE_SOURCES}
+		sources["stub"] = StubSource(config["XMR_RATE_STUB_PRICE"])
+		self.sources = [sources[name] for name in config["XMR_RATE_SOURCES"]]
 		self.price = 0
 		self.last_updated_time = 0
-		self.check()
+		self.last_attempt_time = 0
+		self.client = None
+		self.refreshing = None
+		self.load()
 
 	def check(self):
+		#never waits on the network, a stale price is served while a refresh runs in the background
+		#failed attempts count as well, so with every source down requests don't start fetch after fetch
 		current_time = int(time.time())
 
-		if current_time > self.last_updated_time + self.LEEWAY:
-			self.update_price()
+		if current_time > max(self.last_updated_time, self.last_attempt_time) + self.LEEWAY:
+			try:
+				self.start_refresh()
+			except RuntimeError:
+				pass
 
 		return self.price
 
-	def update_price(self):
-		url = "https://whitebit.com/api/v1/public/ticker?market=XMR_USDT" #most recent price from top 3 exchange, good as estimate, not advised if using to convert.
-		response = requests.get(url)
-		body = response.json()
-		self.price = float(body["result"]["last"])
-		self.last_updated_time = int(time.time())
\ No newline at end of file
+	def start_refresh(self):
+		#the one refresh in flight, shared by check and the scheduled job
+		if self.refreshing is None:
+			self.last_attempt_time = int(time.time())
+			self.refreshing = asyncio.get_running_loop().create_task(self.fetch_price())
+		return self.refreshing
+
+	async def update_price(self):
+		#scheduled job, joins a refresh check already started instead of overlapping it
+		return await asyncio.shield(self.start_refresh())
+
+	async def fetch_price(self):
+		try:
+			if self.client is None:
+				self.client = httpx.AsyncClient(timeout=self.TIMEOUT)
+			results = await asyncio.gather(*[source.fetch(self.client) for source in self.sources], return_exceptions=True)
+			prices = []
+			for source, result in zip(self.sources, results):
+				if isinstance(result, Exception):
+					print(f"failed to get xmr rate from {source.name}: {result!r}")
+				elif result > 0:
+					prices.append(result)
+			#median so one source with a bad tick can't move the displayed rate
+			if prices:
+				self.price = statistics.median(prices)
+				self.last_updated_time = int(time.time())
+				self.save()
+		finally:
+			self.refreshing = None
+		return self.price
+
+	def load(self):
+		#last known good price, so pages don't show 0 between a restart and the first refresh
+		try:
+			with open(self.CACHE_FILE, 'r') as file:
+				saved = json.load(file)
+			self.price = saved["price"]
+			self.last_updated_time = saved["time"]
+		except (OSError, ValueError, KeyError):
+			pass
+
+	def save(self):
+		try:
+			with open(self.CACHE_FILE + ".tmp", 'w') as file:
+				json.dump({"price":self.price,"time":self.last_updated_time}, file)
+			os.replace(self.CACHE_FILE + ".tmp", self.CACHE_FILE)
+		except OSError as e:
+			print(f"failed to save xmr rate: {e}")
+
+	async def close(self):
+		if self.client is not None:
+			await self.client.aclose()
+			self.client = None
@@ -1,52 +1,163 @@
-import requests
+import httpx
+import asyncio
 import json
+import os
+import time
+import metrics
 
-with open('config.json', 'r') as file:
+with open(os.environ.get("CONFIG_FILE", "config.json"), 'r') as file:
 	config = json.load(file)
 
+#safe to resend if the wallet may have already seen the request
+#relay_tx included since the signed tx is fixed by its metadata, a second relay can't spend twice
+IDEMPOTENT_METHODS = {"incoming_transfers","get_transfers","get_balance","get_height","store","relay_tx"}
+MAX_ADDRESSES_PER_CALL = 64
+
 class XMRWalletRPC:
 	def __init__(self):
 		self.url = config["WALLET_RPC_ADDRESS"]
+		self.TIMEOUT = config["WALLET_RPC_TIMEOUT"]
+		self.MAX_CONNECTIONS = config["WALLET_RPC_MAX_CONNECTIONS"]
+		self.MAX_CONCURRENT = config["WALLET_RPC_MAX_CONCURRENT"]
+		self.RETRY_MAX = config["WALLET_RPC_RETRY_MAX"]
+		self.RETRY_BACKOFF = config["WALLET_RPC_RETRY_BACKOFF"]
+		self.client = None
+		self.semaphore = None
+
+	def get_client(self):
+		#created lazily so the pool binds to the running event loop
+		if self.client is None:
+			limits = httpx.Limits(max_connections=self.MAX_CONNECTIONS, max_keepalive_connections=self.MAX_CONNECTIONS)
+			self.client = httpx.AsyncClient(base_url=f"http://{self.url}", timeout=self.TIMEOUT, limits=limits)
+			self.semaphore = asyncio.Semaphore(self.MAX_CONCURRENT)
+		return self.client
+
+	async def close(self):
+		if self.client is not None:
+			await self.client.aclose()
+			self.client = None
+
+	def is_idempotent(self, method, params):
+		if method in IDEMPOTENT_METHODS:
+			return True
+		return method == "transfer" and bool(params) and params.get("do_not_relay", False)
+
+	async def post(self, data, idempotent):
+		method = data["method"] if isinstance(data, dict) else "batch"
+		start = time.perf_counter()
+		try:
+			response = await self.post_with_retry(data, idempotent)
+		except Exception:
+			metrics.wallet_rpc_errors.inc(method)
+			raise
+		metrics.wallet_rpc_seconds.observe(time.perf_counter() - start, method)
+		return response
+
+	async def post_with_retry(self, data, idempotent):
+		client = self.get_client()
+		attempt = 0
+		while True:
+			try:
+				async with self.semaphore:
+					response = await client.post("/json_rpc", json=data)
+				return response.json()
+			except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+				#request never reached the wallet, always safe to retry
+				error = e
+			except httpx.TransportError as e:
+				if not idempotent:
+					raise
+				error = e
+			attempt += 1
+			if attempt > self.RETRY_MAX:
+				raise error
+			await asyncio.sleep(self.RETRY_BACKOFF * 2 ** (attempt - 1))
 
-	def send(self, method, params = None):
+	async def send(self, method, params = None):
 		data = {"jsonrpc":"2.0","id":"0","method":method}
 		if params:
 			data["params"] = params
-		response = requests.post(f"http://{self.url}/json_rpc", json=data).json()
-		return response
+		return await self.post(data, self.is_idempotent(method, params))
+
+	async def batch(self, calls):
+		#calls is a list of (method, params), responses come back in the same order
+		data = []
+		for i, (method, params) in enumerate(calls):
+			call = {"jsonrpc":"2.0","id":str(i),"method":method}
+			if params:
+				call["params"] = params
+			data.append(call)
+		idempotent = all(self.is_idempotent(method, params) for method, params in calls)
+		responses = await self.post(data, idempotent)
+		if not isinstance(responses, list):
+			#wallet without batch support, only replay when nothing can be sent twice
+			if not idempotent:
+				raise ValueError("wallet rpc does not support batch requests")
+			return await asyncio.gather(*[self.send(method, params) for method, params in calls])
+		by_id = {response.get("id"): response for response in responses}
+		return [by_id.get(str(i), {}) for i in range(len(calls))]
 
-	def create_address(self):
-		address = self.send("create_address",{"account_index":0,"label":"","count":1})
-		self.send("store") #saves file with new index
+	async def create_address(self, count=1):
+		address = await self.send("create_address",{"account_index":0,"label":"","count":count})
+		await self.store() #saves file with new index
 		return address["result"]
 
-	def incoming_transfers(self, subaddr_indices):
-		transfers = self.send("incoming_transfers",{"transfer_type":"available","account_index":0,"subaddr_indices":subaddr_indices})
+	async def create_addresses(self, count):
+		#(address_index, address) pairs, the wallet makes at most MAX_ADDRESSES_PER_CALL a call and the file is saved once at the end
+		addresses = []
+		while len(addresses) < count:
+			created = await self.send("create_address",{"account_index":0,"label":"","count":min(count - len(addresses), MAX_ADDRESSES_PER_CALL)})
+			created = created["result"]
+			addresses += list(zip(created["address_indices"], created["addresses"]))
+		await self.store()
+		return addresses
+
+	async def store(self):
+		return await self.send("store")
+
+	async def incoming_transfers(self, subaddr_indices):
+		transfers = await self.send("incoming_transfers",{"transfer_type":"available","account_index":0,"subaddr_indices":subaddr_indices})
 		if transfers == {} or transfers["result"] == {}:
 			return []
 		return transfers["result"]["transfers"]
 
-	def get_transfers(self, min_height=0):
-		transfers = self.send("get_transfers", {"in":True,"account_index":0,"pending":False,"filter_by_height":True,"min_height":min_height})
+	async def get_transfers(self, min_height=0):
+		transfers = await self.send("get_transfers", {"in":True,"account_index":0,"pending":False,"filter_by_height":True,"min_height":min_height})
 		if transfers["result"] == {}:
 			return []
 		return transfers["result"]
 
-	def transfer_no_relay(self, amount, address):
-		transfer = self.send("transfer",{"destinations":[{"amount":amount,"address":address}],"account_index":0,"priority":0,"ring_size":16,"get_tx_metadata":True,"do_not_relay":True})
+	async def get_outgoing_transfers(self):
+		#everything this wallet has sent or has waiting to go out
+		transfers = await self.send("get_transfers", {"out":True,"pending":True,"pool":True,"account_index":0})
+		result = transfers["result"]
+		return [transfer for key in ("out","pending","pool") for transfer in result.get(key, [])]
+
+	async def get_outgoing_tx_hashes(self):
+		#used to settle withdraws whose relay outcome was lost
+		return {transfer["txid"] for transfer in await self.get_outgoing_transfers()}
+
+	async def transfer_no_relay(self, destinations):
+		#destinations is a list of {"amount","address"}, one output each
+		transfer = await self.send("transfer",{"destinations":destinations,"account_index":0,"priority":0,"ring_size":16,"get_tx_metadata":True,"do_not_relay":True})
 		if not "result" in transfer:
 			return None
 		return transfer["result"]
 
-	def relay_tx(self, tx_metadata):
-		transfer = self.send("relay_tx",{"hex":tx_metadata})
+	async def relay_tx(self, tx_metadata):
+		transfer = await self.send("relay_tx",{"hex":tx_metadata})
 		if not "result" in transfer:
 			return None
 		return transfer["result"]
 
-	def get_balance(self):
-		balance = self.send("get_balance")
+	async def get_height(self):
+		height = await self.send("get_height")
+		return height["result"]["height"]
+
+	async def get_balance(self):
+		balance = await self.send("get_balance")
 		return balance["result"]
 
+xmr_wallet_rpc = XMRWalletRPC()
 
-#monero-wallet-rpc.exe --rpc-bind-port (wallet_rpc_port) --daemon-address (rpc_address) --wallet-file (file_name) --prompt-for-password --disable-rpc-login
\ No newline at end of file
+#monero-wallet-rpc.exe --rpc-bind-port (wallet_rpc_port) --daemon-address (rpc_address) --wallet-file (file_name) --prompt-for-password --disable-rpc-login